@@ -0,0 +1,205 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from Metrics import metrics
+
+# Served in this order; a waiting interactive request always goes before a batch one
+PRIORITIES = ("interactive", "batch")
+
+# Generations running at once; matches the scheduler's batch size so admitted requests decode together
+MAX_ACTIVE = int(os.environ.get("OPENMED_MAX_ACTIVE", "8"))
+MAX_ACTIVE_PER_CLIENT = int(os.environ.get("OPENMED_MAX_ACTIVE_PER_CLIENT", "4"))
+MAX_QUEUED = {"interactive": 32, "batch": 256}
+MAX_QUEUED_PER_CLIENT = 64
+QUEUE_TIMEOUT_SECONDS = {"interactive": 60.0, "batch": 600.0}
+# Peers whose X-Forwarded-For names the real client, e.g. "127.0.0.1" on workers behind Router.py
+TRUSTED_PROXIES = frozenset(
+    host.strip() for host in os.environ.get("OPENMED_TRUSTED_PROXIES", "").split(",") if host.strip()
+)
+
+
+def client_address(request, trusted_proxies=TRUSTED_PROXIES) -> str:
+    """
+    The client a request is counted against: its peer address, or the address
+    in X-Forwarded-For when the peer is a trusted proxy (the last entry, which
+    that proxy added). Anyone else can set the header, so it is ignored.
+    """
+    peer = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and peer in trusted_proxies:
+        return forwarded.split(",")[-1].strip() or peer
+    return peer
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; maps to an HTTP error with a Retry-After hint."""
+
+    def __init__(self, reason: str, message: str, retry_after: int, status_code: int = 429):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class Ticket:
+    """An admitted request; pass it back to `AdmissionController.release` when the generation ends."""
+
+    def __init__(self, client_id: str, priority: str, enqueued_at: float):
+        self.client_id = client_id
+        self.priority = priority
+        self.enqueued_at = enqueued_at
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self.future: "asyncio.Future" = asyncio.get_running_loop().create_future()
+
+
+class AdmissionController:
+    """
+    Bounded, prioritised admission in front of the inference service.
+
+    At most `max_active` generations run at once, and at most
+    `max_active_per_client` for any one client. Everything else waits in a FIFO
+    queue per priority class. A waiter whose client is at its cap is skipped,
+    so it cannot block other clients. Full queues are rejected immediately
+    (429), and requests that wait longer than the class's queue timeout are
+    rejected (503). Both carry a Retry-After estimate from recent service times.
+    All methods run on the event loop.
+    """
+
+    def __init__(
+        self,
+        max_active: int = MAX_ACTIVE,
+        max_active_per_client: int = MAX_ACTIVE_PER_CLIENT,
+        max_queued: Dict[str, int] = MAX_QUEUED,
+        max_queued_per_client: int = MAX_QUEUED_PER_CLIENT,
+        queue_timeout: Dict[str, float] = QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_active = max_active
+        self.max_active_per_client = max_active_per_client
+        self.max_queued = dict(max_queued)
+        self.max_queued_per_client = max_queued_per_client
+        self.queue_timeout = dict(queue_timeout)
+        self.queues: Dict[str, Deque[Ticket]] = {priority: deque() for priority in PRIORITIES}
+        self.active = 0
+        self.active_by_client: Dict[str, int] = {}
+        self.queued_by_client: Dict[str, int] = {}
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.rejected: Dict[str, int] = {}
+        # Moving average of how long an admitted request holds its slot
+        self.service_time_ewma = 5.0
+
+    async def acquire(self, client_id: str, priority: str = "interactive") -> Ticket:
+        """Waits for a slot; raises `AdmissionRejected` if the queue is full or the wait times out."""
+        if priority not in self.queues:
+            raise ValueError(f"Unknown priority '{priority}'. Expected one of {', '.join(PRIORITIES)}.")
+
+        queue = self.queues[priority]
+        if len(queue) >= self.max_queued[priority]:
+            self._reject("queue_full", f"The {priority} queue is full.")
+        if self.queued_by_client.get(client_id, 0) >= self.max_queued_per_client:
+            self._reject("client_queue_full", "Too many queued requests from this client.")
+
+        ticket = Ticket(client_id, priority, time.perf_counter())
+        queue.append(ticket)
+        self.queued_by_client[client_id] = self.queued_by_client.get(client_id, 0) + 1
+        self._dispatch()
+        if ticket.future.done():
+            return ticket
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.queue_timeout[priority])
+            return ticket
+        except asyncio.TimeoutError:
+            if ticket.future.done():
+                # Granted in the same loop iteration as the timeout fired
+                return ticket
+            self._dequeue(ticket)
+            self._reject("queue_timeout", "Timed out waiting for a free generation slot.", status_code=503)
+        except asyncio.CancelledError:
+            # The client went away while queued
+            if ticket.future.done():
+                self.release(ticket)
+            else:
+                self._dequeue(ticket)
+            raise
+
+    def release(self, ticket: Ticket):
+        """Frees the ticket's slot. Safe to call more than once."""
+        if ticket.released or ticket.granted_at is None:
+            return
+        ticket.released = True
+        self.active -= 1
+        remaining = self.active_by_client[ticket.client_id] - 1
+        if remaining:
+            self.active_by_client[ticket.client_id] = remaining
+        else:
+            del self.active_by_client[ticket.client_id]
+        held = time.perf_counter() - ticket.granted_at
+        self.service_time_ewma = 0.9 * self.service_time_ewma + 0.1 * held
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_active:
+            ticket = self._next_waiter()
+            if ticket is None:
+                return
+            self._dequeue(ticket)
+            ticket.granted_at = time.perf_counter()
+            self.active += 1
+            self.active_by_client[ticket.client_id] = self.active_by_client.get(ticket.client_id, 0) + 1
+            self.admitted[ticket.priority] += 1
+            metrics.observe(
+                f"admission_wait_seconds_{ticket.priority}",
+                ticket.granted_at - ticket.enqueued_at,
+                f"Time {ticket.priority} requests waited for a generation slot.",
+            )
+            ticket.future.set_result(ticket)
+
+    def _next_waiter(self) -> Optional[Ticket]:
+        for priority in PRIORITIES:
+            for ticket in self.queues[priority]:
+                if self.active_by_client.get(ticket.client_id, 0) < self.max_active_per_client:
+                    return ticket
+        return None
+
+    def _dequeue(self, ticket: Ticket):
+        try:
+            self.queues[ticket.priority].remove(ticket)
+        except ValueError:
+            return
+        remaining = self.queued_by_client[ticket.client_id] - 1
+        if remaining:
+            self.queued_by_client[ticket.client_id] = remaining
+        else:
+            del self.queued_by_client[ticket.client_id]
+
+    def _reject(self, reason: str, message: str, status_code: int = 429):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        metrics.inc(f"admission_rejected_total_{reason}")
+        raise AdmissionRejected(reason, message, self.retry_after(), status_code)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free for a new request, from queue depth and recent service times."""
+        queued = sum(len(queue) for queue in self.queues.values())
+        estimate = self.service_time_ewma * (queued + 1) / max(1, self.max_active)
+        return max(1, min(120, math.ceil(estimate)))
+
+    def stats(self) -> Dict:
+        now = time.perf_counter()
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "clients_active": len(self.active_by_client),
+            "queued": {priority: len(queue) for priority, queue in self.queues.items()},
+            "oldest_wait_s": {
+                priority: now - queue[0].enqueued_at if queue else 0.0 for priority, queue in self.queues.items()
+            },
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+            "service_time_ewma_s": self.service_time_ewma,
+            "retry_after_s": self.retry_after(),
+        }
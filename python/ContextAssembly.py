@@ -0,0 +1,174 @@
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate
+from pathlib import Path
+from typing import Dict, List
+
+TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def _terms(text: str) -> List[str]:
+    return [term.lower() for term in TERM_PATTERN.findall(text)]
+
+
+class ContextAssembler:
+    """
+    Fits attached files into a token budget by keeping the chunks most relevant to a question.
+
+    Files are split into line-aligned chunks of about `chunk_tokens` tokens. Chunk
+    offsets, token counts and term frequencies live in an on-disk SQLite index keyed
+    by file path and content hash, so only changed files are re-chunked and
+    re-tokenized. The index never stores file text itself. Chunks are ranked
+    with BM25 against the question and added best-first until the budget is
+    used up.
+    """
+
+    def __init__(self, index_path: Path, tokenizer=None, chunk_tokens: int = 256):
+        self.tokenizer = tokenizer
+        self.chunk_tokens = chunk_tokens
+        index_path = Path(index_path)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(index_path), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                path TEXT NOT NULL,
+                ord INTEGER NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                n_tokens INTEGER NOT NULL,
+                terms TEXT NOT NULL,
+                PRIMARY KEY (path, ord)
+            );
+            """
+        )
+        self._db.commit()
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            # Rough estimate for when no tokenizer is available
+            return max(1, len(text) // 4)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def assemble(self, files: List[Dict[str, str]], question: str, budget: int) -> List[Dict[str, str]]:
+        """
+        Returns `{"name", "content"}` parts that fit within `budget` tokens. Files
+        that fit entirely are returned unchanged; otherwise the selected chunks are
+        returned in their original file order.
+        """
+        chunks = []
+        for file_data in files:
+            for ord_, text, n_tokens, terms in self._chunks_for(file_data):
+                chunks.append(
+                    {"name": file_data["name"], "ord": ord_, "text": text, "n_tokens": n_tokens, "terms": terms}
+                )
+        if sum(chunk["n_tokens"] for chunk in chunks) <= budget:
+            return [{"name": f["name"], "content": f["content"]} for f in files]
+
+        for chunk, score in zip(chunks, self._bm25(chunks, _terms(question))):
+            chunk["score"] = score
+
+        selected = []
+        used = 0
+        for chunk in sorted(chunks, key=lambda c: c["score"], reverse=True):
+            if used + chunk["n_tokens"] > budget:
+                continue
+            selected.append(chunk)
+            used += chunk["n_tokens"]
+
+        file_order = {file_data["name"]: i for i, file_data in enumerate(files)}
+        selected.sort(key=lambda c: (file_order[c["name"]], c["ord"]))
+        return [
+            {"name": f"{chunk['name']} (part {chunk['ord'] + 1})", "content": chunk["text"]}
+            for chunk in selected
+        ]
+
+    def _chunks_for(self, file_data: Dict[str, str]):
+        path = file_data.get("path", file_data["name"])
+        content = file_data["content"]
+        content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        with self._lock:
+            row = self._db.execute("SELECT content_hash FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == content_hash:
+                rows = self._db.execute(
+                    "SELECT ord, start, end, n_tokens, terms FROM chunks WHERE path = ? ORDER BY ord", (path,)
+                ).fetchall()
+                return [
+                    (ord_, content[start:end], n_tokens, json.loads(terms))
+                    for ord_, start, end, n_tokens, terms in rows
+                ]
+
+        rows = []
+        for ord_, (start, end, n_tokens) in enumerate(self._split(content)):
+            rows.append((ord_, start, end, n_tokens, dict(Counter(_terms(content[start:end])))))
+
+        with self._lock:
+            self._db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+            self._db.executemany(
+                "INSERT INTO chunks (path, ord, start, end, n_tokens, terms) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, ord_, start, end, n_tokens, json.dumps(terms)) for ord_, start, end, n_tokens, terms in rows],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, content_hash) VALUES (?, ?)", (path, content_hash)
+            )
+            self._db.commit()
+        return [(ord_, content[start:end], n_tokens, terms) for ord_, start, end, n_tokens, terms in rows]
+
+    def _split(self, content: str):
+        """Yields `(start, end, n_tokens)` of line-aligned chunks of about `chunk_tokens` tokens."""
+        start = end = 0
+        current_tokens = 0
+        lines = content.splitlines(keepends=True)
+        for line, line_tokens in zip(lines, self._line_tokens(lines)):
+            if end > start and current_tokens + line_tokens > self.chunk_tokens:
+                yield start, end, current_tokens
+                start, current_tokens = end, 0
+            end += len(line)
+            current_tokens += line_tokens
+        if end > start:
+            yield start, end, current_tokens
+
+    def _line_tokens(self, lines: List[str]) -> List[int]:
+        """Token count of each line; fast tokenizers tokenize the text once and count by offsets."""
+        if not lines or not getattr(self.tokenizer, "is_fast", False):
+            return [self.count_tokens(line) for line in lines]
+        encoding = self.tokenizer("".join(lines), add_special_tokens=False, return_offsets_mapping=True)
+        token_starts = [start for start, _ in encoding["offset_mapping"]]
+        # Tokens starting before each line's end; a token spanning a line break counts toward the line it starts on
+        before = [bisect_left(token_starts, line_end) for line_end in accumulate(len(line) for line in lines)]
+        return [end - start for start, end in zip([0] + before[:-1], before)]
+
+    def _bm25(self, chunks: List[dict], query_terms: List[str]) -> List[float]:
+        if not chunks or not query_terms:
+            return [0.0] * len(chunks)
+        n = len(chunks)
+        lengths = [sum(chunk["terms"].values()) for chunk in chunks]
+        avgdl = (sum(lengths) / n) or 1.0
+        query = set(query_terms)
+        df = Counter(term for chunk in chunks for term in query if term in chunk["terms"])
+        idf = {term: math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5)) for term in query}
+
+        scores = []
+        for chunk, length in zip(chunks, lengths):
+            score = 0.0
+            for term in query:
+                tf = chunk["terms"].get(term, 0)
+                if tf:
+                    score += idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl))
+            scores.append(score)
+        return scores
@@ -0,0 +1,226 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from ServerUtils import ATTACHMENT_HEADER
+
+# Token counts remembered per text part, keyed by content hash
+TOKEN_COUNT_CACHE_ENTRIES = 65536
+# Chats whose trim point is remembered
+MAX_TRACKED_CHATS = 1024
+# Chat template tokens around each message (<start_of_turn>role\n ... <end_of_turn>\n)
+MESSAGE_OVERHEAD_TOKENS = 5
+# BOS and the generation prompt
+PROMPT_OVERHEAD_TOKENS = 4
+# Once a prompt has to be trimmed it is cut to this fraction of the budget, so the
+# next turns fit without moving the cut again and keep reusing the cached prefix
+TRIM_TARGET_FRACTION = 0.75
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _parts(message: dict) -> List[dict]:
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return content
+    return [{"type": "text", "text": content}]
+
+
+def _attachment_name(part: dict) -> Optional[str]:
+    """The file name of a part holding an attached file's text, or None."""
+    text = part.get("text", "") if part.get("type") == "text" else ""
+    if not text.startswith(ATTACHMENT_HEADER):
+        return None
+    return text[len(ATTACHMENT_HEADER):].split(" ---\n", 1)[0]
+
+
+class TrimResult:
+    """The messages to template and what was left out to fit the budget."""
+
+    def __init__(self, messages: List[dict], tokens: int, budget: int):
+        self.messages = messages
+        self.tokens = tokens
+        self.budget = budget
+        self.dropped_messages = 0
+        self.dropped_attachments: List[str] = []
+
+    @property
+    def trimmed(self) -> bool:
+        return bool(self.dropped_messages or self.dropped_attachments)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_budget": self.budget,
+            "estimated_tokens": self.tokens,
+            "dropped_messages": self.dropped_messages,
+            "dropped_attachments": self.dropped_attachments,
+        }
+
+
+class ContextWindow:
+    """
+    Keeps prompts under a token budget so prefill cost stays bounded however long a chat runs.
+
+    Messages are counted part by part; counts are cached by content hash, so the
+    old turns of a growing chat are never re-tokenized. Over budget, attached
+    files are taken out of older user messages first, then the oldest turns are
+    dropped, and as a last resort the files attached to the newest message.
+    Removed files and turns leave a short note, so the model knows something is
+    missing. System messages and the newest message are always kept.
+
+    The cut for each chat is remembered and reused while the chat still fits, so
+    consecutive turns share a stable prompt prefix for the prefix cache.
+    """
+
+    def __init__(self, tokenizer, image_tokens: int = 0, max_entries: int = TOKEN_COUNT_CACHE_ENTRIES):
+        self.tokenizer = tokenizer
+        self.image_tokens = image_tokens
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.trimmed_prompts = 0
+        self._lock = threading.Lock()
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        # chat id -> (messages dropped, messages with their files removed)
+        self._cuts: "OrderedDict[Any, Tuple[int, int]]" = OrderedDict()
+
+    def count_text(self, text: str) -> int:
+        key = _hash(text)
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return count
+        count = len(self.tokenizer.encode(text, add_special_tokens=False))
+        with self._lock:
+            self.misses += 1
+            self._counts[key] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_message(self, message: dict) -> int:
+        tokens = MESSAGE_OVERHEAD_TOKENS
+        for part in _parts(message):
+            if part.get("type") == "image":
+                tokens += self.image_tokens
+            elif part.get("type") == "text":
+                tokens += self.count_text(part.get("text", ""))
+        return tokens
+
+    def count(self, messages: List[dict]) -> int:
+        return PROMPT_OVERHEAD_TOKENS + sum(self.count_message(message) for message in messages)
+
+    def fit(self, messages: List[dict], budget: int, chat_id=None) -> TrimResult:
+        """
+        Returns the messages cut down to about `budget` tokens. Messages that need no
+        change are passed through as they are; changed ones are copies.
+        """
+        tokens = self.count(messages)
+        if tokens <= budget:
+            return TrimResult(messages, tokens, budget)
+
+        with self._lock:
+            cut = self._cuts.get(chat_id) if chat_id is not None else None
+        if cut is not None:
+            result = self._apply(messages, budget, *cut)
+            if result.tokens <= budget:
+                with self._lock:
+                    self._cuts.move_to_end(chat_id)
+                    self.trimmed_prompts += 1
+                return result
+
+        result, cut = self._trim(messages, budget, int(budget * TRIM_TARGET_FRACTION))
+        with self._lock:
+            self.trimmed_prompts += 1
+            if chat_id is not None:
+                self._cuts[chat_id] = cut
+                self._cuts.move_to_end(chat_id)
+                while len(self._cuts) > MAX_TRACKED_CHATS:
+                    self._cuts.popitem(last=False)
+        return result
+
+    def _trim(self, messages: List[dict], budget: int, target: int) -> Tuple[TrimResult, Tuple[int, int]]:
+        """Smallest cut that brings the prompt under `target` tokens (or as close as it gets)."""
+        full = [self.count_message(message) for message in messages]
+        stripped_counts = [self.count_message(self._strip_attachments(message)[0]) for message in messages]
+        note_tokens = self.count_text(self._note(len(messages))) + 2
+
+        def estimate(dropped: int, stripped: int) -> int:
+            kept = self._kept(messages, dropped)
+            tokens = PROMPT_OVERHEAD_TOKENS + (note_tokens if len(kept) < len(messages) else 0)
+            return tokens + sum(stripped_counts[i] if i < stripped else full[i] for i in kept)
+
+        last = len(messages) - 1
+        # Files come out of older messages first, oldest first; then whole turns go,
+        # oldest first; finally the newest message's own files
+        cuts = [(0, stripped) for stripped in range(1, last + 1)]
+        cuts += [(dropped, last) for dropped in range(1, last + 1)]
+        cuts.append((last, last + 1))
+        cut = next((cut for cut in cuts if estimate(*cut) <= target), cuts[-1])
+        return self._apply(messages, budget, *cut), cut
+
+    def _kept(self, messages: List[dict], dropped: int) -> List[int]:
+        """Indices left after dropping the first `dropped` non-system messages; the newest always stays."""
+        conversation = [i for i, message in enumerate(messages) if message.get("role") != "system"]
+        rest = conversation[min(dropped, len(conversation) - 1):]
+        # Roles must keep alternating, so a cut history restarts at a user message
+        while dropped and len(rest) > 1 and messages[rest[0]].get("role") != "user":
+            rest = rest[1:]
+        kept = set(rest)
+        return [i for i, message in enumerate(messages) if message.get("role") == "system" or i in kept]
+
+    def _note(self, dropped: int) -> str:
+        return f"[{dropped} earlier messages were omitted to fit the context window.]\n"
+
+    def _apply(self, messages: List[dict], budget: int, dropped: int, stripped: int) -> TrimResult:
+        """Drops the first `dropped` non-system messages and removes the files of the first `stripped`."""
+        kept = []
+        dropped_attachments = []
+        for index in self._kept(messages, dropped):
+            message = messages[index]
+            if index < stripped:
+                message, names = self._strip_attachments(message)
+                dropped_attachments.extend(names)
+            kept.append(message)
+
+        dropped_count = len(messages) - len(kept)
+        if dropped_count:
+            for index, message in enumerate(kept):
+                if message.get("role") == "user":
+                    note = {"type": "text", "text": self._note(dropped_count)}
+                    kept[index] = {**message, "content": [note] + list(_parts(message))}
+                    break
+
+        result = TrimResult(kept, self.count(kept), budget)
+        result.dropped_messages = dropped_count
+        result.dropped_attachments = dropped_attachments
+        return result
+
+    def _strip_attachments(self, message: dict) -> Tuple[dict, List[str]]:
+        parts = []
+        names = []
+        for part in _parts(message):
+            name = _attachment_name(part)
+            if name is None:
+                parts.append(part)
+            else:
+                names.append(name)
+                parts.append({"type": "text", "text": f"{ATTACHMENT_HEADER}{name} (omitted to fit the context window) ---\n"})
+        if not names:
+            return message, names
+        return {**message, "content": parts}, names
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "cached_counts": len(self._counts),
+                "hits": self.hits,
+                "misses": self.misses,
+                "trimmed_prompts": self.trimmed_prompts,
+                "tracked_chats": len(self._cuts),
+            }
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Chats kept in memory; the least recently used one is dropped first
+MAX_CONVERSATIONS = 512
+# Chats not used for this long are dropped
+CONVERSATION_IDLE_SECONDS = 6 * 3600
+
+
+class VersionConflict(Exception):
+    """The client's base version is not the server's current version of the chat."""
+
+    def __init__(self, current_version: Optional[str]):
+        super().__init__("Conversation version mismatch.")
+        self.current_version = current_version
+
+
+def _chain(version: str, message: dict) -> str:
+    """Next version: a hash over the previous version and the added message."""
+    digest = hashlib.sha256(version.encode("utf-8"))
+    digest.update(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def _copy_message(message: dict) -> dict:
+    # Content lists are mutated downstream (image parts are inserted), so they are copied too
+    copy = dict(message)
+    if isinstance(copy.get("content"), list):
+        copy["content"] = [dict(part) if isinstance(part, dict) else part for part in copy["content"]]
+    if isinstance(copy.get("paths"), list):
+        copy["paths"] = list(copy["paths"])
+    return copy
+
+
+class _Conversation:
+    def __init__(self):
+        self.messages: List[dict] = []
+        self.version = ""
+        self.touched_at = time.monotonic()
+
+
+class ConversationStore:
+    """
+    Server-side message history per chat, so clients only send new turns.
+
+    Each chat has a version string that chains a hash over every message, so
+    any divergence between client and server (edited or deleted turns, a
+    restarted server) shows up as a version mismatch. The client then resends
+    the whole history. Appending costs time in proportion to the new messages
+    only.
+    """
+
+    def __init__(self, max_conversations: int = MAX_CONVERSATIONS, idle_seconds: float = CONVERSATION_IDLE_SECONDS):
+        self.max_conversations = max_conversations
+        self.idle_seconds = idle_seconds
+        self._conversations: "OrderedDict[int, _Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.appends = 0
+        self.full_syncs = 0
+        self.conflicts = 0
+
+    def version(self, chat_id) -> Optional[str]:
+        with self._lock:
+            conversation = self._get(chat_id)
+            return conversation.version if conversation is not None else None
+
+    def append(self, chat_id, base_version: Optional[str], messages: List[dict]) -> str:
+        """Adds `messages` if the chat is still at `base_version`; returns the new version."""
+        with self._lock:
+            conversation = self._get(chat_id)
+            current = conversation.version if conversation is not None else None
+            if conversation is None or current != base_version:
+                self.conflicts += 1
+                raise VersionConflict(current)
+            self._extend(conversation, messages)
+            self.appends += 1
+            return conversation.version
+
+    def replace(self, chat_id, messages: List[dict]) -> str:
+        """Full sync: the chat's history becomes `messages`; returns the new version."""
+        with self._lock:
+            conversation = _Conversation()
+            self._extend(conversation, messages)
+            self._conversations[chat_id] = conversation
+            self._conversations.move_to_end(chat_id)
+            self._evict()
+            self.full_syncs += 1
+            return conversation.version
+
+    def snapshot(self, chat_id) -> List[dict]:
+        """Copies of the chat's messages, safe to modify."""
+        with self._lock:
+            conversation = self._get(chat_id)
+            if conversation is None:
+                return []
+            return [_copy_message(message) for message in conversation.messages]
+
+    def _get(self, chat_id) -> Optional[_Conversation]:
+        conversation = self._conversations.get(chat_id)
+        if conversation is None:
+            return None
+        if time.monotonic() - conversation.touched_at > self.idle_seconds:
+            del self._conversations[chat_id]
+            return None
+        conversation.touched_at = time.monotonic()
+        self._conversations.move_to_end(chat_id)
+        return conversation
+
+    def _extend(self, conversation: _Conversation, messages: List[dict]):
+        for message in messages:
+            conversation.messages.append(message)
+            conversation.version = _chain(conversation.version, message)
+        conversation.touched_at = time.monotonic()
+
+    def _evict(self):
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "messages": sum(len(c.messages) for c in self._conversations.values()),
+                "appends": self.appends,
+                "full_syncs": self.full_syncs,
+                "conflicts": self.conflicts,
+            }
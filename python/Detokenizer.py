@@ -0,0 +1,42 @@
+from typing import List
+
+# Decoding holds back text ending in this until the next token completes the character
+REPLACEMENT_CHAR = "�"
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing token sequence into text fragments at a cost per token that
+    does not grow with the answer.
+
+    Rather than decoding the whole answer after every token, only a short window
+    is decoded: the tokens since the last emitted fragment, plus the tokens of
+    that fragment as context. The context makes word-initial spaces and merged
+    byte sequences come out exactly as in a full decode; its own text is then cut
+    off. Text ending in an incomplete multi-byte character is held back until a
+    later token completes it.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens: List[int] = []
+        # tokens[prefix_offset:read_offset] were emitted last and serve as context
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token: int) -> str:
+        """Adds a token and returns the text it completes ("" when nothing is printable yet)."""
+        self.tokens.append(token)
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith(REPLACEMENT_CHAR):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+    def _decode(self, tokens: List[int]) -> str:
+        if not tokens:
+            return ""
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
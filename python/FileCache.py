@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+
+class FileContentCache:
+    """
+    In-memory cache of text file contents keyed by path, mtime and size.
+
+    Unchanged files are served from memory; a changed mtime or size makes the
+    entry stale and the file is read again. Entries are evicted least-recently-used
+    once `max_bytes` of file content is held. Folder walks and reads run on a
+    shared thread pool.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_workers: int = 8):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="file-cache")
+
+    def read(self, path: Path, stat: Optional[os.stat_result] = None) -> str:
+        """Returns the file's text, reading it from disk only when it changed since the last read."""
+        key = str(path)
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        with open(path, "r", encoding="utf-8") as f:
+            before = os.fstat(f.fileno())
+            content = f.read()
+            after = os.fstat(f.fileno())
+        # Keyed on what was actually read; a file written to during the read is not cached
+        stat = after
+        unchanged = (before.st_mtime_ns, before.st_size) == (after.st_mtime_ns, after.st_size)
+
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes_held -= old[1]
+            if unchanged and stat.st_size <= self.max_bytes:
+                self.entries[key] = (stat.st_mtime_ns, stat.st_size, content)
+                self.bytes_held += stat.st_size
+                while self.bytes_held > self.max_bytes:
+                    _, (_, size, _) = self.entries.popitem(last=False)
+                    self.bytes_held -= size
+        return content
+
+    def iter_folder(self, folder: Path, extensions: Iterable[str]) -> Iterator[Tuple[Path, Optional[str], Optional[Exception]]]:
+        """
+        Walks `folder` and yields `(path, content, error)` for every file with a
+        supported extension, as soon as each one has been read. Sub-directories are
+        listed and files are read concurrently, so results arrive in no particular order.
+        """
+        extensions = {ext.lower() for ext in extensions}
+        results: "queue.Queue" = queue.Queue()
+        pending = [0]
+        pending_lock = threading.Lock()
+
+        def submit(fn, *args):
+            with pending_lock:
+                pending[0] += 1
+            self._executor.submit(run, fn, *args)
+
+        def run(fn, *args):
+            try:
+                fn(*args)
+            except Exception as e:
+                results.put((args[0], None, e))
+            finally:
+                with pending_lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        results.put(None)
+
+        def scan(directory: Path):
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        submit(scan, Path(entry.path))
+                    elif entry.is_file() and Path(entry.name).suffix.lower() in extensions:
+                        submit(read, Path(entry.path), entry.stat())
+
+        def read(path: Path, stat: os.stat_result):
+            results.put((path, self.read(path, stat), None))
+
+        submit(scan, folder)
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            yield item
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from Log import get_logger
+
+log = get_logger(__name__)
+
+# Delta events kept per generation for clients that reattach; older ones are folded into a text snapshot
+REPLAY_BUFFER_MAX_EVENTS = 2048
+# A running generation that no client has been attached to for this long is cancelled
+ORPHAN_TIMEOUT_SECONDS = float(os.environ.get("OPENMED_GENERATION_ORPHAN_SECONDS", "300"))
+# A finished generation can still be read this long after its last client detached
+FINISHED_RETENTION_SECONDS = float(os.environ.get("OPENMED_GENERATION_RETENTION_SECONDS", "600"))
+REAP_INTERVAL_SECONDS = 5.0
+
+
+class GenerationNotFound(KeyError):
+    """No generation with this id is running or retained."""
+
+
+class _Generation:
+    def __init__(self, generation_id: str, cancel: Callable[[], Any], max_events: int):
+        self.generation_id = generation_id
+        self.cancel = cancel
+        self.max_events = max_events
+        self.start_event: Optional[dict] = None
+        # Events with seq >= 1: deltas, then the final complete or error event
+        self.events: deque = deque()
+        # Text of the deltas dropped from the front of `events`, and the last seq among them
+        self.dropped_text = ""
+        self.dropped_seq = 0
+        self.last_seq = 0
+        self.finished = False
+        self.readers = 0
+        self.orphaned = False
+        self.idle_since = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def append(self, event: dict):
+        if event["type"] == "start":
+            self.start_event = event
+        else:
+            if "seq" not in event:
+                event = {**event, "seq": self.last_seq + 1}
+            self.last_seq = event["seq"]
+            self.events.append(event)
+            while len(self.events) > self.max_events and self.events[0]["type"] == "delta":
+                dropped = self.events.popleft()
+                self.dropped_text += dropped["text"]
+                self.dropped_seq = dropped["seq"]
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self.idle_since = time.monotonic()
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def text_until(self, seq: int) -> str:
+        """Text of the deltas up to and including `seq` (at least the dropped ones)."""
+        return self.dropped_text + "".join(
+            event["text"] for event in self.events if event["type"] == "delta" and event["seq"] <= seq
+        )
+
+    async def read(self, from_seq: int, snapshot: bool = False) -> AsyncIterator[dict]:
+        """
+        Events from `from_seq` on, then live ones until the generation ends. When
+        deltas before the buffer are asked for, a `snapshot` event carrying the
+        whole text up to its `seq` replaces them. With `snapshot`, one comes first
+        whenever earlier text exists, so readers that need the whole text have it.
+        """
+        position = from_seq
+        if snapshot and self.dropped_seq < position - 1:
+            seq = min(position - 1, self.last_seq)
+            yield {"type": "snapshot", "seq": seq, "text": self.text_until(seq), "generation_id": self.generation_id}
+        while True:
+            changed = self._changed
+            if position <= 0 and self.start_event is not None:
+                yield self.start_event
+            position = max(position, 1)
+            if position <= self.dropped_seq:
+                yield {
+                    "type": "snapshot",
+                    "seq": self.dropped_seq,
+                    "text": self.dropped_text,
+                    "generation_id": self.generation_id,
+                }
+                position = self.dropped_seq + 1
+            # Seqs in the buffer are consecutive; it may change while this reader is suspended
+            while self.events:
+                index = position - self.events[0]["seq"]
+                if index < 0 or index >= len(self.events):
+                    break
+                event = self.events[index]
+                yield event
+                position = event["seq"] + 1
+            if position <= self.dropped_seq:
+                # Fell behind the buffer while suspended; a snapshot covers the gap
+                continue
+            if self.finished and position > self.last_seq:
+                return
+            await changed.wait()
+
+
+class GenerationRegistry:
+    """
+    Runs generations independently of the HTTP requests that start them.
+
+    Each generation is driven by its own task and its events go into a bounded
+    replay buffer, so a client whose connection drops can reattach with
+    `stream(generation_id, from_seq)` and continue where it stopped; several
+    clients may read the same generation. Nothing is regenerated on reconnect.
+    A running generation without readers for `orphan_timeout` is cancelled; a
+    finished one is forgotten `retention` seconds after its last reader left.
+    """
+
+    def __init__(
+        self,
+        max_events: int = REPLAY_BUFFER_MAX_EVENTS,
+        orphan_timeout: float = ORPHAN_TIMEOUT_SECONDS,
+        retention: float = FINISHED_RETENTION_SECONDS,
+    ):
+        self.max_events = max_events
+        self.orphan_timeout = orphan_timeout
+        self.retention = retention
+        self.reattached = 0
+        self.orphans_cancelled = 0
+        self._generations: Dict[str, _Generation] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    def start(self, generation_id: str, events: AsyncIterator[dict], cancel: Callable[[], Any]):
+        """
+        Drives `events` (an async generator of generation events) to the end in the
+        background. `cancel` is called when the generation is orphaned or the
+        registry closes.
+        """
+        generation = _Generation(generation_id, cancel, self.max_events)
+        self._generations[generation_id] = generation
+        generation.task = asyncio.create_task(self._drive(generation, events))
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def _drive(self, generation: _Generation, events: AsyncIterator[dict]):
+        try:
+            async for event in events:
+                generation.append(event)
+        except Exception as e:
+            log.exception("Generation %s failed: %s", generation.generation_id, e)
+            generation.append({"type": "error", "message": str(e), "generation_id": generation.generation_id})
+        finally:
+            await events.aclose()
+            generation.finish()
+
+    def status(self, generation_id: str) -> Dict[str, Any]:
+        generation = self._generations.get(generation_id)
+        if generation is None:
+            raise GenerationNotFound(generation_id)
+        return {
+            "generation_id": generation_id,
+            "state": "finished" if generation.finished else "running",
+            "last_seq": generation.last_seq,
+            "readers": generation.readers,
+        }
+
+    def stream(
+        self, generation_id: str, from_seq: int = 0, reattach: bool = False, snapshot: bool = False
+    ) -> AsyncIterator[dict]:
+        """
+        Reads the generation's events from `from_seq` on; `snapshot` starts with the
+        text before `from_seq` (see `_Generation.read`). Raises GenerationNotFound.
+        """
+        generation = self._generations.get(generation_id)
+        if generation is None:
+            raise GenerationNotFound(generation_id)
+        if reattach:
+            self.reattached += 1
+        return self._read(generation, from_seq, snapshot)
+
+    async def _read(self, generation: _Generation, from_seq: int, snapshot: bool) -> AsyncIterator[dict]:
+        generation.readers += 1
+        try:
+            async for event in generation.read(from_seq, snapshot):
+                yield event
+        finally:
+            generation.readers -= 1
+            generation.idle_since = time.monotonic()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL_SECONDS)
+            now = time.monotonic()
+            for generation_id, generation in list(self._generations.items()):
+                if generation.readers:
+                    continue
+                idle = now - generation.idle_since
+                if generation.finished and idle > self.retention:
+                    del self._generations[generation_id]
+                elif not generation.finished and generation.orphaned:
+                    # `cancel` did not end it within a reap interval
+                    generation.task.cancel()
+                elif not generation.finished and idle > self.orphan_timeout:
+                    log.info("Cancelling generation %s: no client for %.0fs", generation_id, idle)
+                    self.orphans_cancelled += 1
+                    generation.orphaned = True
+                    generation.cancel()
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        for generation in self._generations.values():
+            if not generation.finished:
+                generation.cancel()
+                generation.task.cancel()
+        tasks = [generation.task for generation in self._generations.values() if generation.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        generations = list(self._generations.values())
+        return {
+            "running": sum(1 for generation in generations if not generation.finished),
+            "retained": sum(1 for generation in generations if generation.finished),
+            "detached": sum(1 for generation in generations if not generation.finished and not generation.readers),
+            "reattached": self.reattached,
+            "orphans_cancelled": self.orphans_cancelled,
+        }
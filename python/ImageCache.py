@@ -0,0 +1,111 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import torch
+
+ImageSource = Union[str, Path, bytes]
+
+
+def _tensor_bytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, dict):
+        return sum(_tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+class ImageCache:
+    """
+    LRU cache of preprocessed image tensors under a memory budget.
+
+    Entries are keyed by the SHA-256 of the image file content, so the same scan
+    is recognised no matter which path or upload it comes from. The path -> hash
+    mapping is memoised by path, mtime and size so unchanged files are not
+    re-read just to be hashed.
+    """
+
+    def __init__(self, max_bytes: int, max_hashes: int = 1024):
+        self.max_bytes = max_bytes
+        self.max_hashes = max_hashes
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self._hashes: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def content_key(self, image: ImageSource) -> str:
+        """Content hash of an image given as raw bytes, a file path or a series directory."""
+        if isinstance(image, bytes):
+            return hashlib.sha256(image).hexdigest()
+        if os.path.isdir(image):
+            # An image series: the hash of its files' hashes, in name order
+            members = sorted(entry.path for entry in os.scandir(image) if entry.is_file())
+            return hashlib.sha256("".join(self.content_key(path) for path in members).encode()).hexdigest()
+
+        stat = os.stat(image)
+        stat_key = (str(image), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._hashes.get(stat_key)
+            if digest is not None:
+                self._hashes.move_to_end(stat_key)
+                return digest
+
+        sha = hashlib.sha256()
+        with open(image, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._hashes[stat_key] = digest
+            while len(self._hashes) > self.max_hashes:
+                self._hashes.popitem(last=False)
+        return digest
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        size = _tensor_bytes(value)
+        with self._lock:
+            if key in self.entries:
+                self.bytes_held -= self.sizes.pop(key)
+                del self.entries[key]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.bytes_held += size
+            while self.bytes_held > self.max_bytes:
+                evicted, _ = self.entries.popitem(last=False)
+                self.bytes_held -= self.sizes.pop(evicted)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes_held = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
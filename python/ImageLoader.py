@@ -0,0 +1,289 @@
+"""
+Decodes attached images straight to the size the model takes them.
+
+Besides the formats PIL reads, this handles DICOM files (single and
+multi-frame), directories of DICOM files (a CT or MR series) and large TIFFs
+(multi-page stacks, pyramidal whole-slide images). Whatever the file size,
+what is held in memory is about one frame at the model's input size:
+
+- JPEGs are decoded at a reduced scale (PIL draft mode).
+- TIFFs are read from the smallest pyramid level that still covers the input
+  size. A level larger than that is decoded tile by tile (or, uncompressed,
+  read row by row), keeping only every n-th row and column.
+- DICOM frames are read one at a time from the file, not the whole pixel data.
+
+From a series or multi-frame image, SERIES_FRAMES evenly spaced frames are
+picked (the middle one by default); several are tiled into one grid image.
+Frames are decoded in parallel on a small thread pool.
+
+pydicom and tifffile are optional: without pydicom DICOM input is rejected,
+without tifffile TIFFs are read by PIL in full.
+"""
+
+import io
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from ImageCache import ImageSource
+from Log import get_logger
+
+try:
+    import pydicom
+    try:
+        from pydicom.pixels import apply_modality_lut, apply_voi_lut, pixel_array as read_dicom_frame
+    except ImportError:  # pydicom < 3 decodes all frames at once
+        from pydicom.pixel_data_handlers.util import apply_modality_lut, apply_voi_lut
+        read_dicom_frame = None
+except ImportError:
+    pydicom = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+log = get_logger(__name__)
+
+# Used when the processor does not say what size it resizes images to
+DEFAULT_INPUT_SIZE = (896, 896)  # (width, height), Gemma 3 vision input
+# Frames picked from a series or multi-frame image; more than one are tiled into a grid
+SERIES_FRAMES = int(os.environ.get("OPENMED_SERIES_FRAMES", "1"))
+DECODE_WORKERS = int(os.environ.get("OPENMED_IMAGE_DECODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+DICOM_MAGIC_OFFSET = 128
+DICOM_MAGIC = b"DICM"
+TIFF_MAGICS = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
+
+
+def pick_frames(count: int, wanted: int) -> List[int]:
+    """`wanted` evenly spaced frame indices out of `count`, centred (the middle frame for one)."""
+    wanted = max(1, min(wanted, count))
+    return [int((i + 0.5) * count / wanted) for i in range(wanted)]
+
+
+def _read_header(image: ImageSource) -> bytes:
+    if isinstance(image, bytes):
+        return image[:DICOM_MAGIC_OFFSET + len(DICOM_MAGIC)]
+    with open(image, "rb") as f:
+        return f.read(DICOM_MAGIC_OFFSET + len(DICOM_MAGIC))
+
+
+def image_format(image: ImageSource) -> str:
+    """"series" (a directory), "dicom", "tiff" or "pil", from the path and the file's first bytes."""
+    if not isinstance(image, bytes) and Path(image).is_dir():
+        return "series"
+    header = _read_header(image)
+    if header[DICOM_MAGIC_OFFSET:] == DICOM_MAGIC:
+        return "dicom"
+    if header[:4] in TIFF_MAGICS:
+        return "tiff"
+    return "pil"
+
+
+def _to_uint8(pixels: np.ndarray) -> np.ndarray:
+    if pixels.dtype == np.uint8:
+        return pixels
+    pixels = pixels.astype(np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    if high <= low:
+        return np.zeros(pixels.shape, dtype=np.uint8)
+    return ((pixels - low) * (255.0 / (high - low))).astype(np.uint8)
+
+
+class ImageLoader:
+    """
+    Loads an image source (path, directory or bytes) as an RGB image no smaller
+    than `input_size` on either side unless the source is, and not much larger;
+    the processor does the final resize. Thread-safe.
+    """
+
+    def __init__(
+        self,
+        input_size: Tuple[int, int] = DEFAULT_INPUT_SIZE,
+        frames: int = SERIES_FRAMES,
+        workers: int = DECODE_WORKERS,
+    ):
+        self.input_size = input_size
+        self.frames = max(1, frames)
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="image-decode")
+        self._lock = threading.Lock()
+        self._loaded: Dict[str, int] = {"series": 0, "dicom": 0, "tiff": 0, "pil": 0}
+        self.frames_decoded = 0
+        # Largest decoded array held in memory at once, to check it tracks the input size
+        self.peak_array_bytes = 0
+
+    def load(self, image: ImageSource) -> Image.Image:
+        kind = image_format(image)
+        if kind in ("series", "dicom") and pydicom is None:
+            raise ValueError("DICOM images need the optional pydicom package (pip install pydicom).")
+        if kind == "series":
+            frames = self._load_series(Path(image))
+        elif kind == "dicom":
+            frames = self._load_dicom(image)
+        elif kind == "tiff" and tifffile is not None:
+            frames = self._load_tiff(image)
+        else:
+            frames = self._load_pil(image)
+        with self._lock:
+            self._loaded[kind] += 1
+            self.frames_decoded += len(frames)
+        return frames[0] if len(frames) == 1 else self._tile(frames)
+
+    def _note(self, pixels: np.ndarray):
+        with self._lock:
+            self.peak_array_bytes = max(self.peak_array_bytes, pixels.nbytes)
+
+    def _cover_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        """The smallest size with the source's aspect that covers the input size on both sides (never larger than the source)."""
+        width, height = size
+        scale = min(1.0, max(self.input_size[0] / width, self.input_size[1] / height))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def _step(self, height: int, width: int) -> int:
+        """Row/column stride that keeps an array at least twice the input size, for a good final resize."""
+        return max(1, min(height // (2 * self.input_size[1]), width // (2 * self.input_size[0])))
+
+    def _fit(self, image: Image.Image) -> Image.Image:
+        image = image.convert("RGB")
+        size = self._cover_size(image.size)
+        if size == image.size:
+            return image
+        return image.resize(size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+
+    def _from_array(self, pixels: np.ndarray) -> Image.Image:
+        self._note(pixels)
+        pixels = _to_uint8(pixels)
+        if pixels.ndim == 3 and pixels.shape[-1] == 1:
+            pixels = pixels[..., 0]
+        elif pixels.ndim == 3 and pixels.shape[-1] > 3:
+            pixels = pixels[..., :3]
+        return self._fit(Image.fromarray(np.ascontiguousarray(pixels)))
+
+    def _tile(self, frames: List[Image.Image]) -> Image.Image:
+        columns = math.ceil(math.sqrt(len(frames)))
+        rows = math.ceil(len(frames) / columns)
+        cell_width, cell_height = self.input_size[0] // columns, self.input_size[1] // rows
+        grid = Image.new("RGB", (cell_width * columns, cell_height * rows))
+        for index, frame in enumerate(frames):
+            frame = frame.copy()
+            frame.thumbnail((cell_width, cell_height), Image.Resampling.BICUBIC)
+            x = (index % columns) * cell_width + (cell_width - frame.width) // 2
+            y = (index // columns) * cell_height + (cell_height - frame.height) // 2
+            grid.paste(frame, (x, y))
+        return grid
+
+    def _load_pil(self, image: ImageSource) -> List[Image.Image]:
+        with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as source:
+            frames = []
+            for index in pick_frames(getattr(source, "n_frames", 1), self.frames):
+                source.seek(index)
+                # JPEG only: decodes at 1/2, 1/4 or 1/8 scale while still covering the target
+                source.draft("RGB", self._cover_size(source.size))
+                frames.append(self._fit(source))
+            return frames
+
+    def _load_tiff(self, image: ImageSource) -> List[Image.Image]:
+        with tifffile.TiffFile(io.BytesIO(image) if isinstance(image, bytes) else image) as tif:
+            series = tif.series[0]
+            # Levels go from full resolution down; take the smallest that still covers the input size
+            level = series.levels[0]
+            for candidate in series.levels[1:]:
+                page = candidate.pages[0]
+                if page.imagewidth < self.input_size[0] or page.imagelength < self.input_size[1]:
+                    break
+                level = candidate
+            pages = [page for page in level.pages if page is not None]
+            return [self._tiff_page(pages[index]) for index in pick_frames(len(pages), self.frames)]
+
+    def _tiff_page(self, page) -> Image.Image:
+        step = self._step(page.imagelength, page.imagewidth)
+        if step == 1:
+            return self._from_array(page.asarray(maxworkers=self.workers))
+        height, width, samples = page.imagelength, page.imagewidth, page.samplesperpixel
+        pixels = np.zeros((-(-height // step), -(-width // step), samples), dtype=page.dtype)
+        if page.is_contiguous and page.planarconfig == 1:
+            # Uncompressed: only the kept rows are read from the file
+            dtype = page.dtype.newbyteorder(page.parent.byteorder)
+            row_bytes = width * samples * dtype.itemsize
+            handle = page.parent.filehandle
+            for row in range(pixels.shape[0]):
+                handle.seek(page.dataoffsets[0] + row * step * row_bytes)
+                pixels[row] = np.frombuffer(handle.read(row_bytes), dtype).reshape(width, samples)[::step]
+            return self._from_array(pixels)
+
+        # Tiles or strips are decoded a few at a time and subsampled as they come
+        separate = page.planarconfig == 2
+        for segment, index, _ in page.segments(maxworkers=self.workers):
+            if segment is None:
+                continue
+            plane, _, top, left, _ = index
+            first_row, first_column = -top % step, -left % step
+            part = segment[0, first_row::step, first_column::step]
+            row, column = (top + first_row) // step, (left + first_column) // step
+            part = part[:pixels.shape[0] - row, :pixels.shape[1] - column]
+            if separate:
+                pixels[row:row + part.shape[0], column:column + part.shape[1], plane] = part[..., 0]
+            else:
+                pixels[row:row + part.shape[0], column:column + part.shape[1]] = part
+        return self._from_array(pixels)
+
+    def _load_dicom(self, image: ImageSource) -> List[Image.Image]:
+        source = io.BytesIO(image) if isinstance(image, bytes) else image
+        # Pixel data is left on disk until a frame is read
+        dataset = pydicom.dcmread(source, defer_size="1 KB")
+        count = int(dataset.get("NumberOfFrames", 1) or 1)
+        indices = pick_frames(count, self.frames)
+        return list(self._pool.map(lambda index: self._dicom_frame(image, dataset, index, count), indices))
+
+    def _load_series(self, directory: Path) -> List[Image.Image]:
+        files = [path for path in sorted(directory.iterdir()) if path.is_file() and image_format(path) == "dicom"]
+        if not files:
+            raise ValueError(f"No DICOM files in {directory}.")
+        headers = list(self._pool.map(
+            lambda path: pydicom.dcmread(path, stop_before_pixels=True, specific_tags=["InstanceNumber"]), files
+        ))
+        order = sorted(range(len(files)), key=lambda i: (int(headers[i].get("InstanceNumber", 0) or 0), files[i].name))
+        picked = [files[order[index]] for index in pick_frames(len(files), self.frames)]
+
+        def decode(path: Path) -> Image.Image:
+            dataset = pydicom.dcmread(path, defer_size="1 KB")
+            return self._dicom_frame(path, dataset, 0, int(dataset.get("NumberOfFrames", 1) or 1))
+
+        return list(self._pool.map(decode, picked))
+
+    def _dicom_frame(self, image: ImageSource, dataset, index: int, count: int) -> Image.Image:
+        if read_dicom_frame is not None:
+            source = io.BytesIO(image) if isinstance(image, bytes) else image
+            pixels = read_dicom_frame(source, index=index)
+        else:
+            pixels = dataset.pixel_array
+            pixels = pixels[index] if count > 1 else pixels
+        self._note(pixels)
+        step = self._step(pixels.shape[0], pixels.shape[1])
+        pixels = pixels[::step, ::step]
+        if dataset.get("SamplesPerPixel", 1) == 1:
+            # Stored values to the display window the modality defines
+            pixels = apply_voi_lut(apply_modality_lut(pixels, dataset), dataset)
+            pixels = _to_uint8(pixels)
+            if dataset.get("PhotometricInterpretation") == "MONOCHROME1":
+                pixels = 255 - pixels
+        return self._from_array(pixels)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                **{f"loaded_{kind}": count for kind, count in self._loaded.items()},
+                "frames_decoded": self.frames_decoded,
+                "peak_array_bytes": self.peak_array_bytes,
+            }
@@ -1,81 +1,552 @@
 import torch
-from transformers import (
-    AutoProcessor,
-    AutoModelForImageTextToText,
-    BitsAndBytesConfig,
-    TextIteratorStreamer,
-    StoppingCriteria,
-    StoppingCriteriaList,
-)
+from transformers import BatchFeature
 from PIL import Image
-import io
+import os
+import shutil
+from pathlib import Path
 import threading
-import base64
 import json
 import asyncio
 import uuid
-from typing import List, Dict, Any
-import queue
+from typing import List, Dict, Any, Optional
+import time
 import traceback
+from ContextWindow import ContextWindow
+from ImageCache import ImageCache, ImageSource
+from ImageLoader import DEFAULT_INPUT_SIZE, ImageLoader
+from Log import get_logger
+from MemoryGovernor import MemoryExhausted, MemoryGovernor, OBSERVE_EVERY
+from Metrics import metrics
+from PrefixCache import PrefixCache
+from Profiles import EngineProfile, for_device, get_profile
+from ResponseCache import ResponseCache, response_key
+from Scheduler import BatchScheduler, GenerationRequest, TokenChannel
+from Speculative import DraftModelDrafter, PromptLookupDrafter
+from TemplateCache import ChatTemplateCache
+from Utils import text_checksum
+
+log = get_logger(__name__)
+
+# Budget for past key/values kept between turns of the same chat
+PREFIX_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB
+# Budget for preprocessed pixel values and vision encoder outputs
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512MB
+
+# Set OPENMED_CACHE_QUANTIZED=1 to save the quantized weights after the first load and
+# load them directly on later starts, skipping re-quantization
+CACHE_QUANTIZED_WEIGHTS = os.environ.get("OPENMED_CACHE_QUANTIZED", "") not in ("", "0")
+QUANTIZED_CACHE_DIR = Path(
+    os.environ.get("OPENMED_QUANTIZED_CACHE_DIR", Path.home() / ".cache" / "open-med-ai" / "quantized")
+)
+# Written last when saving; records what the cached weights were quantized from
+QUANTIZED_CACHE_MARKER = "openmed_quantization.json"
+# The dynamic-int8 export: the quantized state dict, which save_pretrained cannot store; the model is rebuilt around it
+DYNAMIC_INT8_EXPORT_FILE = "model_dynamic_int8_state.pt"
+# Submodules that make up the vision side; they can run at their own precision
+VISION_MODULES = ("vision_tower", "multi_modal_projector")
+
+# Speculative decoding for lone requests: "off", "ngram" (prompt lookup, suits answers
+# that quote attached files) or "draft" (a small model sharing the tokenizer, set by
+# OPENMED_DRAFT_MODEL; falls back to "ngram" when none is configured or it fails to load)
+SPECULATIVE_MODE = os.environ.get("OPENMED_SPECULATIVE", "off")
+DRAFT_MODEL_ID = os.environ.get("OPENMED_DRAFT_MODEL", "")
+
+# Set OPENMED_RESPONSE_CACHE=1 to answer repeated identical requests from a disk cache
+RESPONSE_CACHE_ENABLED = os.environ.get("OPENMED_RESPONSE_CACHE", "") not in ("", "0")
+RESPONSE_CACHE_PATH = Path(
+    os.environ.get("OPENMED_RESPONSE_CACHE_PATH", Path.home() / ".cache" / "open-med-ai" / "responses.sqlite3")
+)
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("OPENMED_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+# Cached answers are streamed back in pieces of this many characters
+REPLAY_CHUNK_CHARS = 64
+
+# A generation is stopped and reported as timed out when its first token (queueing and
+# prefill included) or any later token takes longer than this
+FIRST_TOKEN_TIMEOUT_SECONDS = float(os.environ.get("OPENMED_FIRST_TOKEN_TIMEOUT", "120"))
+INTER_TOKEN_TIMEOUT_SECONDS = float(os.environ.get("OPENMED_INTER_TOKEN_TIMEOUT", "30"))
+
+
+def apply_cpu_settings(profile: EngineProfile):
+    """Applies the profile's torch thread counts and CPU pinning to this process."""
+    if profile.cpu_threads:
+        torch.set_num_threads(profile.cpu_threads)
+    if profile.cpu_interop_threads:
+        try:
+            torch.set_num_interop_threads(profile.cpu_interop_threads)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process
+            log.warning("Could not set inter-op threads: %s", e)
+    if profile.cpu_affinity and hasattr(os, "sched_setaffinity"):
+        cpus = set()
+        for part in profile.cpu_affinity.split(","):
+            first, _, last = part.strip().partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+        os.sched_setaffinity(0, cpus)
 
 
+def vision_module_names(model) -> List[str]:
+    """Names of the outermost vision tower and projector modules in `model`."""
+    names = []
+    for name, _ in model.named_modules():
+        if name.split(".")[-1] in VISION_MODULES and not any(name.startswith(outer + ".") for outer in names):
+            names.append(name)
+    return names
 
-def get_next_token(streamer):
-    try:
-        return next(streamer)
-    except StopIteration:
-        return None
 
+def set_vision_dtype(model, dtype: torch.dtype):
+    for name in vision_module_names(model):
+        model.get_submodule(name).to(dtype)
 
-class CustomStoppingCriteria(StoppingCriteria):
-    def __init__(self, stop_event: threading.Event):
-        super().__init__()
-        self.stop_event = stop_event
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        return self.stop_event.is_set()
+def quantize_dynamic_int8(model):
+    """
+    Replaces every linear layer outside the vision modules (the language model
+    and the LM head) with a dynamically quantized int8 one. Weights are stored
+    in int8; activations are quantized on the fly, so the model stays float32
+    from the outside.
+    """
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    vision = vision_module_names(model)
+    layers = {
+        name: default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not any(name.startswith(prefix + ".") for prefix in vision)
+    }
+    return quantize_dynamic(model, layers, dtype=torch.qint8)
+
+
+def request_timings(request: GenerationRequest) -> Dict[str, Any]:
+    """Scheduler-side timings of a request, in seconds."""
+    timings = {
+        "prompt_tokens": request.prompt_tokens,
+        "cached_tokens": request.cached_tokens,
+        "generated_tokens": request.generated_tokens,
+    }
+    if request.submitted_at is not None and request.prefill_started_at is not None:
+        timings["queue_wait_s"] = request.prefill_started_at - request.submitted_at
+    if request.prefill_started_at is not None and request.prefill_finished_at is not None:
+        timings["prefill_s"] = request.prefill_finished_at - request.prefill_started_at
+    if request.first_token_at is not None and request.finished_at is not None and request.generated_tokens > 1:
+        decode_time = request.finished_at - request.first_token_at
+        if decode_time > 0:
+            timings["decode_tokens_per_s"] = (request.generated_tokens - 1) / decode_time
+    if request.draft_tokens:
+        timings["draft_tokens"] = request.draft_tokens
+        timings["accepted_draft_tokens"] = request.accepted_tokens
+        timings["acceptance_rate"] = request.accepted_tokens / request.draft_tokens
+    return timings
 
 
 class InferenceService:
-    def __init__(self):
-        self.model = None
-        self.processor = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+    def __init__(
+        self,
+        model=None,
+        processor=None,
+        max_batch_size: int = 8,
+        prefix_cache_max_bytes: int = PREFIX_CACHE_MAX_BYTES,
+        image_cache_max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+        cache_quantized: bool = CACHE_QUANTIZED_WEIGHTS,
+        speculative: str = SPECULATIVE_MODE,
+        draft_model=None,
+        response_cache_path: Optional[Path] = RESPONSE_CACHE_PATH if RESPONSE_CACHE_ENABLED else None,
+        profile: Optional[EngineProfile] = None,
+        first_token_timeout: float = FIRST_TOKEN_TIMEOUT_SECONDS,
+        inter_token_timeout: float = INTER_TOKEN_TIMEOUT_SECONDS,
+    ):
+        """
+        Pass `model` and `processor` to run with an already loaded (or stand-in) model;
+        otherwise the weights are loaded as the engine `profile` says (default: the
+        one named by OPENMED_PROFILE; without CUDA, bitsandbytes quantization becomes
+        dynamic-int8, see `for_device`). The profile's sampling settings, answer
+        length and context size apply either way. With `cache_quantized`, the
+        quantized weights are kept under QUANTIZED_CACHE_DIR between starts.
+        `speculative` picks the drafting mode (see SPECULATIVE_MODE); `draft_model`
+        is an already loaded draft model for the "draft" mode. With
+        `response_cache_path`, finished answers are cached on disk there.
+        `first_token_timeout` and `inter_token_timeout` are the streaming deadlines.
+        """
+        self.model = model
+        self.processor = processor
+        self.cache_quantized = cache_quantized
+        self.first_token_timeout = first_token_timeout
+        self.inter_token_timeout = inter_token_timeout
+        self.profile = profile if profile is not None else get_profile()
+        if self.model is None:
+            requested = self.profile
+            self.profile = for_device(requested, torch.cuda.is_available())
+            if self.profile is not requested:
+                log.warning(
+                    "CUDA is not available; profile '%s' loads with %s instead of %s quantization",
+                    self.profile.name, self.profile.quantization, requested.quantization,
+                )
+        if self.profile.device == "auto" and self.profile.quantization != "dynamic-int8":
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        else:
+            self.device = "cpu" if self.profile.device == "auto" else self.profile.device
+        apply_cpu_settings(self.profile)
         # Store cancellation events
         self.active_generations: Dict[str, threading.Event] = {}
-        self.load_model()
+        if self.model is None or self.processor is None:
+            self.load_model()
+        config = getattr(self.model, "config", None)
+        self.image_token_id = getattr(config, "image_token_id", getattr(config, "image_token_index", None))
+        self.prefix_cache = PrefixCache(prefix_cache_max_bytes, image_token_id=self.image_token_id)
+        self.image_cache = ImageCache(image_cache_max_bytes)
+        # Decodes DICOM, large TIFFs and series straight to the vision input size
+        self.image_loader = ImageLoader(self._image_input_size())
+        self.context_window = ContextWindow(self.processor.tokenizer, image_tokens=self._image_prompt_tokens())
+        self.template_cache = ChatTemplateCache(self.processor.tokenizer)
+        # Sizes answers (or defers requests) to the free memory; may empty the caches above to make room
+        self.memory = MemoryGovernor(self.model, self.device, reclaimers=[self.prefix_cache.clear, self.image_cache.clear])
+        self.response_cache = (
+            ResponseCache(response_cache_path, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS) if response_cache_path else None
+        )
+        # Part of every response cache key, so answers from another model or profile are never replayed
+        self.model_name = f"{getattr(config, '_name_or_path', None) or type(self.model).__name__}:{self.profile.name}"
+        self.scheduler = BatchScheduler(
+            self.model,
+            self.processor.tokenizer,
+            self.device,
+            max_batch_size=max_batch_size,
+            prefix_cache=self.prefix_cache,
+            image_cache=self.image_cache,
+            image_token_id=self.image_token_id,
+            drafter=self._create_drafter(speculative, draft_model),
+        )
 
     def load_model(self):
         """
-        Loads the Med Gemma model and processor.
+        Loads the model and processor with the profile's quantization, dtype and attention settings.
         """
-        # Configure 4-bit quantization for efficient model loading
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-            bnb_4bit_use_double_quant=True,
-        )
-        
-        # TODO: Replace "google/gemma-2b" with the actual Med Gemma model ID
-        model_id = "google/medgemma-1.5-4b-it" 
+        # Imported here so the server can start answering before transformers' model code is loaded
+        from transformers import AutoProcessor, AutoModelForImageTextToText, BitsAndBytesConfig
+
+        profile = self.profile
+        dtype = getattr(torch, profile.dtype)
+        load_kwargs = {"device_map": self.device}
+        if profile.attn_implementation:
+            load_kwargs["attn_implementation"] = profile.attn_implementation
+
+        model_id = profile.model_id
+        log.info("Loading %s with engine profile '%s'", model_id, profile.name)
+        if profile.quantization == "dynamic-int8":
+            self._load_dynamic_int8(load_kwargs)
+            self._compile_model()
+            return
+
+        quantization_config = None
+        # With its own precision, the vision side is kept out of bitsandbytes quantization
+        skip_modules = list(VISION_MODULES) + ["lm_head"] if profile.vision_dtype else None
+        if profile.quantization == "nf4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True,
+                llm_int8_skip_modules=skip_modules,
+            )
+        elif profile.quantization == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=skip_modules)
+
+        if quantization_config is None:
+            self.processor = AutoProcessor.from_pretrained(model_id)
+            self.model = AutoModelForImageTextToText.from_pretrained(model_id, torch_dtype=dtype, **load_kwargs)
+            self._set_vision_dtype()
+            self._compile_model()
+            return
+
+        cache_dir = QUANTIZED_CACHE_DIR / f"{model_id.replace('/', '--')}--{profile.quantization}"
+        settings = {"model_id": model_id, "quantization": quantization_config.to_dict()}
+
+        if self.cache_quantized and self._quantized_cache_matches(cache_dir, settings):
+            log.info("Loading pre-quantized weights from %s", cache_dir)
+            try:
+                self.processor = AutoProcessor.from_pretrained(cache_dir)
+                self.model = AutoModelForImageTextToText.from_pretrained(cache_dir, **load_kwargs)
+                self._set_vision_dtype()
+                self._compile_model()
+                return
+            except Exception as e:
+                log.warning("Could not load cached weights, quantizing %s again: %s", model_id, e)
 
         self.processor = AutoProcessor.from_pretrained(model_id)
         self.model = AutoModelForImageTextToText.from_pretrained(
             model_id,
             quantization_config=quantization_config,
-            device_map=self.device,
+            **load_kwargs,
         )
+        if self.cache_quantized:
+            self._save_quantized(cache_dir, settings)
+        self._set_vision_dtype()
+        self._compile_model()
+
+    def _load_dynamic_int8(self, load_kwargs: Dict[str, Any]):
+        """
+        CPU backend: float32 weights with the language model's linear layers
+        quantized to int8 (see `quantize_dynamic_int8`). Quantizing takes a while,
+        so the quantized state dict is exported to QUANTIZED_CACHE_DIR once; later
+        starts rebuild the model from its config and load the weights from there,
+        as long as the model, settings and library versions match.
+        """
+        import transformers
+        from transformers import AutoProcessor, AutoModelForImageTextToText
+
+        profile = self.profile
+        model_id = profile.model_id
+        cache_dir = QUANTIZED_CACHE_DIR / f"{model_id.replace('/', '--')}--dynamic-int8"
+        settings = {
+            "model_id": model_id,
+            "quantization": "dynamic-int8",
+            "vision_dtype": profile.vision_dtype,
+            "attn_implementation": profile.attn_implementation,
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "export": "state_dict",
+        }
+
+        if self._quantized_cache_matches(cache_dir, settings):
+            log.info("Loading dynamic int8 export from %s", cache_dir)
+            try:
+                self.processor = AutoProcessor.from_pretrained(cache_dir)
+                self.model = self._rebuild_dynamic_int8(cache_dir)
+                return
+            except Exception as e:
+                log.warning("Could not load the dynamic int8 export, quantizing %s again: %s", model_id, e)
+
+        self.processor = AutoProcessor.from_pretrained(model_id)
+        model = AutoModelForImageTextToText.from_pretrained(model_id, torch_dtype=torch.float32, **load_kwargs)
+        model.eval()
+        self.model = quantize_dynamic_int8(model)
+        self._set_vision_dtype()
+
+        def save_model(path: Path):
+            # Tensors only: loading them back never runs code from the cache dir
+            torch.save(self.model.state_dict(), path / DYNAMIC_INT8_EXPORT_FILE)
+            self.model.config.save_pretrained(path)
+
+        self._save_quantized(cache_dir, settings, save_model=save_model)
+
+    def _rebuild_dynamic_int8(self, cache_dir: Path):
+        """The dynamic int8 model, built from the exported config and quantized like the original, with its weights."""
+        from transformers import AutoConfig, AutoModelForImageTextToText
+        try:
+            from transformers.initialization import no_init_weights
+        except ImportError:  # transformers 4.x
+            from transformers.modeling_utils import no_init_weights
+
+        config = AutoConfig.from_pretrained(cache_dir)
+        kwargs = {"attn_implementation": self.profile.attn_implementation} if self.profile.attn_implementation else {}
+        # The weights are overwritten below, so they are not initialised
+        with no_init_weights():
+            model = AutoModelForImageTextToText.from_config(config, **kwargs)
+        model.eval()
+        model = quantize_dynamic_int8(model)
+        if self.profile.vision_dtype:
+            set_vision_dtype(model, getattr(torch, self.profile.vision_dtype))
+        model.load_state_dict(torch.load(cache_dir / DYNAMIC_INT8_EXPORT_FILE, weights_only=True))
+        return model
+
+    def _set_vision_dtype(self):
+        if self.profile.vision_dtype:
+            set_vision_dtype(self.model, getattr(torch, self.profile.vision_dtype))
+
+    def _compile_model(self):
+        if not self.profile.compile:
+            return
+        # dynamic=True: batch size and sequence length change every step
+        self.model.forward = torch.compile(self.model.forward, dynamic=True)
+
+    def _create_drafter(self, mode: str, draft_model=None):
+        if mode in ("", "off", "0"):
+            return None
+        if mode == "draft":
+            if draft_model is None and DRAFT_MODEL_ID:
+                try:
+                    from transformers import AutoModelForCausalLM
 
-    async def generate(self, messages: List[Dict[str, str]], image_base64: str = None, generation_id: str = None):
+                    dtype = torch.bfloat16 if self.device == "cuda" else torch.float32
+                    draft_model = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_ID, torch_dtype=dtype, device_map=self.device)
+                    draft_model.eval()
+                except Exception as e:
+                    log.warning("Could not load draft model %s, using prompt lookup instead: %s", DRAFT_MODEL_ID, e)
+            if draft_model is not None:
+                log.info("Speculative decoding: draft model")
+                return DraftModelDrafter(draft_model)
+            log.info("Speculative decoding: no draft model configured, using prompt lookup")
+            return PromptLookupDrafter()
+        if mode != "ngram":
+            log.warning("Unknown speculative mode '%s', speculative decoding is off", mode)
+            return None
+        log.info("Speculative decoding: prompt lookup")
+        return PromptLookupDrafter()
+
+    def _quantized_cache_matches(self, cache_dir: Path, settings: Dict[str, Any]) -> bool:
+        try:
+            saved = json.loads((cache_dir / QUANTIZED_CACHE_MARKER).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        return saved == json.loads(json.dumps(settings, default=str))
+
+    def _save_quantized(self, cache_dir: Path, settings: Dict[str, Any], save_model=None):
+        """
+        Saves the quantized model to a staging dir of this process next to the cache
+        dir, then renames it into place, so a crash never leaves a partial cache.
+        Workers that quantize at the same time each stage their own copy; the first
+        one renamed into place wins and the others discard theirs.
+        """
+        staging = cache_dir.with_name(f"{cache_dir.name}.partial-{os.getpid()}")
+        try:
+            shutil.rmtree(staging, ignore_errors=True)
+            if save_model is not None:
+                staging.mkdir(parents=True)
+                save_model(staging)
+            else:
+                self.model.save_pretrained(staging)
+            self.processor.save_pretrained(staging)
+            (staging / QUANTIZED_CACHE_MARKER).write_text(json.dumps(settings, default=str), encoding="utf-8")
+            try:
+                if self._quantized_cache_matches(cache_dir, settings):
+                    raise FileExistsError(cache_dir)
+                if cache_dir.exists():
+                    # An outdated cache; moved aside first, since a directory cannot be renamed over a non-empty one
+                    stale = cache_dir.with_name(f"{cache_dir.name}.stale-{os.getpid()}")
+                    cache_dir.rename(stale)
+                    shutil.rmtree(stale, ignore_errors=True)
+                staging.rename(cache_dir)
+            except OSError:
+                if not self._quantized_cache_matches(cache_dir, settings):
+                    raise
+                shutil.rmtree(staging, ignore_errors=True)
+                log.info("Quantized weights were already saved to %s by another process", cache_dir)
+                return
+            log.info("Saved quantized weights to %s", cache_dir)
+        except Exception as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            log.warning("Could not save quantized weights: %s", e)
+
+    def _image_prompt_tokens(self) -> int:
+        """Tokens an image adds to the prompt once the processor expands its placeholder."""
+        full_image_sequence = getattr(self.processor, "full_image_sequence", None)
+        if full_image_sequence:
+            return len(self.processor.tokenizer.encode(full_image_sequence, add_special_tokens=False))
+        return getattr(self.processor, "image_seq_length", 256)
+
+    def _image_input_size(self) -> tuple:
+        """`(width, height)` the image processor resizes images to."""
+        size = getattr(getattr(self.processor, "image_processor", None), "size", None) or {}
+        if "width" in size and "height" in size:
+            return size["width"], size["height"]
+        if "shortest_edge" in size:
+            return size["shortest_edge"], size["shortest_edge"]
+        return DEFAULT_INPUT_SIZE
+
+    def _decode_image(self, image: ImageSource) -> Image.Image:
+        return self.image_loader.load(image)
+
+    def _pixel_inputs(self, image: ImageSource, image_key: str) -> Dict[str, Any]:
+        """Decodes and preprocesses the image, or returns the cached pixel values for its content."""
+        cache_key = "pixels:" + image_key
+        pixel_inputs = self.image_cache.get(cache_key)
+        if pixel_inputs is None:
+            pixel_inputs = dict(self.processor.image_processor(self._decode_image(image), return_tensors="pt"))
+            self.image_cache.put(cache_key, pixel_inputs)
+        return pixel_inputs
+
+    def prefetch_image(self, image: ImageSource):
+        """
+        Hashes, decodes and preprocesses an image into the image cache ahead of the
+        `generate` call that uses it. Blocking; meant for a worker thread.
+        """
+        image_key = self.image_cache.content_key(image)
+        # Only the Gemma-style placeholder path in _prepare_inputs reads cached pixel values
+        if self._image_placeholder() is not None:
+            self._pixel_inputs(image, image_key)
+
+    def _image_placeholder(self) -> Optional[tuple]:
+        """`(placeholder, expansion)` of the processor's image token layout, or None when it is not known."""
+        full_image_sequence = getattr(self.processor, "full_image_sequence", None)
+        boi_token = getattr(self.processor, "boi_token", None)
+        if full_image_sequence is None or boi_token is None or self.image_token_id is None:
+            return None
+        return boi_token, full_image_sequence
+
+    def _prepare_inputs(
+        self, chat_template: str, image: ImageSource = None, image_key: str = None, segments: Optional[list] = None
+    ) -> BatchFeature:
+        """
+        Tokenizes the prompt and attaches image inputs. With `segments` from the
+        template cache, token ids come from the cache instead. Runs off the event loop.
+        """
+        placeholder = self._image_placeholder() if image is not None else None
+        if image is not None and placeholder is None:
+            # Processors without a known placeholder layout need the whole image for every call
+            return self.processor(text=chat_template, images=self._decode_image(image), return_tensors="pt").to(self.device)
+
+        if segments is not None:
+            input_ids = torch.tensor([self.template_cache.encode(segments, placeholder)], dtype=torch.long)
+            text_inputs = BatchFeature({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+        elif image is None:
+            return self.processor(text=chat_template, return_tensors="pt").to(self.device)
+        else:
+            # Expand the image placeholder the way the Gemma 3 processor does, so cached
+            # pixel values can be reused without running the image processor again.
+            text_inputs = self.processor.tokenizer(chat_template.replace(*placeholder), return_tensors="pt")
+        if image is None:
+            return text_inputs.to(self.device)
+        text_inputs["token_type_ids"] = (text_inputs["input_ids"] == self.image_token_id).long()
+        return BatchFeature({**text_inputs, **self._pixel_inputs(image, image_key)}).to(self.device)
+
+    async def generate(
+        self,
+        messages: List[Dict[str, str]],
+        image: ImageSource = None,
+        generation_id: str = None,
+        chat_id=None,
+        max_new_tokens: Optional[int] = None,
+        seed: Optional[int] = None,
+        cache: str = "auto",
+        do_sample: Optional[bool] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+    ):
+        """
+        Streams the answer as event dicts: a `start` event carrying the
+        `generation_id` (usable with `cancel_generation` right away), one `delta`
+        event per new text fragment (numbered by `seq`), then a `complete` event
+        carrying the full text and its checksum, or an `error` event. Closing the
+        stream early stops the generation at the next token.
+
+        `image` is a file path or raw bytes; its preprocessed pixels and vision
+        encoder outputs are cached by content. Passing `chat_id` lets consecutive
+        turns of a chat reuse the cached prompt prefix. `max_new_tokens`,
+        `do_sample`, `temperature` and `top_p` override the engine profile's
+        defaults for this request. Histories longer than the profile's
+        `max_prompt_tokens` lose old attachments and turns first (see
+        ContextWindow); `stats["context"]` in the complete event lists what was
+        left out. When memory is short the answer length is clamped or the
+        request waits (see MemoryGovernor); `stats["memory"]` reports the grant
+        and the memory high-water mark. A `seed` makes sampling reproducible.
+        With the response cache enabled, `cache` (see ResponseCache.CACHE_MODES)
+        decides whether the answer may come from it and be stored in it; cached
+        answers are replayed as the same events.
+        """
         if generation_id is None:
             generation_id = str(uuid.uuid4())
 
         stop_event = threading.Event()
         self.active_generations[generation_id] = stop_event
-        
+        started_at = time.perf_counter()
+        # Per-request timings, aggregated into the process metrics when the stream ends
+        trace = {"generation_id": generation_id, "chat_id": chat_id, "status": "aborted", "has_image": image is not None}
+        request = None
+        grant = None
+        failure = None
+
         try:
-            if image_base64:
+            yield {"type": "start", "generation_id": generation_id}
+
+            if image is not None:
 
                 # Ensure <image> token is present in the prompt for Gemma 3 models
                 for i in range(len(messages) - 1, -1, -1):
@@ -88,63 +559,202 @@ class InferenceService:
                             has_image = any(item.get("type") == "image" for item in content)
                             if not has_image:
                                 messages[i]["content"].insert(0, {"type": "image"})
-                        print(messages)
+                        log.debug("Attached the image to message %d of %d", i, len(messages))
                         break
 
-            chat_template = self.processor.tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
-            if image_base64:
-                image_bytes = base64.b64decode(image_base64)
-                image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-                inputs = self.processor(text=chat_template, images=image, return_tensors="pt").to(self.device)
-            else:
-                inputs = self.processor(text=chat_template, return_tensors="pt").to(self.device)
-
-            streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, timeout=120.0)
-            stopping_criteria = StoppingCriteriaList([CustomStoppingCriteria(stop_event)])
-
-            generation_kwargs = dict(
-                **inputs,
-                streamer=streamer,
-                stopping_criteria=stopping_criteria,
-                max_new_tokens=2000,
-                do_sample=True,
-                top_p=0.9,
-                temperature=0.6,
+            image_key = None
+            if image is not None:
+                image_key = await asyncio.to_thread(self.image_cache.content_key, image)
+
+            profile = self.profile
+            sampling = {
+                "max_new_tokens": max_new_tokens if max_new_tokens is not None else profile.max_new_tokens,
+                "do_sample": do_sample if do_sample is not None else profile.do_sample,
+                "temperature": temperature if temperature is not None else profile.temperature,
+                "top_p": top_p if top_p is not None else profile.top_p,
+                "seed": seed,
+            }
+            cache_key = None
+            reproducible = not sampling["do_sample"] or seed is not None
+            if self.response_cache is not None and (cache == "allow" or (cache == "auto" and reproducible)):
+                cache_key = response_key(self.model_name, messages, image_key, sampling)
+                cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+                trace["response_cache"] = "miss" if cached is None else "hit"
+                if cached is not None:
+                    async for event in self._replay(cached, generation_id, trace, started_at):
+                        yield event
+                    return
+
+            # Long chats are cut to the profile's prompt budget, which bounds prefill time
+            prompt_budget = min(profile.max_prompt_tokens, profile.max_context - 1)
+            window = await asyncio.to_thread(self.context_window.fit, messages, prompt_budget, chat_id)
+            inputs = await self._tokenize_prompt(window.messages, image, image_key, trace)
+            prompt_len = inputs["input_ids"].shape[1]
+            if prompt_len > prompt_budget:
+                # The per-message estimate fell short; cut again by the measured difference
+                corrected_budget = window.tokens - (prompt_len - prompt_budget)
+                corrected = await asyncio.to_thread(self.context_window.fit, messages, corrected_budget, chat_id)
+                if corrected.tokens < window.tokens:
+                    window = corrected
+                    window.budget = prompt_budget
+                    inputs = await self._tokenize_prompt(window.messages, image, image_key, trace)
+                    prompt_len = inputs["input_ids"].shape[1]
+            trace["context_trimmed"] = window.trimmed
+
+            if prompt_len >= profile.max_context:
+                trace["status"] = "too_long"
+                yield {
+                    "type": "error",
+                    "message": f"The prompt is {prompt_len} tokens; the '{profile.name}' profile allows {profile.max_context}.",
+                    "generation_id": generation_id,
+                }
+                return
+            sampling["max_new_tokens"] = min(sampling["max_new_tokens"], profile.max_context - prompt_len)
+            try:
+                grant = await self.memory.admit(generation_id, prompt_len, sampling["max_new_tokens"])
+            except MemoryExhausted as e:
+                trace["status"] = "memory"
+                yield {"type": "error", "message": str(e), "generation_id": generation_id}
+                return
+            sampling["max_new_tokens"] = grant.max_new_tokens
+
+            request = GenerationRequest(
+                generation_id,
+                inputs,
+                stop_event,
+                cache_key=chat_id,
+                image_key=image_key,
+                output=TokenChannel(asyncio.get_running_loop()),
+                **sampling,
             )
-            thread = threading.Thread(target=self.model.generate, kwargs=generation_kwargs)
-            thread.start()
+            grant.request = request
+            self.scheduler.submit(request)
 
             generated_text = ""
-            print("InferenceService: Starting to iterate streamer...") # DEBUG PRINT
+            seq = 0
+            log.debug("Generation %s submitted: %d prompt tokens", generation_id, prompt_len)
             try:
                 while True:
-                    new_text = await asyncio.to_thread(get_next_token, streamer)
+                    timeout = self.first_token_timeout if seq == 0 else self.inter_token_timeout
+                    new_text = await asyncio.wait_for(request.output.get(), timeout)
                     if new_text is None:
                         break
-                    
-                    #print(f"InferenceService: Streamer yielded: '{new_text}'") # DEBUG PRINT
+                    if isinstance(new_text, Exception):
+                        raise new_text
+
                     generated_text += new_text
-                    yield json.dumps({"type": "update", "text": generated_text, "generation_id": generation_id})
+                    seq += 1
+                    if seq == 1:
+                        trace["ttft_s"] = time.perf_counter() - started_at
+                    if seq % OBSERVE_EVERY == 1:
+                        self.memory.observe()
+                    yield {"type": "delta", "seq": seq, "text": new_text, "generation_id": generation_id}
 
                     if stop_event.is_set():
                         break
-            except queue.Empty:
-                yield json.dumps({"type": "error", "message": "Generation timed out.", "generation_id": generation_id})
+            except asyncio.TimeoutError:
+                stop_event.set()
+                trace["status"] = "timeout"
+                waited_for = "the first token" if seq == 0 else "the next token"
+                yield {"type": "error", "message": f"Generation timed out waiting for {waited_for}.", "generation_id": generation_id}
                 return
+
+            log.debug("Generation %s finished: %d tokens", generation_id, request.generated_tokens)
             
-            print("InferenceService: Finished iterating streamer.") # DEBUG PRINT
-            
-            yield json.dumps({"type": "complete", "text": generated_text, "generation_id": generation_id})
+            trace["status"] = "cancelled" if stop_event.is_set() else "complete"
+            self.memory.observe()
+            stats = {
+                "prompt_tokens": request.prompt_tokens,
+                "cached_tokens": request.cached_tokens,
+                "generated_tokens": request.generated_tokens,
+                "draft_tokens": request.draft_tokens,
+                "accepted_draft_tokens": request.accepted_tokens,
+                "acceptance_rate": request.accepted_tokens / request.draft_tokens if request.draft_tokens else None,
+                "context": {**window.to_dict(), "prompt_tokens": prompt_len},
+                "memory": grant.to_dict(),
+            }
+            # A clamped answer may be cut short of what the cache key's max_new_tokens asks for
+            if cache_key is not None and trace["status"] == "complete" and not grant.clamped:
+                await asyncio.to_thread(self.response_cache.put, cache_key, generated_text, stats)
+            yield {
+                "type": "complete",
+                "seq": seq + 1,
+                "text": generated_text,
+                "checksum": text_checksum(generated_text),
+                "stats": stats,
+                "generation_id": generation_id,
+            }
 
         except Exception as e:
+            trace["status"] = "error"
+            failure = e
+            log.exception("Generation %s failed: %s", generation_id, e)
             error_msg = f"{str(e)}\n{traceback.format_exc()}"
-            yield json.dumps({"type": "error", "message": error_msg, "generation_id": generation_id})
+            yield {"type": "error", "message": error_msg, "generation_id": generation_id}
         finally:
             stop_event.set()
             if generation_id in self.active_generations:
                 del self.active_generations[generation_id]
+            trace["total_s"] = time.perf_counter() - started_at
+            if request is not None:
+                trace.update(request_timings(request))
+            if grant is not None:
+                self.memory.release(generation_id, trace["status"], failure)
+                trace["memory_peak_bytes"] = grant.peak_bytes
+                trace["memory_clamped"] = grant.clamped
+            metrics.record_trace(trace)
+
+    async def _tokenize_prompt(
+        self, messages: List[Dict[str, Any]], image: ImageSource, image_key: Optional[str], trace: Dict[str, Any]
+    ) -> BatchFeature:
+        phase_started = time.perf_counter()
+        chat_template, segments = await asyncio.to_thread(self._render_prompt, messages, image)
+        trace["template_s"] = trace.get("template_s", 0.0) + time.perf_counter() - phase_started
+
+        phase_started = time.perf_counter()
+        inputs = await asyncio.to_thread(self._prepare_inputs, chat_template, image, image_key, segments)
+        trace["tokenize_s"] = trace.get("tokenize_s", 0.0) + time.perf_counter() - phase_started
+        return inputs
+
+    def _render_prompt(self, messages: List[Dict[str, Any]], image: ImageSource):
+        """The prompt as per-message segments, or as one rendered string when the template cache cannot be used."""
+        # Only new turns are rendered; earlier ones come from the template cache
+        segments = self.template_cache.render(messages)
+        if segments is not None and (image is None or self._image_placeholder() is not None):
+            return None, segments
+        return self.processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True), None
+
+    async def _replay(self, cached: Dict[str, Any], generation_id: str, trace: Dict[str, Any], started_at: float):
+        """Streams a cached answer as delta events followed by its complete event."""
+        text = cached["text"]
+        seq = 0
+        for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+            seq += 1
+            if seq == 1:
+                trace["ttft_s"] = time.perf_counter() - started_at
+            yield {"type": "delta", "seq": seq, "text": text[start:start + REPLAY_CHUNK_CHARS], "generation_id": generation_id}
+        trace["status"] = "cached"
+        yield {
+            "type": "complete",
+            "seq": seq + 1,
+            "text": text,
+            "checksum": text_checksum(text),
+            "stats": {**cached["stats"], "cached_response": True},
+            "generation_id": generation_id,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "prefix_cache": self.prefix_cache.stats(),
+            "image_cache": self.image_cache.stats(),
+            "memory": self.memory.stats(),
+            "image_loader": self.image_loader.stats(),
+            "context_window": self.context_window.stats(),
+            "template_cache": self.template_cache.stats(),
+            "speculative": self.scheduler.speculative_stats(),
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else None,
+            "profile": self.profile.to_dict(),
+        }
 
     def cancel_generation(self, generation_id: str):
         if generation_id in self.active_generations:
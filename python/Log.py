@@ -0,0 +1,161 @@
+"""
+Logging for the server modules: level-gated, non-blocking and correlated by request.
+
+    from Log import get_logger, preview
+    log = get_logger(__name__)
+    log.info("Appended %d files", count)            # formatted only if INFO is enabled
+    log.debug("History: %s", preview(messages))     # at most PREVIEW_CHARS characters
+
+Records go through a bounded in-memory queue to a background thread that does
+the writing, so a slow terminal or pipe never stalls a request; when the queue
+is full, records are dropped and counted rather than waited on. Each line
+carries the id of the request it was logged for (see `set_request_id`).
+
+Levels come from OPENMED_LOG_LEVEL (default INFO) and per module from
+OPENMED_LOG_LEVELS, e.g. "Inference=DEBUG,Utils=WARNING". Message and file
+contents are patient data: log sizes and ids at INFO and above, and contents
+only as `preview`s at DEBUG.
+"""
+
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from typing import Any, Dict, Optional
+
+LOGGER_PREFIX = "openmed"
+LOG_LEVEL = os.environ.get("OPENMED_LOG_LEVEL", "INFO").upper()
+# "module=LEVEL,module=LEVEL"
+MODULE_LOG_LEVELS = os.environ.get("OPENMED_LOG_LEVELS", "")
+# Longest text a preview shows
+PREVIEW_CHARS = int(os.environ.get("OPENMED_LOG_PREVIEW_CHARS", "200"))
+# Records waiting for the writer thread; more are dropped
+LOG_QUEUE_SIZE = 10000
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+_lock = threading.Lock()
+_handler: Optional["_DroppingQueueHandler"] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def set_request_id(request_id: Optional[str]) -> contextvars.Token:
+    """Tags everything logged in the current context (and tasks or threads started from it) with `request_id`."""
+    return _request_id.set(request_id or "-")
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+class preview:
+    """
+    Lazy, size-limited rendering of a value for a log argument. Nothing is
+    converted unless the record is emitted, and then at most `limit` characters.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value: Any, limit: int = PREVIEW_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} chars)"
+
+    __repr__ = __str__
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without ever blocking the caller."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _module_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure(level: str = LOG_LEVEL, module_levels: str = MODULE_LOG_LEVELS, stream=None):
+    """
+    Sets up the queue handler and writer thread (once) and applies the levels.
+    Called by `get_logger`; call it directly to change levels or the output stream.
+    """
+    global _handler, _listener
+    with _lock:
+        root = logging.getLogger(LOGGER_PREFIX)
+        root.setLevel(level)
+        root.propagate = False
+        for name, module_level in _module_levels(module_levels).items():
+            logging.getLogger(f"{LOGGER_PREFIX}.{name}").setLevel(module_level)
+
+        if _listener is not None and stream is None:
+            return
+        if _listener is not None:
+            _listener.stop()
+            root.removeHandler(_handler)
+        writer = logging.StreamHandler(stream or sys.stderr)
+        writer.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _handler = _DroppingQueueHandler(log_queue)
+        _handler.addFilter(_RequestIdFilter())
+        root.addHandler(_handler)
+        _listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+        _listener.start()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for a module; `name` is usually `__name__`."""
+    if _listener is None:
+        configure()
+    return logging.getLogger(f"{LOGGER_PREFIX}.{name.rsplit('.', 1)[-1]}")
+
+
+def flush():
+    """Waits until every queued record is written (the writer thread keeps running)."""
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener.start()
+
+
+def stats() -> Dict[str, int]:
+    return {
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        "dropped": _handler.dropped if _handler is not None else 0,
+    }
+
+
+@atexit.register
+def _stop():
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
@@ -0,0 +1,329 @@
+"""
+Keeps the model process from running out of memory.
+
+Before a generation starts, its footprint is estimated from token counts: the
+KV cache of prompt plus answer (layers x KV heads x head size x dtype, from the
+model config) and the prefill activations. That is checked against the
+headroom: free device memory on GPU, available system memory on CPU (within
+the container's limit), minus what running generations will still grow by and
+a reserve. A request that does not fit gets the prefix and image caches
+reclaimed, then its answer length clamped, and otherwise waits for running
+generations to finish.
+
+After a failed, timed-out or cancelled generation, memory is reclaimed
+(garbage collection and the CUDA allocator cache, in a worker thread; after an
+out-of-memory error also the caches). Each request's memory high-water mark is recorded.
+"""
+
+import asyncio
+import gc
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from Log import get_logger
+
+log = get_logger(__name__)
+
+MB = 1024 * 1024
+# Kept free for what the estimates do not cover (batch re-packing, sampling, fragmentation)
+MEMORY_RESERVE_BYTES = int(os.environ.get("OPENMED_MEMORY_RESERVE_MB", "1024")) * MB
+# Answers are not clamped below this; a request that cannot get it waits instead
+MIN_NEW_TOKENS = 128
+# How long a request waits for memory before it is refused
+DEFER_TIMEOUT_SECONDS = float(os.environ.get("OPENMED_MEMORY_DEFER_SECONDS", "60"))
+# The high-water mark is sampled once every this many streamed fragments
+OBSERVE_EVERY = 32
+
+CGROUP_LIMIT_FILE = "/sys/fs/cgroup/memory.max"
+CGROUP_USAGE_FILE = "/sys/fs/cgroup/memory.current"
+
+
+class MemoryExhausted(Exception):
+    """Not enough memory for the request, even after waiting for others to finish."""
+
+
+def _model_config(model):
+    config = getattr(model, "config", None)
+    # Multimodal configs keep the language model's dimensions in text_config
+    return getattr(config, "text_config", None) or config
+
+
+def _kv_dtype_bytes(model) -> int:
+    dtype = getattr(model, "dtype", None)
+    if not isinstance(dtype, torch.dtype) or not dtype.is_floating_point:
+        # Quantized weights; the cache is kept in the compute dtype
+        dtype = next((p.dtype for p in model.parameters() if p.dtype.is_floating_point), torch.float32)
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def kv_bytes_per_token(model) -> Optional[int]:
+    """Key/value cache bytes one token takes across all layers, or None when the config does not say."""
+    config = _model_config(model)
+    layers = getattr(config, "num_hidden_layers", None)
+    heads = getattr(config, "num_attention_heads", None)
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    hidden = getattr(config, "hidden_size", None)
+    head_dim = getattr(config, "head_dim", None) or (hidden // heads if hidden and heads else None)
+    if not (layers and kv_heads and head_dim):
+        return None
+    return 2 * layers * kv_heads * head_dim * _kv_dtype_bytes(model)
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path, encoding="ascii") as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def system_available_bytes() -> Optional[int]:
+    """Memory the process can still take: MemAvailable, capped by the cgroup (container) limit."""
+    available = None
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        try:
+            import psutil
+            available = psutil.virtual_memory().available
+        except ImportError:
+            return None
+    limit, usage = _read_int(CGROUP_LIMIT_FILE), _read_int(CGROUP_USAGE_FILE)
+    if available is not None and limit is not None and usage is not None:
+        available = min(available, limit - usage)
+    return available
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            return None
+
+
+class MemoryGrant:
+    """Memory set aside for one generation."""
+
+    def __init__(self, prompt_tokens: int, requested_new_tokens: int, max_new_tokens: int, estimated_bytes: int, deferred_s: float):
+        self.prompt_tokens = prompt_tokens
+        self.requested_new_tokens = requested_new_tokens
+        self.max_new_tokens = max_new_tokens
+        self.estimated_bytes = estimated_bytes
+        self.deferred_s = deferred_s
+        self.peak_bytes = 0
+        # The scheduler request, once submitted; its progress shows how much is already allocated
+        self.request = None
+
+    @property
+    def clamped(self) -> bool:
+        return self.max_new_tokens < self.requested_new_tokens
+
+    def owed(self, kv_per_token: int) -> int:
+        """Bytes the generation may still allocate."""
+        request = self.request
+        if request is None or request.prefill_finished_at is None:
+            return self.estimated_bytes
+        used = kv_per_token * (self.prompt_tokens + request.generated_tokens)
+        return max(0, kv_per_token * (self.prompt_tokens + self.max_new_tokens) - used)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "estimated_bytes": self.estimated_bytes,
+            "requested_new_tokens": self.requested_new_tokens,
+            "max_new_tokens": self.max_new_tokens,
+            "clamped": self.clamped,
+            "deferred_s": self.deferred_s,
+            "peak_bytes": self.peak_bytes,
+        }
+
+
+class MemoryGovernor:
+    """
+    Admits generations by estimated memory need; see the module docstring.
+    `reclaimers` free evictable caches (e.g. `PrefixCache.clear`). All methods
+    but `observe` run on the event loop.
+    """
+
+    def __init__(
+        self,
+        model,
+        device: str,
+        reclaimers: Optional[List[Callable[[], Any]]] = None,
+        reserve_bytes: int = MEMORY_RESERVE_BYTES,
+        min_new_tokens: int = MIN_NEW_TOKENS,
+        defer_timeout: float = DEFER_TIMEOUT_SECONDS,
+    ):
+        self.device = device
+        self.cuda = str(device).startswith("cuda") and torch.cuda.is_available()
+        self.reclaimers = reclaimers or []
+        self.reserve_bytes = reserve_bytes
+        self.min_new_tokens = min_new_tokens
+        self.defer_timeout = defer_timeout
+        self.kv_per_token = kv_bytes_per_token(model)
+        config = _model_config(model)
+        dtype_bytes = _kv_dtype_bytes(model)
+        hidden = getattr(config, "hidden_size", 0) or 0
+        intermediate = getattr(config, "intermediate_size", 0) or 0
+        # Rough per-token prefill activations: residual stream, attention projections, MLP
+        self.activation_per_token = (4 * hidden + 2 * intermediate) * dtype_bytes
+        # Eager attention materialises a prompt x prompt score matrix per head (one layer at a time)
+        eager = getattr(config, "_attn_implementation", None) == "eager"
+        self.score_bytes = (getattr(config, "num_attention_heads", 0) or 0) * 4 if eager else 0
+        if self.kv_per_token is None:
+            log.warning("Model config has no KV cache dimensions; memory-based admission is off")
+        self.grants: Dict[str, MemoryGrant] = {}
+        self.deferred = 0
+        self.clamped = 0
+        self.rejected = 0
+        self.reclaims = 0
+        self.peak_bytes = 0
+        self._changed = asyncio.Event()
+        # The running garbage collection; one runs at a time
+        self._collecting: Optional[asyncio.Future] = None
+
+    def estimate(self, prompt_tokens: int, new_tokens: int) -> int:
+        """Bytes a generation needs at most: its KV cache plus the prefill activations."""
+        prefill = self.activation_per_token * prompt_tokens + self.score_bytes * prompt_tokens * prompt_tokens
+        return self.kv_per_token * (prompt_tokens + new_tokens) + prefill
+
+    def available(self) -> Optional[int]:
+        if self.cuda:
+            free, _ = torch.cuda.mem_get_info(self.device)
+            # Blocks PyTorch holds but does not use are free to it too
+            return free + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return system_available_bytes()
+
+    def headroom(self) -> Optional[int]:
+        available = self.available()
+        if available is None or self.kv_per_token is None:
+            return None
+        owed = sum(grant.owed(self.kv_per_token) for grant in self.grants.values())
+        return available - owed - self.reserve_bytes
+
+    def _fit(self, prompt_tokens: int, max_new_tokens: int, headroom: Optional[int]) -> Optional[int]:
+        """The answer length that fits in `headroom`, or None when not even the minimum does."""
+        if headroom is None or self.estimate(prompt_tokens, max_new_tokens) <= headroom:
+            return max_new_tokens
+        fitting = (headroom - self.estimate(prompt_tokens, 0)) // self.kv_per_token
+        if fitting >= min(self.min_new_tokens, max_new_tokens):
+            return int(fitting)
+        return None
+
+    async def admit(self, generation_id: str, prompt_tokens: int, max_new_tokens: int) -> MemoryGrant:
+        """
+        Reserves memory for a generation, clamping `max_new_tokens` to what fits.
+        Waits for running generations when even the minimum does not; raises
+        MemoryExhausted when nothing is left to wait for or the wait times out.
+        """
+        started = time.perf_counter()
+        reclaimed = waited = False
+        while True:
+            changed = self._changed
+            granted = self._fit(prompt_tokens, max_new_tokens, self.headroom())
+            if granted is not None:
+                break
+            if not reclaimed:
+                await asyncio.shield(self.reclaim(caches=True))
+                reclaimed = True
+                continue
+            remaining = started + self.defer_timeout - time.perf_counter()
+            if not self.grants or remaining <= 0:
+                self.rejected += 1
+                needed = self.estimate(prompt_tokens, min(self.min_new_tokens, max_new_tokens))
+                raise MemoryExhausted(
+                    f"Not enough memory for a {prompt_tokens}-token prompt: it needs about {needed / MB:.1f} MB "
+                    f"and {max(0, self.headroom() or 0) / MB:.1f} MB is free."
+                )
+            if not waited:
+                self.deferred += 1
+                waited = True
+                log.info("Generation %s waits for memory (%d prompt tokens)", generation_id, prompt_tokens)
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        grant = MemoryGrant(
+            prompt_tokens,
+            max_new_tokens,
+            granted,
+            self.estimate(prompt_tokens, granted) if self.kv_per_token else 0,
+            time.perf_counter() - started,
+        )
+        if grant.clamped:
+            self.clamped += 1
+            log.info("Generation %s limited to %d new tokens by free memory", generation_id, granted)
+        self.grants[generation_id] = grant
+        return grant
+
+    def observe(self):
+        """Samples process memory into the high-water marks of the running generations."""
+        if self.cuda:
+            current = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            current = rss_bytes()
+        if current is None:
+            return
+        self.peak_bytes = max(self.peak_bytes, current)
+        for grant in list(self.grants.values()):
+            grant.peak_bytes = max(grant.peak_bytes, current)
+
+    def release(self, generation_id: str, status: str, error: Optional[BaseException] = None) -> Optional[MemoryGrant]:
+        """
+        Ends a generation's grant; reclaims memory when it did not finish normally
+        (the collection finishes in the background).
+        """
+        self.observe()
+        grant = self.grants.pop(generation_id, None)
+        if status in ("error", "timeout", "cancelled", "aborted"):
+            out_of_memory = isinstance(error, MemoryError) or "out of memory" in str(error or "").lower()
+            self.reclaim(caches=out_of_memory)
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return grant
+
+    def reclaim(self, caches: bool = False) -> asyncio.Future:
+        """
+        Clears the evictable caches when `caches`, then collects garbage and empties
+        the CUDA allocator cache in a thread. Returns the collection, which is shared
+        when one is already running.
+        """
+        if caches:
+            for reclaimer in self.reclaimers:
+                reclaimer()
+        self.reclaims += 1
+        if self._collecting is None or self._collecting.done():
+            self._collecting = asyncio.ensure_future(asyncio.to_thread(self._collect))
+        return self._collecting
+
+    def _collect(self):
+        gc.collect()
+        if self.cuda:
+            torch.cuda.empty_cache()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kv_bytes_per_token": self.kv_per_token,
+            "available_bytes": self.available(),
+            "headroom_bytes": self.headroom(),
+            "reserve_bytes": self.reserve_bytes,
+            "active_grants": len(self.grants),
+            "deferred": self.deferred,
+            "clamped": self.clamped,
+            "rejected": self.rejected,
+            "reclaims": self.reclaims,
+            "peak_bytes": self.peak_bytes,
+        }
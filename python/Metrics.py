@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from Log import get_logger
+
+log = get_logger(__name__)
+
+# Set to a file path to append one JSON line per finished generation
+TRACE_FILE = os.environ.get("OPENMED_TRACE_FILE")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+BYTE_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(6, 18))  # 64MB .. 128GB
+
+# Trace field -> (metric name, help text, buckets)
+TRACE_HISTOGRAMS = {
+    "queue_wait_s": ("generation_queue_wait_seconds", "Time from submission to the start of prefill.", DEFAULT_BUCKETS),
+    "template_s": ("generation_template_seconds", "Chat template rendering time.", DEFAULT_BUCKETS),
+    "tokenize_s": ("generation_tokenize_seconds", "Processor / tokenizer time, including image preprocessing.", DEFAULT_BUCKETS),
+    "prefill_s": ("generation_prefill_seconds", "Prompt prefill forward time.", DEFAULT_BUCKETS),
+    "ttft_s": ("generation_time_to_first_token_seconds", "Time from request to the first streamed token.", DEFAULT_BUCKETS),
+    "decode_tokens_per_s": ("generation_decode_tokens_per_second", "Decode rate after the first token.", RATE_BUCKETS),
+    "total_s": ("generation_total_seconds", "Total generation time.", DEFAULT_BUCKETS),
+    "prompt_tokens": ("generation_prompt_tokens", "Prompt length in tokens.", TOKEN_BUCKETS),
+    "generated_tokens": ("generation_generated_tokens", "Generated tokens per request.", TOKEN_BUCKETS),
+    "memory_peak_bytes": ("generation_memory_peak_bytes", "Process memory high-water mark during a generation.", BYTE_BUCKETS),
+}
+
+
+def _percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class Histogram:
+    """Cumulative-bucket histogram plus a window of recent values for percentiles."""
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS, window: int = 1024):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def prometheus(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def snapshot(self) -> Dict[str, Any]:
+        values = sorted(self.recent)
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": _percentile(values, 0.50),
+            "p95": _percentile(values, 0.95),
+            "p99": _percentile(values, 0.99),
+            "max": values[-1] if values else None,
+        }
+
+
+class Metrics:
+    """
+    Process-wide latency and throughput metrics.
+
+    Generations report one trace dict each (`record_trace`); other components
+    observe single values (`observe`) or bump counters (`inc`). Everything is
+    exposed as Prometheus text or as a JSON snapshot.
+    """
+
+    def __init__(self, trace_file: Optional[str] = TRACE_FILE):
+        self.trace_file = trace_file
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        for name, help_text, buckets in TRACE_HISTOGRAMS.values():
+            self.histograms[name] = Histogram(name, help_text, buckets)
+
+    def histogram(self, name: str, help_text: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(name, help_text, buckets)
+            return histogram
+
+    def observe(self, name: str, value: float, help_text: str = "", buckets=DEFAULT_BUCKETS):
+        histogram = self.histogram(name, help_text, buckets)
+        with self._lock:
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_trace(self, trace: Dict[str, Any]):
+        """Aggregates one generation's timings and optionally appends it to the trace file."""
+        with self._lock:
+            for field, (name, _, _) in TRACE_HISTOGRAMS.items():
+                value = trace.get(field)
+                if value is not None:
+                    self.histograms[name].observe(value)
+            status = trace.get("status", "unknown")
+            key = f"generations_total_{status}"
+            self.counters[key] = self.counters.get(key, 0) + 1
+            self.counters["generated_tokens_total"] = (
+                self.counters.get("generated_tokens_total", 0) + (trace.get("generated_tokens") or 0)
+            )
+
+        if self.trace_file:
+            try:
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace) + "\n")
+            except OSError as e:
+                log.warning("Failed to write trace: %s", e)
+
+    def prometheus_text(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """Renders all metrics; `gauges` adds point-in-time values such as cache sizes."""
+        with self._lock:
+            lines = []
+            for histogram in self.histograms.values():
+                lines.extend(histogram.prometheus())
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+            for name, value in sorted((gauges or {}).items()):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+            return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = time.time() - self.started_at
+            return {
+                "uptime_s": uptime,
+                "counters": dict(self.counters),
+                "tokens_per_s": self.counters.get("generated_tokens_total", 0) / uptime if uptime else 0.0,
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+
+def flatten_gauges(stats: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Turns nested stats dicts into flat `a_b_c` gauge names, keeping numeric values only."""
+    gauges = {}
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            gauges.update(flatten_gauges(value, name + "_"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges[name] = value
+    return gauges
+
+
+metrics = Metrics()
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import httpx
+from Log import get_logger
+from Metrics import metrics
+
+log = get_logger(__name__)
+
+
+class _MessageState:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.text = ""
+        self.saved_text = ""
+        self.message_id = None
+        self.last_flush = time.monotonic()
+        self.queued = False
+        self.final = False
+        self.failures = 0
+        self.done: Optional[asyncio.Future] = None
+
+    @property
+    def dirty(self) -> bool:
+        return self.text != self.saved_text
+
+
+class MessageWriter:
+    """
+    Persists streamed assistant messages to the Rust DB in the background.
+
+    Streams hand over their running text with `update`, which never waits on the
+    network: the writer task coalesces updates per message and writes the latest
+    text once `flush_interval` seconds have passed or `flush_chars` new characters
+    have arrived. All requests share one pooled `httpx.AsyncClient`.
+
+    At most `max_messages` messages are tracked at once; a stream that starts while
+    the writer is that far behind waits for a slot (backpressure). `finish` and
+    `close` guarantee the final text is written.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        flush_interval: float = 0.5,
+        flush_chars: int = 1024,
+        max_messages: int = 256,
+        max_connections: int = 8,
+        final_attempts: int = 3,
+        client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.base_url = base_url
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.final_attempts = final_attempts
+        self.client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._max_connections = max_connections
+        self._messages: Dict[str, _MessageState] = {}
+        self._slots = asyncio.Semaphore(max_messages)
+        self._urgent: "asyncio.Queue[str]" = asyncio.Queue(maxsize=max_messages)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def update(self, key: str, chat_id, text: str):
+        """Records the latest text of a message. Only waits when no message slot is free."""
+        state = self._messages.get(key)
+        if state is None:
+            await self._slots.acquire()
+            state = self._messages[key] = _MessageState(chat_id)
+        state.text = text
+        if len(state.text) - len(state.saved_text) >= self.flush_chars:
+            self._mark_urgent(key, state)
+
+    async def finish(self, key: str, chat_id, text: str):
+        """Records the final text and waits until it has been written (or given up on)."""
+        await self.update(key, chat_id, text)
+        state = self._messages[key]
+        state.final = True
+        if state.done is None:
+            state.done = asyncio.get_running_loop().create_future()
+        done = state.done
+        self._mark_urgent(key, state)
+        await done
+
+    async def close(self):
+        """Flushes every tracked message, stops the writer task and closes the pool."""
+        self.start()
+        pending = []
+        for key, state in list(self._messages.items()):
+            state.final = True
+            if state.done is None:
+                state.done = asyncio.get_running_loop().create_future()
+            pending.append(state.done)
+            self._mark_urgent(key, state)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "tracked_messages": len(self._messages),
+            "dirty_messages": sum(1 for state in self._messages.values() if state.dirty),
+            "urgent_queue": self._urgent.qsize(),
+        }
+
+    def _mark_urgent(self, key: str, state: _MessageState):
+        if state.queued:
+            return
+        try:
+            self._urgent.put_nowait(key)
+            state.queued = True
+        except asyncio.QueueFull:
+            # The periodic sweep still picks the message up.
+            pass
+
+    async def _run(self):
+        while True:
+            keys = []
+            try:
+                keys.append(await asyncio.wait_for(self._urgent.get(), timeout=self.flush_interval))
+                while not self._urgent.empty():
+                    keys.append(self._urgent.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+
+            now = time.monotonic()
+            for key, state in self._messages.items():
+                if key not in keys and (state.final or (state.dirty and now - state.last_flush >= self.flush_interval)):
+                    keys.append(key)
+
+            for start in range(0, len(keys), self._max_connections):
+                await asyncio.gather(*(self._flush(key) for key in keys[start:start + self._max_connections]))
+
+    async def _flush(self, key: str):
+        state = self._messages.get(key)
+        if state is None:
+            return
+        state.queued = False
+        text = state.text
+        try:
+            if state.dirty:
+                write_started = time.perf_counter()
+                await self._write(state, text)
+                metrics.observe("persist_write_seconds", time.perf_counter() - write_started, "DB write latency per message update.")
+            state.saved_text = text
+            state.failures = 0
+        except Exception as e:
+            state.failures += 1
+            metrics.inc("persist_write_failures_total")
+            log.warning("Failed to save message (%d failures in a row): %s", state.failures, e)
+        state.last_flush = time.monotonic()
+
+        if state.final and (not state.dirty or state.failures >= self.final_attempts):
+            del self._messages[key]
+            self._slots.release()
+            if state.done is not None and not state.done.done():
+                state.done.set_result(not state.dirty)
+
+    async def _write(self, state: _MessageState, text: str):
+        if state.message_id is None:
+            res = await self.client.post(
+                f"{self.base_url}/chats/{state.chat_id}/messages",
+                json={"role": "assistant", "content": text},
+            )
+            if res.status_code != 201:
+                raise RuntimeError(f"unexpected status {res.status_code} creating message")
+            state.message_id = res.json()
+        else:
+            res = await self.client.patch(
+                f"{self.base_url}/messages/{state.message_id}",
+                json={"content": text},
+            )
+            res.raise_for_status()
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _Entry:
+    def __init__(self, token_ids: List[int], layers: List[tuple], image_key: Optional[str]):
+        self.token_ids = token_ids
+        self.layers = layers
+        self.image_key = image_key
+        self.nbytes = sum(k.nbytes + v.nbytes for k, v in layers)
+
+
+def _common_prefix_length(a: List[int], b: List[int]) -> int:
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PrefixCache:
+    """
+    Per-chat cache of prompt key/values, evicted least-recently-used under a byte budget.
+
+    Each chat keeps the KV of its last prompt plus generated answer. A new request
+    for the same chat reuses the longest common token prefix, so only the new
+    suffix (usually the latest user turn) has to be prefilled.
+    """
+
+    def __init__(self, max_bytes: int, image_token_id: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.image_token_id = image_token_id
+        self.entries: "OrderedDict[Any, _Entry]" = OrderedDict()
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key, token_ids: List[int], image_key: Optional[str] = None) -> Tuple[int, Optional[List[tuple]]]:
+        """
+        Returns `(prefix_length, layers)` with the cached KV cropped to the reusable
+        prefix, or `(0, None)` on a miss. At least one prompt token is always left
+        for prefill so the model produces logits for the next token.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return 0, None
+            self.entries.move_to_end(key)
+
+            prefix_len = _common_prefix_length(entry.token_ids, token_ids)
+            prefix_len = min(prefix_len, len(token_ids) - 1)
+
+            # Image placeholder tokens look the same for every image, so only reuse
+            # past the first one when the cached KV was computed for the same image.
+            if self.image_token_id is not None and (image_key is None or image_key != entry.image_key):
+                for i in range(prefix_len):
+                    if token_ids[i] == self.image_token_id:
+                        prefix_len = i
+                        break
+
+            if prefix_len <= 0:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.reused_tokens += prefix_len
+            layers = [(k[:, :, :prefix_len, :], v[:, :, :prefix_len, :]) for k, v in entry.layers]
+            return prefix_len, layers
+
+    def store(self, key, token_ids: List[int], layers: List[tuple], image_key: Optional[str] = None):
+        """Replaces the chat's entry. `layers` must be owned by the cache (not views of a live batch)."""
+        entry = _Entry(token_ids, layers, image_key)
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes_held -= old.nbytes
+            if entry.nbytes > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.bytes_held += entry.nbytes
+            while self.bytes_held > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes_held -= evicted.nbytes
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes_held -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.bytes_held = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
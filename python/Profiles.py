@@ -0,0 +1,178 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+MODEL_ID = "google/medgemma-1.5-4b-it"
+
+# Profile used by this deployment, and an optional JSON file with more profiles:
+# {"name": {"base": "cpu-fast", "max_new_tokens": 256, ...}, ...}
+PROFILE_NAME = os.environ.get("OPENMED_PROFILE", "default")
+PROFILES_FILE = os.environ.get("OPENMED_PROFILES_FILE")
+
+QUANTIZATIONS = (None, "nf4", "int8", "dynamic-int8")
+
+# Default tokens of attached file content added to a chat, for profiles that do not set their own
+ATTACHMENT_TOKEN_BUDGET = int(os.environ.get("OPENMED_ATTACHMENT_TOKEN_BUDGET", "8000"))
+
+
+class EngineProfile:
+    """
+    How the model is loaded and run, and the sampling defaults requests start from.
+
+    - `device`: "auto" (CUDA when available), "cuda" or "cpu"
+    - `quantization`: None, "nf4" (4-bit) or "int8" through bitsandbytes, or
+      "dynamic-int8": PyTorch dynamic int8 quantization of the language model's
+      linear layers, the CPU backend (exported once to disk)
+    - `dtype`: compute dtype name, e.g. "bfloat16" or "float32"
+    - `vision_dtype`: precision of the vision tower and projector when it should
+      differ from `dtype`; they are then left out of quantization
+    - `attn_implementation`: passed to `from_pretrained` ("sdpa", "eager", ...); None keeps the model's default
+    - `compile`: wrap the model's forward in `torch.compile` (loaded models only, not injected ones)
+    - `cpu_threads`, `cpu_interop_threads`: torch intra-/inter-op threads; None keeps torch's default
+    - `cpu_affinity`: CPUs to pin the process to, e.g. "0-7" or "0,2,4"; None leaves it unpinned
+    - `max_context`: prompt plus answer tokens; longer prompts are refused, answers are cut to fit
+    - `max_prompt_tokens`: prompt budget; longer chats lose old attachments and turns
+      first (see ContextWindow), which bounds prefill time
+    - `attachment_token_budget`: tokens of attached file content per message; larger
+      attachments are cut to the chunks most relevant to the latest question
+    - `max_new_tokens`, `do_sample`, `temperature`, `top_p`: request defaults
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model_id: str = MODEL_ID,
+        device: str = "auto",
+        quantization: Optional[str] = "nf4",
+        dtype: str = "bfloat16",
+        vision_dtype: Optional[str] = None,
+        attn_implementation: Optional[str] = None,
+        compile: bool = False,
+        cpu_threads: Optional[int] = None,
+        cpu_interop_threads: Optional[int] = None,
+        cpu_affinity: Optional[str] = None,
+        max_context: int = 131072,
+        max_prompt_tokens: int = 32768,
+        attachment_token_budget: int = ATTACHMENT_TOKEN_BUDGET,
+        max_new_tokens: int = 2000,
+        do_sample: bool = True,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}' in profile '{name}'.")
+        if device not in ("auto", "cuda", "cpu"):
+            raise ValueError(f"Unknown device '{device}' in profile '{name}'.")
+        if quantization == "dynamic-int8" and device == "cuda":
+            raise ValueError(f"Profile '{name}': dynamic-int8 quantization runs on the CPU only.")
+        self.name = name
+        self.model_id = model_id
+        self.device = device
+        self.quantization = quantization
+        self.dtype = dtype
+        self.vision_dtype = vision_dtype
+        self.attn_implementation = attn_implementation
+        self.compile = compile
+        self.cpu_threads = cpu_threads
+        self.cpu_interop_threads = cpu_interop_threads
+        self.cpu_affinity = cpu_affinity
+        self.max_context = max_context
+        self.max_prompt_tokens = max_prompt_tokens
+        self.attachment_token_budget = attachment_token_budget
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    def derive(self, name: str, **changes) -> "EngineProfile":
+        return EngineProfile(**{**self.to_dict(), "name": name, **changes})
+
+
+_DEFAULT = EngineProfile("default")
+
+PROFILES: Dict[str, EngineProfile] = {
+    # 4-bit weights on the GPU, the original settings; dynamic int8 on CPU-only boxes (see for_device)
+    "default": _DEFAULT,
+    "gpu-int8": _DEFAULT.derive("gpu-int8", device="cuda", quantization="int8"),
+    "gpu-bf16": _DEFAULT.derive("gpu-bf16", device="cuda", quantization=None, attn_implementation="sdpa", compile=True),
+    # CPU-only boxes: unquantized float32 weights, all cores
+    "cpu-quality": _DEFAULT.derive(
+        "cpu-quality", device="cpu", quantization=None, dtype="float32", cpu_threads=os.cpu_count()
+    ),
+    # Trades answer quality for latency: int8 language model, bfloat16 vision tower,
+    # shorter context and answers, greedy decoding
+    "cpu-fast": _DEFAULT.derive(
+        "cpu-fast",
+        device="cpu",
+        quantization="dynamic-int8",
+        dtype="float32",
+        vision_dtype="bfloat16",
+        attn_implementation="sdpa",
+        cpu_threads=os.cpu_count(),
+        max_context=8192,
+        max_prompt_tokens=4096,
+        attachment_token_budget=min(ATTACHMENT_TOKEN_BUDGET, 2048),
+        max_new_tokens=512,
+        do_sample=False,
+    ),
+}
+
+
+def load_profiles(path: Optional[str] = PROFILES_FILE) -> Dict[str, EngineProfile]:
+    """The built-in profiles plus those in `path`; each file entry extends its `base` (default "default")."""
+    profiles = dict(PROFILES)
+    if not path:
+        return profiles
+    for name, fields in json.loads(Path(path).read_text(encoding="utf-8")).items():
+        fields = dict(fields)
+        base = fields.pop("base", "default")
+        if base not in profiles:
+            raise ValueError(f"Profile '{name}' extends unknown profile '{base}'.")
+        profiles[name] = profiles[base].derive(name, **fields)
+    return profiles
+
+
+def get_profile(name: str = PROFILE_NAME) -> EngineProfile:
+    profiles = load_profiles()
+    if name not in profiles:
+        raise ValueError(f"Unknown engine profile '{name}'. Available: {', '.join(sorted(profiles))}.")
+    return profiles[name]
+
+
+def for_device(profile: EngineProfile, cuda_available: bool) -> EngineProfile:
+    """
+    The profile to load with. bitsandbytes needs CUDA, so a profile that leaves the
+    device to "auto" and asks for nf4 or int8 gets dynamic-int8 (float32, on the
+    CPU) when there is no GPU. Other profiles are returned unchanged.
+    """
+    if profile.device != "auto" or profile.quantization not in ("nf4", "int8") or cuda_available:
+        return profile
+    return profile.derive(profile.name, device="cpu", quantization="dynamic-int8", dtype="float32")
+
+
+def parse_sampling(
+    max_new_tokens=None, do_sample=None, temperature=None, top_p=None
+) -> Dict[str, Any]:
+    """Validates per-request sampling overrides; returns only the ones that were given. Raises ValueError."""
+    overrides = {}
+    if max_new_tokens is not None:
+        if not isinstance(max_new_tokens, int) or isinstance(max_new_tokens, bool) or max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be a positive integer.")
+        overrides["max_new_tokens"] = max_new_tokens
+    if do_sample is not None:
+        if not isinstance(do_sample, bool):
+            raise ValueError("do_sample must be a boolean.")
+        overrides["do_sample"] = do_sample
+    if temperature is not None:
+        if not isinstance(temperature, (int, float)) or isinstance(temperature, bool) or temperature < 0:
+            raise ValueError("temperature must be a non-negative number.")
+        overrides["temperature"] = float(temperature)
+    if top_p is not None:
+        if not isinstance(top_p, (int, float)) or isinstance(top_p, bool) or not 0 < top_p <= 1:
+            raise ValueError("top_p must be in (0, 1].")
+        overrides["top_p"] = float(top_p)
+    return overrides
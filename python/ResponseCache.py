@@ -0,0 +1,135 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+WHITESPACE = re.compile(r"\s+")
+
+# Per-request cache use: "auto" caches only reproducible (greedy or seeded) requests,
+# "allow" also sampled ones, "off" bypasses the cache
+CACHE_MODES = ("auto", "allow", "off")
+
+
+def _normalize(value: Any) -> Any:
+    """Collapses whitespace in every string so formatting-only differences map to the same key."""
+    if isinstance(value, str):
+        return WHITESPACE.sub(" ", value).strip()
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def response_key(model_name: str, messages: List[dict], image_key: Optional[str], params: Dict[str, Any]) -> str:
+    """
+    Cache key of a generation: the model, the normalised messages (attached file
+    text is already inlined), the image's content hash and the sampling settings.
+    """
+    digest = hashlib.sha256()
+    for part in (model_name, _normalize(messages), image_key, params):
+        digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of finished answers, so repeated standard prompts against
+    the same attachments skip generation.
+
+    Entries live in a SQLite file and survive restarts. Entries older than
+    `ttl_seconds` are ignored and removed; past `max_entries` or `max_bytes` the
+    least recently used ones are dropped first.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = 10000,
+        max_bytes: int = 256 * 1024 * 1024,
+        ttl_seconds: float = 7 * 24 * 3600,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+            """
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns `{"text", "stats"}` for a live entry, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT text, stats, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return {"text": row[0], "stats": json.loads(row[1])}
+
+    def put(self, key: str, text: str, stats: Dict[str, Any]):
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, text, stats, bytes, created_at, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, json.dumps(stats), size, now, now),
+            )
+            self.stores += 1
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float):
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, bytes FROM responses ORDER BY used_at").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses").fetchone()
+            return {
+                "entries": count,
+                "bytes_held": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+            }
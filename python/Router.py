@@ -0,0 +1,419 @@
+"""
+Runs several ai_server workers (one model each) behind a single endpoint.
+
+    python Router.py --workers 2 --port 8000
+    OPENMED_STUB_MODEL=1 python Router.py --workers 3   # CPU stub models, for testing
+
+Each worker is a separate `ai_server` process with its own InferenceService on
+its own local port. `/generate` requests of the same chat go to the same worker
+so its prefix cache is reused, unless that worker is far busier than the
+least loaded one. `/cancel` and `/generations/{id}` (status and reattaching to
+a stream) reach the worker that owns the generation.
+Workers that exit are restarted automatically.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from Admission import client_address
+from Log import get_logger
+from Metrics import flatten_gauges
+
+log = get_logger(__name__)
+
+PYTHON_DIR = Path(__file__).resolve().parent
+
+WORKER_BASE_PORT = 8100
+HEALTH_INTERVAL_SECONDS = 1.0
+# Restart delay doubles after each crash, up to this limit
+MAX_RESTART_BACKOFF_SECONDS = 30.0
+# A worker that stayed up this long is considered healthy again
+STABLE_UPTIME_SECONDS = 60.0
+# Chat affinity is dropped when the preferred worker has this many more streams than the least loaded one
+AFFINITY_SLACK = 4
+# Generation owners remembered for /cancel and reattaching; older ones are found by asking the workers
+MAX_TRACKED_GENERATIONS = 4096
+
+GENERATION_ID_PATTERN = re.compile(rb'"generation_id": "([^"]+)"')
+# Same multipart part limit as the workers (ai_server.NEW_MAX_PART_SIZE)
+MAX_PART_SIZE = 100 * 1024 * 1024  # 100MB
+# Worker response headers passed back to the client on non-streaming replies
+PASSTHROUGH_HEADERS = ("content-type", "retry-after")
+
+
+class Worker:
+    """One ai_server process and what the router knows about it."""
+
+    def __init__(self, index: int, port: int, env: Dict[str, str]):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+        self.state = "stopped"
+        self.in_flight = 0
+        self.served = 0
+        self.restarts = 0
+        self.started_at = 0.0
+        self.next_restart_at = 0.0
+        self.backoff = 1.0
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "ai_server:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=PYTHON_DIR,
+            env=self.env,
+        )
+        self.state = "starting"
+        self.started_at = time.monotonic()
+        log.info("Worker %d started (pid %d, port %d)", self.index, self.process.pid, self.port)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.state = "stopped"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "port": self.port,
+            "pid": self.process.pid if self.process is not None else None,
+            "in_flight": self.in_flight,
+            "served": self.served,
+            "restarts": self.restarts,
+            "uptime_s": time.monotonic() - self.started_at if self.alive else 0.0,
+        }
+
+
+class WorkerRouter:
+    """Starts, watches and picks workers; used by the router app below."""
+
+    def __init__(self, n_workers: int, base_port: int = WORKER_BASE_PORT, devices: Optional[List[str]] = None):
+        self.workers: List[Worker] = []
+        for index in range(n_workers):
+            # Workers listen on loopback only; the router's X-Forwarded-For is the one to trust there
+            env = {**os.environ, "OPENMED_WORKER_INDEX": str(index), "OPENMED_TRUSTED_PROXIES": "127.0.0.1"}
+            if devices:
+                env["CUDA_VISIBLE_DEVICES"] = devices[index % len(devices)]
+            self.workers.append(Worker(index, base_port + index, env))
+        # generation_id -> worker, for the most recently started generations
+        self.generations: "OrderedDict[str, Worker]" = OrderedDict()
+        self.client: Optional[httpx.AsyncClient] = None
+        self._monitor: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None))
+        for worker in self.workers:
+            worker.start()
+        self._monitor = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for worker in self.workers:
+            worker.stop()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL_SECONDS)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.alive:
+                    await self._check_ready(worker)
+                    if worker.state == "ready" and now - worker.started_at > STABLE_UPTIME_SECONDS:
+                        worker.backoff = 1.0
+                elif worker.state != "restarting":
+                    code = worker.process.returncode if worker.process is not None else None
+                    log.warning("Worker %d exited with code %s; restarting in %.0fs", worker.index, code, worker.backoff)
+                    worker.state = "restarting"
+                    worker.next_restart_at = now + worker.backoff
+                    worker.backoff = min(MAX_RESTART_BACKOFF_SECONDS, worker.backoff * 2)
+                elif now >= worker.next_restart_at:
+                    worker.restarts += 1
+                    worker.start()
+
+    async def _check_ready(self, worker: Worker):
+        try:
+            response = await self.client.get(worker.url + "/health/ready", timeout=2.0)
+            worker.state = "ready" if response.status_code == 200 else response.json().get("state", "loading")
+        except (httpx.HTTPError, ValueError):
+            worker.state = "starting"
+
+    def pick(self, chat_id: Optional[str], exclude: Optional[Worker] = None) -> Optional[Worker]:
+        """The chat's preferred worker (rendezvous hashing over ready workers), unless it is much busier than the rest."""
+        candidates = [w for w in self.workers if w.state == "ready" and w.alive and w is not exclude]
+        if not candidates:
+            return None
+        least_loaded = min(candidates, key=lambda w: w.in_flight)
+        if chat_id is None:
+            return least_loaded
+        preferred = max(candidates, key=lambda w: hashlib.sha1(f"{chat_id}:{w.index}".encode()).digest())
+        if preferred.in_flight - least_loaded.in_flight > AFFINITY_SLACK:
+            return least_loaded
+        return preferred
+
+    def remember(self, generation_id: str, worker: Worker):
+        self.generations[generation_id] = worker
+        self.generations.move_to_end(generation_id)
+        while len(self.generations) > MAX_TRACKED_GENERATIONS:
+            self.generations.popitem(last=False)
+
+    async def owner(self, generation_id: str) -> Optional[Worker]:
+        """The worker that runs or retains the generation, asking every worker if it is not known here."""
+        worker = self.generations.get(generation_id)
+        if worker is not None and worker.alive:
+            return worker
+
+        async def has(worker: Worker):
+            try:
+                response = await self.client.get(f"{worker.url}/generations/{generation_id}", timeout=5.0)
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+
+        alive = [w for w in self.workers if w.alive]
+        for worker, found in zip(alive, await asyncio.gather(*(has(w) for w in alive))):
+            if found:
+                self.remember(generation_id, worker)
+                return worker
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            "workers": {str(w.index): w.stats() for w in self.workers},
+            "ready_workers": sum(1 for w in self.workers if w.state == "ready"),
+            "in_flight": sum(w.in_flight for w in self.workers),
+            "tracked_generations": len(self.generations),
+        }
+
+
+def create_app(router: WorkerRouter) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await router.start()
+        yield
+        await router.close()
+
+    app = FastAPI(title="MedGemma API router", lifespan=lifespan)
+
+    @app.get("/")
+    async def root():
+        return {"message": "MedGemma API router is running."}
+
+    @app.get("/health/live")
+    async def health_live():
+        return {"status": "alive"}
+
+    @app.get("/health/ready")
+    async def health_ready():
+        """Ready once at least one worker is."""
+        stats = router.stats()
+        if not stats["ready_workers"]:
+            return JSONResponse(content={"status": "loading", **stats}, status_code=503, headers={"Retry-After": "5"})
+        return {"status": "ready", **stats}
+
+    @app.get("/stats")
+    async def stats_endpoint():
+        """Router state plus each ready worker's own /stats."""
+        stats = router.stats()
+
+        async def fetch(worker: Worker):
+            try:
+                return (await router.client.get(worker.url + "/stats", timeout=5.0)).json()
+            except (httpx.HTTPError, ValueError):
+                return None
+
+        ready = [w for w in router.workers if w.state == "ready"]
+        for worker, worker_stats in zip(ready, await asyncio.gather(*(fetch(w) for w in ready))):
+            stats["workers"][str(worker.index)]["stats"] = worker_stats
+        return stats
+
+    @app.get("/metrics")
+    async def metrics_endpoint():
+        """Router gauges; scrape the workers' own /metrics for latency histograms."""
+        lines = []
+        for name, value in sorted(flatten_gauges(router.stats(), "router_").items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+    async def forward(request: Request, chat_id: Optional[str], path: str, content) -> Response:
+        """Sends the request body to a worker and relays its event stream (or its error reply)."""
+        headers = {
+            "content-type": request.headers.get("content-type", ""),
+            "x-forwarded-for": client_address(request),
+        }
+
+        worker = router.pick(chat_id)
+        response = None
+        for attempt in range(2):
+            if worker is None:
+                return JSONResponse(
+                    content={"error": "No model worker is ready."}, status_code=503, headers={"Retry-After": "5"}
+                )
+            worker.in_flight += 1
+            try:
+                response = await router.client.send(
+                    router.client.build_request("POST", worker.url + path, content=content, headers=headers),
+                    stream=True,
+                )
+                break
+            except httpx.TransportError as e:
+                log.warning("Worker %d unreachable: %s", worker.index, e)
+                worker.in_flight -= 1
+                worker.state = "starting"
+                # Try another worker once, if the body can still be sent again
+                retry = attempt == 0 and (isinstance(content, bytes) or isinstance(e, httpx.ConnectError))
+                worker = router.pick(chat_id, exclude=worker) if retry else None
+        if response is None:
+            return JSONResponse(content={"error": "No model worker is reachable."}, status_code=503, headers={"Retry-After": "5"})
+
+        return await relay(worker, response)
+
+    async def relay(worker: Worker, response: httpx.Response) -> Response:
+        """Relays a worker's event stream, noting which generation it carries, or passes its error reply on."""
+        if response.status_code != 200:
+            body = await response.aread()
+            await response.aclose()
+            worker.in_flight -= 1
+            passthrough = {k: v for k, v in response.headers.items() if k.lower() in PASSTHROUGH_HEADERS}
+            return Response(content=body, status_code=response.status_code, headers=passthrough)
+
+        async def stream():
+            generation_id = None
+            try:
+                async for chunk in response.aiter_raw():
+                    if generation_id is None:
+                        match = GENERATION_ID_PATTERN.search(chunk)
+                        if match:
+                            generation_id = match.group(1).decode()
+                            router.remember(generation_id, worker)
+                    yield chunk
+            except httpx.HTTPError as e:
+                log.warning("Stream from worker %d broke: %s", worker.index, e)
+                yield b'data: {"type": "error", "message": "The model worker stopped unexpectedly."}\n\n'
+            finally:
+                await response.aclose()
+                worker.in_flight -= 1
+                worker.served += 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/generate")
+    async def generate_endpoint(request: Request):
+        """
+        Forwards the unchanged multipart body to the chat's worker. With the chat id
+        in an X-Chat-ID header (or a `chat_id` query parameter) the body is streamed
+        through; otherwise it is buffered and parsed to find `chat_id`.
+        """
+        chat_id = request.headers.get("x-chat-id") or request.query_params.get("chat_id")
+        if chat_id is not None:
+            return await forward(request, chat_id, "/generate", request.stream())
+        body = await request.body()
+        form = await request.form(max_part_size=MAX_PART_SIZE)
+        chat_id = form.get("chat_id")
+        await form.close()
+        return await forward(request, chat_id, "/generate", body)
+
+    @app.post("/chats/{chat_id}/generate")
+    async def generate_turn_endpoint(chat_id: int, request: Request):
+        """Streams the NDJSON body through to the chat's worker, which holds the chat's history."""
+        return await forward(request, str(chat_id), f"/chats/{chat_id}/generate", request.stream())
+
+    @app.get("/generations/{generation_id}")
+    async def generation_status_endpoint(generation_id: str):
+        worker = await router.owner(generation_id)
+        if worker is None:
+            return JSONResponse(content={"error": f"Generation {generation_id} not found."}, status_code=404)
+        try:
+            response = await router.client.get(f"{worker.url}/generations/{generation_id}", timeout=5.0)
+        except httpx.HTTPError:
+            return JSONResponse(content={"error": "The model worker is unreachable."}, status_code=503)
+        return Response(content=response.content, status_code=response.status_code, media_type="application/json")
+
+    @app.get("/generations/{generation_id}/stream")
+    async def generation_stream_endpoint(generation_id: str, request: Request):
+        """Reattaches to the generation on the worker that runs it."""
+        worker = await router.owner(generation_id)
+        if worker is None:
+            return JSONResponse(content={"error": f"Generation {generation_id} not found."}, status_code=404)
+        worker.in_flight += 1
+        try:
+            response = await router.client.send(
+                router.client.build_request(
+                    "GET", f"{worker.url}/generations/{generation_id}/stream", params=request.query_params
+                ),
+                stream=True,
+            )
+        except httpx.TransportError:
+            worker.in_flight -= 1
+            return JSONResponse(content={"error": "The model worker is unreachable."}, status_code=503)
+        return await relay(worker, response)
+
+    @app.post("/cancel")
+    async def cancel_generation_endpoint(generation_id: str = Form(...)):
+        """Cancels on the worker that runs the generation; asks every worker if it is not known here."""
+        owner = router.generations.get(generation_id)
+        targets = [owner] if owner is not None and owner.alive else [w for w in router.workers if w.alive]
+
+        async def cancel(worker: Worker):
+            try:
+                response = await router.client.post(
+                    worker.url + "/cancel", data={"generation_id": generation_id}, timeout=5.0
+                )
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+
+        if any(await asyncio.gather(*(cancel(w) for w in targets))):
+            return {"message": f"Generation {generation_id} cancelled successfully."}
+        return JSONResponse(
+            content={"message": f"Generation {generation_id} not found or already finished."}, status_code=404
+        )
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("OPENMED_WORKERS", "2")))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--worker-base-port", type=int, default=WORKER_BASE_PORT)
+    parser.add_argument("--devices", help="comma-separated CUDA devices assigned to workers round-robin, e.g. 0,1")
+    args = parser.parse_args(argv)
+
+    router = WorkerRouter(
+        args.workers,
+        base_port=args.worker_base_port,
+        devices=args.devices.split(",") if args.devices else None,
+    )
+    uvicorn.run(create_app(router), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
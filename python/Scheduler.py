@@ -0,0 +1,577 @@
+import asyncio
+import inspect
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from Detokenizer import IncrementalDetokenizer
+from Log import get_logger
+from Speculative import verify_draft
+
+log = get_logger(__name__)
+
+
+class TokenChannel:
+    """
+    Hands items from the scheduler thread to a coroutine on the event loop.
+
+    `put` is called from the scheduler thread and schedules the item onto an
+    asyncio queue with `call_soon_threadsafe`, so the reader awaits
+    `get` directly instead of blocking an executor thread per token.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._queue: "asyncio.Queue" = asyncio.Queue()
+
+    def put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop is gone (shutdown); nobody is reading any more
+            pass
+
+    async def get(self):
+        return await self._queue.get()
+
+
+class GenerationRequest:
+    """
+    A single queued generation owned by the BatchScheduler.
+
+    The scheduler writes decoded text fragments to `output`, followed by `None`
+    once the request is finished (or an exception instance if it failed).
+    `output` is a thread-safe queue unless a `TokenChannel` is passed for
+    readers on an event loop.
+    """
+
+    def __init__(
+        self,
+        generation_id: str,
+        inputs: Dict[str, Any],
+        stop_event: threading.Event,
+        max_new_tokens: int = 2000,
+        do_sample: bool = True,
+        top_p: float = 0.9,
+        temperature: float = 0.6,
+        cache_key=None,
+        image_key: Optional[str] = None,
+        seed: Optional[int] = None,
+        output=None,
+    ):
+        self.generation_id = generation_id
+        self.inputs = inputs
+        self.stop_event = stop_event
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.top_p = top_p
+        self.temperature = temperature
+        # Requests sharing a cache_key (the chat id) reuse each other's prompt KV.
+        self.cache_key = cache_key
+        self.image_key = image_key
+        # A seed makes sampling reproducible: the request gets its own random generator
+        self.seed = seed
+        self.generator: Optional[torch.Generator] = None
+        self.output = output if output is not None else queue.Queue()
+        # Filled in by the scheduler once the prompt has been prefilled.
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        # perf_counter timestamps for latency metrics
+        self.submitted_at = None
+        self.prefill_started_at = None
+        self.prefill_finished_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.generated_tokens = 0
+        # Speculative decoding: tokens proposed by the drafter and how many the model kept
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+
+class _Sequence:
+    """Decode state of one request inside the running batch."""
+
+    def __init__(
+        self, request: GenerationRequest, prompt_ids: List[int], layers, length: int, next_token: int, detokenizer
+    ):
+        self.request = request
+        self.prompt_ids = prompt_ids
+        # Un-padded per-layer (key, value) tensors; only used until the row joins the batch.
+        self.layers = layers
+        self.length = length
+        self.pad = 0
+        self.next_token = next_token
+        self.generated: List[int] = []
+        self.detokenizer = detokenizer
+        # Owned by the drafter (n-gram index or draft model cache)
+        self.draft_state = None
+
+
+def _cache_layers(cache) -> List[tuple]:
+    """Returns the (key, value) tensors of every layer for both Cache objects and legacy tuples."""
+    return [(kv[0], kv[1]) for kv in cache]
+
+
+def _slice_prompt(inputs: Dict[str, Any], start: int, keep_images: bool) -> Dict[str, Any]:
+    """Drops the first `start` prompt positions that are already covered by a cached prefix."""
+    prompt_len = inputs["input_ids"].shape[1]
+    sliced = {}
+    for name, value in inputs.items():
+        if name == "attention_mask":
+            sliced[name] = value
+        elif name == "pixel_values" or name.startswith("image_"):
+            if keep_images:
+                sliced[name] = value
+        elif isinstance(value, torch.Tensor) and value.dim() >= 2 and value.shape[1] == prompt_len:
+            sliced[name] = value[:, start:]
+        else:
+            sliced[name] = value
+    return sliced
+
+
+def _make_cache(layers: List[tuple], like):
+    if like is None or isinstance(like, (tuple, list)):
+        return tuple(layers)
+    return DynamicCache(layers)
+
+
+class BatchScheduler:
+    """
+    Owns the model and runs one batched decode loop for all concurrent requests.
+
+    New requests are prefilled individually and merged into the running batch at
+    token boundaries; finished or cancelled ones are retired at the same points.
+    The batch keeps a left-padded KV cache so every row advances with a single
+    forward pass per step.
+
+    With a `drafter`, a lone running request decodes speculatively: the drafter
+    proposes several tokens, one forward pass checks them all, and the accepted
+    prefix is emitted at once. Batched steps are unchanged.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        max_batch_size: int = 8,
+        prefix_cache=None,
+        image_cache=None,
+        image_token_id: Optional[int] = None,
+        drafter=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.image_cache = image_cache
+        self.image_token_id = image_token_id
+        self.drafter = drafter
+        self.speculative_steps = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.eos_token_ids = self._collect_eos_ids()
+
+        params = inspect.signature(model.forward).parameters
+        self._accepts_any_kwarg = any(p.kind == p.VAR_KEYWORD for p in params.values())
+        self._forward_params = set(params)
+
+        self.pending: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        self.active: List[_Sequence] = []
+        self._batch_layers = None
+        self._batch_like = None
+        self._attention_mask = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: GenerationRequest):
+        if self._closed:
+            raise RuntimeError("Scheduler is closed.")
+        request.submitted_at = time.perf_counter()
+        self.pending.put(request)
+
+    def close(self):
+        self._closed = True
+        self.pending.put(None)
+        self._thread.join(timeout=5)
+
+    def _collect_eos_ids(self) -> set:
+        eos_ids = set()
+        for source in (getattr(self.model, "generation_config", None), self.tokenizer):
+            value = getattr(source, "eos_token_id", None)
+            if value is None:
+                continue
+            eos_ids.update(value if isinstance(value, (list, tuple)) else [value])
+        return eos_ids
+
+    def _forward_kwargs(self, **kwargs):
+        if self._accepts_any_kwarg:
+            return kwargs
+        return {k: v for k, v in kwargs.items() if k in self._forward_params}
+
+    def _run(self):
+        with torch.inference_mode():
+            while not self._closed:
+                # Block while idle instead of spinning.
+                if not self.active:
+                    request = self.pending.get()
+                    if request is None:
+                        break
+                    self._admit([request])
+
+                joining = []
+                while len(self.active) + len(joining) < self.max_batch_size:
+                    try:
+                        request = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if request is None:
+                        self._closed = True
+                        break
+                    joining.append(request)
+                if joining:
+                    self._admit(joining)
+
+                if self.active:
+                    try:
+                        self._step()
+                    except Exception as e:
+                        log.exception("Decode step failed; failing all running generations")
+                        self._fail_all(e)
+
+        self._fail_all(RuntimeError("Scheduler stopped."))
+
+    def _admit(self, requests: List[GenerationRequest]):
+        joined = []
+        for request in requests:
+            if request.stop_event.is_set():
+                request.output.put(None)
+                continue
+            try:
+                joined.append(self._prefill(request))
+            except Exception as e:
+                log.exception("Prefill failed")
+                request.output.put(e)
+
+        # The first token comes straight out of the prefill logits.
+        running = []
+        for seq in joined:
+            self._emit(seq, seq.next_token)
+            if self._finished(seq):
+                self._retire(seq, seq.layers)
+            else:
+                running.append(seq)
+        if running:
+            self._rebuild_batch(self.active + running)
+
+    def _prefill(self, request: GenerationRequest) -> _Sequence:
+        request.prefill_started_at = time.perf_counter()
+        inputs = dict(request.inputs)
+        prompt_ids = inputs["input_ids"][0].tolist()
+
+        prefix_len, prefix_layers = 0, None
+        if self.prefix_cache is not None and request.cache_key is not None:
+            prefix_len, prefix_layers = self.prefix_cache.lookup(request.cache_key, prompt_ids, request.image_key)
+
+        if prefix_len and self.image_token_id is not None:
+            # The vision features are scattered over all placeholder tokens at once, so an
+            # image must lie either fully inside the cached prefix or fully after it.
+            in_suffix = prompt_ids[prefix_len:].count(self.image_token_id)
+            if in_suffix and in_suffix != prompt_ids.count(self.image_token_id):
+                prefix_len, prefix_layers = 0, None
+
+        if prefix_len:
+            keep_images = self.image_token_id is not None and self.image_token_id in prompt_ids[prefix_len:]
+            inputs = _slice_prompt(inputs, prefix_len, keep_images)
+            cache = DynamicCache(prefix_layers)
+        else:
+            cache = DynamicCache()
+
+        if "pixel_values" in inputs and request.image_key is not None:
+            inputs = self._embed_images(inputs, request.image_key)
+
+        outputs = self.model(
+            **inputs,
+            **self._forward_kwargs(past_key_values=cache, use_cache=True, logits_to_keep=1),
+        )
+        self._batch_like = outputs.past_key_values
+        request.prompt_tokens = len(prompt_ids)
+        request.cached_tokens = prefix_len
+        next_token = self._sample([request], outputs.logits[:, -1, :])[0]
+        request.prefill_finished_at = time.perf_counter()
+        return _Sequence(
+            request,
+            prompt_ids,
+            _cache_layers(outputs.past_key_values),
+            len(prompt_ids),
+            next_token,
+            IncrementalDetokenizer(self.tokenizer),
+        )
+
+    def _embed_images(self, inputs: Dict[str, Any], image_key: str) -> Dict[str, Any]:
+        """
+        Replaces `pixel_values` with prompt embeddings that already contain the image
+        features, taking the vision encoder output from the image cache when the same
+        image was seen before. Models without `get_image_features` keep `pixel_values`.
+        """
+        if self.image_cache is None or self.image_token_id is None or not hasattr(self.model, "get_image_features"):
+            return inputs
+
+        cache_key = "features:" + image_key
+        features = self.image_cache.get(cache_key)
+        if features is None:
+            features = self.model.get_image_features(inputs["pixel_values"])
+            features = getattr(features, "pooler_output", features)
+            self.image_cache.put(cache_key, features)
+
+        inputs = {k: v for k, v in inputs.items() if k != "pixel_values" and not k.startswith("image_")}
+        input_ids = inputs.pop("input_ids")
+        image_mask = input_ids == self.image_token_id
+        embeddings = self.model.get_input_embeddings()(input_ids.masked_fill(image_mask, 0))
+        inputs["inputs_embeds"] = embeddings.masked_scatter(
+            image_mask.unsqueeze(-1), features.to(embeddings.device, embeddings.dtype)
+        )
+        return inputs
+
+    def _rebuild_batch(self, rows: List[_Sequence]):
+        """Re-packs the left-padded batch cache after rows join or leave."""
+        if not rows:
+            self.active = []
+            self._batch_layers = None
+            self._attention_mask = None
+            return
+
+        per_row = []
+        for i, seq in enumerate(rows):
+            if seq.layers is not None:
+                per_row.append(seq.layers)
+                seq.layers = None
+            else:
+                row_index = self.active.index(seq)
+                per_row.append([
+                    (k[row_index:row_index + 1, :, seq.pad:, :], v[row_index:row_index + 1, :, seq.pad:, :])
+                    for k, v in self._batch_layers
+                ])
+
+        max_len = max(seq.length for seq in rows)
+        layers = []
+        for layer_idx in range(len(per_row[0])):
+            keys, values = [], []
+            for seq, row_layers in zip(rows, per_row):
+                k, v = row_layers[layer_idx]
+                pad = max_len - seq.length
+                keys.append(F.pad(k, (0, 0, pad, 0)))
+                values.append(F.pad(v, (0, 0, pad, 0)))
+            layers.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+
+        mask = torch.zeros((len(rows), max_len), dtype=torch.long, device=self.device)
+        for i, seq in enumerate(rows):
+            seq.pad = max_len - seq.length
+            mask[i, seq.pad:] = 1
+
+        self.active = rows
+        self._batch_layers = layers
+        self._attention_mask = mask
+
+    def _step(self):
+        # Speculate only when nothing else could share the forward pass
+        if self.drafter is not None and len(self.active) == 1 and self.pending.empty():
+            if self._speculative_step():
+                return
+
+        rows = self.active
+        past_len = self._attention_mask.shape[1]
+        input_ids = torch.tensor([[seq.next_token] for seq in rows], device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((len(rows), 1), dtype=torch.long, device=self.device)], dim=1
+        )
+        position_ids = torch.tensor([[seq.length] for seq in rows], device=self.device)
+        cache_position = torch.tensor([past_len], device=self.device)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            **self._forward_kwargs(
+                position_ids=position_ids,
+                cache_position=cache_position,
+                past_key_values=_make_cache(self._batch_layers, self._batch_like),
+                use_cache=True,
+            ),
+        )
+        self._batch_layers = _cache_layers(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        next_tokens = self._sample([seq.request for seq in rows], outputs.logits[:, -1, :])
+        for seq, token in zip(rows, next_tokens):
+            seq.length += 1
+            seq.next_token = token
+            self._emit(seq, token)
+
+        remaining = []
+        for i, seq in enumerate(rows):
+            if self._finished(seq):
+                self._retire(seq, [(k[i:i + 1, :, seq.pad:, :], v[i:i + 1, :, seq.pad:, :]) for k, v in self._batch_layers])
+            else:
+                remaining.append(seq)
+        if len(remaining) != len(rows):
+            self._rebuild_batch(remaining)
+
+    def _speculative_step(self) -> bool:
+        """
+        Drafts tokens for the only active row and verifies them in one forward pass.
+        Returns False without touching the batch when there is nothing to draft.
+        """
+        seq = self.active[0]
+        request = seq.request
+        # The token after the accepted drafts is emitted too, so leave room for it
+        limit = request.max_new_tokens - len(seq.generated) - 1
+        if limit <= 0:
+            return False
+        draft = self.drafter.draft(seq, limit)[:limit]
+        if not draft:
+            return False
+
+        past_len = self._attention_mask.shape[1]
+        fed = len(draft) + 1
+        input_ids = torch.tensor([[seq.next_token] + draft], device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((1, fed), dtype=torch.long, device=self.device)], dim=1
+        )
+        position_ids = torch.arange(seq.length, seq.length + fed, device=self.device).unsqueeze(0)
+        cache_position = torch.arange(past_len, past_len + fed, device=self.device)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            **self._forward_kwargs(
+                position_ids=position_ids,
+                cache_position=cache_position,
+                past_key_values=_make_cache(self._batch_layers, self._batch_like),
+                use_cache=True,
+            ),
+        )
+        tokens, accepted = verify_draft(
+            outputs.logits[0, -fed:].float(),
+            draft,
+            lambda row: self._distribution(request, row),
+            generator=self._generator(request, outputs.logits.device),
+        )
+
+        emitted = 0
+        for token in tokens:
+            emitted += 1
+            self._emit(seq, token)
+            if self._finished(seq):
+                break
+
+        self.speculative_steps += 1
+        self.draft_tokens += len(draft)
+        self.accepted_tokens += accepted
+        request.draft_tokens += len(draft)
+        request.accepted_tokens += accepted
+
+        # Keep KV for the fed token and every emitted token except the last, which is fed next step
+        keep = past_len + emitted
+        self._batch_layers = [(k[:, :, :keep, :], v[:, :, :keep, :]) for k, v in _cache_layers(outputs.past_key_values)]
+        self._attention_mask = attention_mask[:, :keep]
+        seq.length += emitted
+        seq.next_token = tokens[emitted - 1]
+
+        if self._finished(seq):
+            self._retire(seq, [(k[:, :, seq.pad:, :], v[:, :, seq.pad:, :]) for k, v in self._batch_layers])
+            self._rebuild_batch([])
+        return True
+
+    def _distribution(self, request: GenerationRequest, row: torch.Tensor) -> Optional[torch.Tensor]:
+        """The request's sampling probabilities over `row`, or None when it decodes greedily."""
+        if not request.do_sample or request.temperature <= 0:
+            return None
+        probs = torch.softmax(row / request.temperature, dim=-1)
+        if request.top_p < 1.0:
+            sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+            cumulative = torch.cumsum(sorted_probs, dim=-1)
+            sorted_probs[(cumulative - sorted_probs) > request.top_p] = 0.0
+            probs = torch.zeros_like(probs).scatter_(0, sorted_idx, sorted_probs)
+        return probs
+
+    def _generator(self, request: GenerationRequest, device) -> Optional[torch.Generator]:
+        if request.seed is None:
+            return None
+        if request.generator is None:
+            request.generator = torch.Generator(device=device)
+            request.generator.manual_seed(request.seed)
+        return request.generator
+
+    def _sample(self, requests: List[GenerationRequest], logits: torch.Tensor) -> List[int]:
+        tokens = []
+        logits = logits.float()
+        for request, row in zip(requests, logits):
+            probs = self._distribution(request, row)
+            if probs is None:
+                tokens.append(int(torch.argmax(row)))
+            else:
+                tokens.append(int(torch.multinomial(probs, 1, generator=self._generator(request, row.device))))
+        return tokens
+
+    def speculative_stats(self) -> Dict[str, Any]:
+        return {
+            "drafter": getattr(self.drafter, "name", None),
+            "steps": self.speculative_steps,
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.accepted_tokens / self.draft_tokens if self.draft_tokens else None,
+        }
+
+    def _emit(self, seq: _Sequence, token: int):
+        """Records a sampled token and pushes any newly printable text to the request."""
+        if seq.request.first_token_at is None:
+            seq.request.first_token_at = time.perf_counter()
+        seq.request.generated_tokens += 1
+        seq.generated.append(token)
+        if token in self.eos_token_ids:
+            return
+        text = seq.detokenizer.push(token)
+        if text:
+            seq.request.output.put(text)
+
+    def _finished(self, seq: _Sequence) -> bool:
+        return (
+            seq.request.stop_event.is_set()
+            or (seq.generated and seq.generated[-1] in self.eos_token_ids)
+            or len(seq.generated) >= seq.request.max_new_tokens
+        )
+
+    def _retire(self, seq: _Sequence, layers: List[tuple]):
+        """Keeps the finished row's KV for the next turn of its chat and closes its output."""
+        request = seq.request
+        if self.prefix_cache is not None and request.cache_key is not None:
+            try:
+                # The last sampled token was never fed back, so it has no KV yet.
+                token_ids = seq.prompt_ids + seq.generated[:-1]
+                owned = [(k.clone(), v.clone()) for k, v in layers]
+                self.prefix_cache.store(request.cache_key, token_ids, owned, request.image_key)
+            except Exception:
+                log.exception("Could not keep the KV cache for the next turn")
+        request.finished_at = time.perf_counter()
+        request.output.put(None)
+
+    def _fail_all(self, error: Exception):
+        for seq in self.active:
+            seq.request.output.put(error)
+        self.active = []
+        self._batch_layers = None
+        self._attention_mask = None
+        while True:
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.output.put(error)
@@ -1,20 +1,89 @@
 import json
-import base64
 from pathlib import Path
+from typing import AsyncIterator
 from Utils import reassemble_objects, read_text_files_from_folder, read_single_text_file
+from ContextAssembly import ContextAssembler
+from Log import get_logger
+from Profiles import ATTACHMENT_TOKEN_BUDGET
+
+log = get_logger(__name__)
+
+# Starts the text part holding an attached file: "\n--- File: name ---\n<content>\n"
+ATTACHMENT_HEADER = "\n--- File: "
 
 def process_history(history: list[str]) -> list[dict]:
     """Reassemble history from chunks and parse as JSON."""
     try:
         messages = reassemble_objects(history)
-        print(f"Processing {len(messages)} messages")
+        log.debug("Processing %d messages", len(messages))
         return messages
     except json.JSONDecodeError as e:
-        print(f"Error parsing history: {e}")
+        log.warning("Error parsing history: %s", e)
         raise ValueError("Invalid history format.")
 
-def process_paths_in_messages(messages: list[dict]):
-    """Iterate through messages to find and process paths (files/directories)."""
+# Largest single NDJSON line (one message) accepted by the incremental parser
+MAX_NDJSON_LINE_BYTES = 100 * 1024 * 1024  # 100MB
+
+async def iter_ndjson(stream: AsyncIterator[bytes], max_line_bytes: int = MAX_NDJSON_LINE_BYTES) -> AsyncIterator[dict]:
+    """
+    Yields one parsed object per line of a newline-delimited JSON body as the bytes
+    arrive, so a large upload is never held as a whole. Raises ValueError on bad JSON
+    or an oversized line.
+    """
+    pending = []
+    pending_size = 0
+    async for chunk in stream:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                if start < len(chunk):
+                    pending.append(chunk[start:])
+                    pending_size += len(chunk) - start
+                    if pending_size > max_line_bytes:
+                        raise ValueError("NDJSON line too large.")
+                break
+            line = b"".join(pending) + chunk[start:end] if pending else chunk[start:end]
+            pending = []
+            pending_size = 0
+            start = end + 1
+            if line.strip():
+                yield _parse_ndjson_line(line)
+    if pending:
+        line = b"".join(pending)
+        if line.strip():
+            yield _parse_ndjson_line(line)
+
+def _parse_ndjson_line(line: bytes) -> dict:
+    try:
+        value = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid NDJSON line: {e}")
+    if not isinstance(value, dict):
+        raise ValueError("Each NDJSON line must be a JSON object.")
+    return value
+
+def validate_message(message: dict):
+    if message.get("role") not in ("user", "assistant", "system"):
+        raise ValueError(f"Invalid message role: {message.get('role')!r}.")
+    if not isinstance(message.get("content"), (str, list)):
+        raise ValueError("Message content must be a string or a list of parts.")
+
+def message_text(message: dict) -> str:
+    """Plain text of a message whose content is either a string or a list of parts."""
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+def process_paths_in_messages(messages: list[dict], context_assembler: ContextAssembler = None, token_budget: int = ATTACHMENT_TOKEN_BUDGET):
+    """
+    Iterate through messages to find and process paths (files/directories).
+
+    With a `context_assembler`, the files attached to a message are cut down to the
+    chunks most relevant to the latest user question within `token_budget` tokens.
+    """
+    question = next((message_text(m) for m in reversed(messages) if m.get("role") == "user"), "")
     for message in messages:
         if message.get("role") == "user" and "paths" in message:
             all_file_contents = []
@@ -28,7 +97,10 @@ def process_paths_in_messages(messages: list[dict]):
                     folder_files = read_text_files_from_folder(path_str)
                     all_file_contents.extend(folder_files)
                 else:
-                    print(f"Path does not exist or is not a file/directory: {path_str}")
+                    log.warning("Path does not exist or is not a file/directory: %s", path_str)
+
+            if all_file_contents and context_assembler is not None:
+                all_file_contents = context_assembler.assemble(all_file_contents, question, token_budget)
 
             if all_file_contents:
                 current_content = message.get("content", "")
@@ -38,30 +110,26 @@ def process_paths_in_messages(messages: list[dict]):
                     current_content.append(
                         {
                             "type": "text",
-                            "text": f"\n--- File: {file_data['name']} ---\n{file_data['content']}\n",
+                            "text": f"{ATTACHMENT_HEADER}{file_data['name']} ---\n{file_data['content']}\n",
                         }
                     )
                 message["content"] = current_content
-                print(f"Appended {len(all_file_contents)} files from paths to a user message.")
+                log.info("Appended %d files from paths to a user message.", len(all_file_contents))
 
             # Remove the 'paths' key after processing
             del message["paths"]
 
-def load_image_from_path(image_path: str) -> str | None:
-    """Load and base64-encode an image from a file path."""
+def resolve_image_path(image_path: str) -> Path | None:
+    """
+    Validate an attached image path: a file, or a directory holding a DICOM series.
+    The image itself is read (and cached by content) by the inference service, so
+    it is not loaded or encoded here.
+    """
     if not image_path:
         return None
     
     image_file_path = Path(image_path)
-    if not image_file_path.is_file():
-        print(f"Warning: image_path '{image_path}' does not point to an existing file.")
+    if not image_file_path.is_file() and not image_file_path.is_dir():
+        log.warning("image_path '%s' does not point to an existing file or directory.", image_path)
         return None
-
-    try:
-        with open(image_file_path, "rb") as img_file:
-            encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
-        print(f"Image loaded and encoded from path: {image_path}")
-        return encoded_image
-    except Exception as e:
-        print(f"Error reading or encoding image from path {image_path}: {e}")
-        raise RuntimeError(f"Failed to process image from path: {e}")
+    return image_file_path
@@ -0,0 +1,156 @@
+import inspect
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+# Tokens proposed per speculative step
+NUM_DRAFT_TOKENS = 8
+# Prompt lookup tries the longest n-gram first
+PROMPT_LOOKUP_MAX_NGRAM = 3
+PROMPT_LOOKUP_MIN_NGRAM = 1
+
+
+class _NgramIndex:
+    """Latest continuation position of every n-gram seen so far in one sequence."""
+
+    def __init__(self, min_ngram: int, max_ngram: int):
+        self.sizes = range(min_ngram, max_ngram + 1)
+        self.positions: Dict[int, Dict[tuple, int]] = {n: {} for n in self.sizes}
+        self.indexed = 0
+
+    def update(self, tokens: List[int]):
+        # An n-gram ending at `end` is indexed once the token after it exists
+        for end in range(max(self.indexed, 1), len(tokens)):
+            for n in self.sizes:
+                if end >= n:
+                    self.positions[n][tuple(tokens[end - n:end])] = end
+        self.indexed = max(self.indexed, len(tokens))
+
+
+class PromptLookupDrafter:
+    """
+    Drafts by copying: finds the latest earlier occurrence of the sequence's last
+    n tokens (in the prompt or the answer so far) and proposes the tokens that
+    followed it. Works well when answers quote attached files or earlier turns.
+    """
+
+    name = "prompt_lookup"
+
+    def __init__(
+        self,
+        num_draft_tokens: int = NUM_DRAFT_TOKENS,
+        min_ngram: int = PROMPT_LOOKUP_MIN_NGRAM,
+        max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM,
+    ):
+        self.num_draft_tokens = num_draft_tokens
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+
+    def draft(self, seq, limit: int) -> List[int]:
+        tokens = seq.prompt_ids + seq.generated
+        if seq.draft_state is None:
+            seq.draft_state = _NgramIndex(self.min_ngram, self.max_ngram)
+        index: _NgramIndex = seq.draft_state
+        index.update(tokens)
+
+        count = min(self.num_draft_tokens, limit)
+        for n in reversed(index.sizes):
+            if len(tokens) < n:
+                continue
+            start = index.positions[n].get(tuple(tokens[-n:]))
+            if start is not None:
+                return tokens[start:start + count]
+        return []
+
+
+class _DraftState:
+    def __init__(self):
+        self.cache = DynamicCache()
+        # Token ids whose KV is in `cache`
+        self.tokens: List[int] = []
+
+
+class DraftModelDrafter:
+    """
+    Drafts greedily with a small model that shares the main model's tokenizer.
+    Its KV cache follows the sequence: after each step it is cut back to the
+    part that still matches the accepted tokens.
+    """
+
+    name = "draft_model"
+
+    def __init__(self, model, num_draft_tokens: int = 4):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.vocab_size = model.get_input_embeddings().num_embeddings
+        self.device = next(model.parameters()).device
+        self._accepts_logits_to_keep = "logits_to_keep" in inspect.signature(model.forward).parameters
+
+    def draft(self, seq, limit: int) -> List[int]:
+        tokens = seq.prompt_ids + seq.generated
+        if seq.draft_state is None:
+            seq.draft_state = _DraftState()
+        state: _DraftState = seq.draft_state
+
+        common = 0
+        for cached, current in zip(state.tokens, tokens):
+            if cached != current:
+                break
+            common += 1
+        common = min(common, len(tokens) - 1)  # the last token is fed again to get its logits
+        if common < len(state.tokens):
+            # A negative crop removes that many tokens; it also empties the cache when nothing is shared
+            state.cache.crop(common - len(state.tokens))
+            state.tokens = state.tokens[:common]
+
+        drafts = []
+        feed = tokens[common:]
+        for _ in range(min(self.num_draft_tokens, limit)):
+            input_ids = torch.tensor([feed], device=self.device)
+            # Image placeholders and other ids the draft model does not know become token 0
+            input_ids = input_ids.masked_fill(input_ids >= self.vocab_size, 0)
+            kwargs = {"logits_to_keep": 1} if self._accepts_logits_to_keep else {}
+            outputs = self.model(input_ids=input_ids, past_key_values=state.cache, use_cache=True, **kwargs)
+            state.tokens.extend(feed)
+            token = int(torch.argmax(outputs.logits[0, -1]))
+            drafts.append(token)
+            feed = [token]
+        return drafts
+
+
+def verify_draft(
+    logits: torch.Tensor, draft: List[int], distribution, generator: Optional[torch.Generator] = None
+) -> Tuple[List[int], int]:
+    """
+    Checks `draft` against the main model's logits for every draft position plus
+    one, returning the tokens to emit and how many draft tokens were accepted.
+
+    `distribution(row)` gives the request's sampling probabilities, or None for
+    greedy decoding. Greedy requests keep draft tokens that equal the argmax.
+    Sampled requests accept each draft token with probability p(token) and, on
+    rejection, sample from p with that token removed. Because the drafts are
+    deterministic proposals, this leaves the output distribution exactly that
+    of normal sampling. Random draws come from `generator` when given.
+    """
+    tokens = []
+    for i, proposed in enumerate(draft):
+        probs = distribution(logits[i])
+        if probs is None:
+            best = int(torch.argmax(logits[i]))
+            tokens.append(best)
+            if best != proposed:
+                return tokens, i
+            continue
+        probs = probs / probs.sum()  # top-p filtering leaves the kept mass unnormalised
+        if float(torch.rand((), generator=generator, device=probs.device)) < float(probs[proposed]):
+            tokens.append(proposed)
+            continue
+        residual = probs.clone()
+        residual[proposed] = 0.0
+        tokens.append(int(torch.multinomial(residual, 1, generator=generator)))
+        return tokens, i
+
+    probs = distribution(logits[len(draft)])
+    tokens.append(int(torch.argmax(logits[len(draft)])) if probs is None else int(torch.multinomial(probs, 1, generator=generator)))
+    return tokens, len(draft)
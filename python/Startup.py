@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from Log import get_logger
+
+log = get_logger(__name__)
+
+
+class ServiceUnavailable(Exception):
+    """Raised while the loaded component is not ready (still loading, warming up, or failed)."""
+
+    def __init__(self, status: Dict[str, Any]):
+        super().__init__(status.get("error") or f"service is {status['state']}")
+        self.status = status
+
+
+class BackgroundLoader:
+    """
+    Builds a slow component (the model) on a background thread so the server can
+    accept connections right away.
+
+    `load` runs on a daemon thread, so shutting down during a long load does not
+    wait for it. The optional async `warm_up` then runs once on the loaded value
+    before it is reported ready; a failed warm-up is logged but not fatal.
+    Requests call `wait`, which returns the value or raises `ServiceUnavailable`.
+    """
+
+    def __init__(self, load: Callable[[], Any], warm_up: Optional[Callable[[Any], Awaitable]] = None):
+        self.load = load
+        self.warm_up = warm_up
+        self.state = "pending"
+        self.value = None
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.warm_up_seconds: Optional[float] = None
+        self._started_at: Optional[float] = None
+        self._done: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Starts loading; call from the running event loop."""
+        self._started_at = time.perf_counter()
+        self._done = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        loaded = loop.create_future()
+
+        def target():
+            try:
+                value = self.load()
+            except BaseException as e:
+                log.exception("Loading failed")
+                loop.call_soon_threadsafe(loaded.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(loaded.set_result, value)
+
+        self.state = "loading"
+        threading.Thread(target=target, name="model-loader", daemon=True).start()
+        try:
+            value = await loaded
+        except Exception as e:
+            self.state = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            log.warning("Loading failed: %s", self.error)
+            self._done.set()
+            return
+        self.load_seconds = time.perf_counter() - self._started_at
+        log.info("Loaded in %.1fs", self.load_seconds)
+
+        if self.warm_up is not None:
+            self.state = "warming_up"
+            warm_up_started = time.perf_counter()
+            try:
+                await self.warm_up(value)
+            except Exception as e:
+                log.warning("Warm-up failed: %s", e)
+            self.warm_up_seconds = time.perf_counter() - warm_up_started
+            log.info("Warm-up took %.1fs", self.warm_up_seconds)
+
+        self.value = value
+        self.state = "ready"
+        self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    async def wait(self, timeout: float) -> Any:
+        """Waits up to `timeout` seconds for the value; raises `ServiceUnavailable` if it is not ready by then."""
+        if not self.ready and self._done is not None and self.state != "failed":
+            try:
+                await asyncio.wait_for(self._done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if not self.ready:
+            raise ServiceUnavailable(self.status())
+        return self.value
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "elapsed_s": time.perf_counter() - self._started_at if self._started_at is not None else 0.0,
+            "load_s": self.load_seconds,
+            "warm_up_s": self.warm_up_seconds,
+        }
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from Log import get_logger
+
+log = get_logger(__name__)
+
+# Budget for rendered message text and token ids
+TEMPLATE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+# The first prompts are also built the slow way and compared; any difference turns the cache off
+VERIFY_PROMPTS = 8
+
+# Stand-ins placed before a message so it renders as a later user or assistant turn
+_ANCHOR_USER = {"role": "user", "content": "."}
+_ANCHOR_ASSISTANT = {"role": "assistant", "content": "."}
+
+
+def _message_key(message: dict) -> str:
+    content = message.get("content")
+    if isinstance(content, str) and len(message) == 2:
+        # Plain text turns, the common case, skip the JSON encoding
+        encoded = f"{message.get('role')}\0{content}".encode("utf-8")
+    else:
+        encoded = json.dumps(message, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class ChatTemplateCache:
+    """
+    Builds prompt token ids from per-message pieces, so each turn of a chat is
+    rendered and tokenized once rather than on every request.
+
+    The prompt is split into a head (any system messages plus the first turn,
+    which templates often merge), one segment per later message and the
+    generation prompt. A later message's segment is what it adds when rendered
+    after fixed stand-in turns of the right alternation. Rendered text is cached
+    by message hash, token ids under the same keys. Segments start at the
+    template's turn markers (special tokens), so tokenizing them one by one gives
+    the same ids as tokenizing the whole prompt.
+
+    The first VERIFY_PROMPTS prompts are also rendered and tokenized whole and
+    compared; a template or tokenizer that does not split cleanly turns the
+    cache off and callers fall back to the full path.
+    """
+
+    def __init__(self, tokenizer, max_bytes: int = TEMPLATE_CACHE_MAX_BYTES, verify_prompts: int = VERIFY_PROMPTS):
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._render_checks_left = verify_prompts
+        self._encode_checks_left = verify_prompts
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, Tuple[object, int]]" = OrderedDict()
+        self._bytes = 0
+        try:
+            self._user_base = self._render([_ANCHOR_USER, _ANCHOR_ASSISTANT])
+            self._assistant_base = self._render([_ANCHOR_USER])
+            with_prompt = self._render([_ANCHOR_USER], add_generation_prompt=True)
+        except Exception as e:
+            log.warning("Chat template cannot be split per message (%s); caching off", e)
+            self.enabled = False
+            return
+        if not with_prompt.startswith(self._assistant_base):
+            self.enabled = False
+            return
+        self._generation_prompt = with_prompt[len(self._assistant_base):]
+
+    def _render(self, messages: List[dict], add_generation_prompt: bool = False) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt
+        )
+
+    def _get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key: tuple, value, size: int):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def render(self, messages: List[dict]) -> Optional[List[Tuple[tuple, str]]]:
+        """
+        The prompt as `(key, text)` segments (head, later messages, generation
+        prompt), or None when the cache is off. The keys let `encode` find the
+        segments' token ids without hashing the text again.
+        """
+        if not self.enabled:
+            return None
+        head_end = next((i + 1 for i, message in enumerate(messages) if message.get("role") != "system"), len(messages))
+        head = messages[:head_end]
+        head_key = ("head",) + tuple(_message_key(message) for message in head)
+        head_text = self._get(head_key)
+        if head_text is None:
+            head_text = self._render(head)
+            self._put(head_key, head_text, len(head_text))
+        segments = [(head_key, head_text)]
+
+        for message in messages[head_end:]:
+            role = message.get("role")
+            if role not in ("user", "assistant"):
+                return None
+            key = (role, _message_key(message))
+            text = self._get(key)
+            if text is None:
+                if role == "user":
+                    base, window = self._user_base, [_ANCHOR_USER, _ANCHOR_ASSISTANT, message]
+                else:
+                    base, window = self._assistant_base, [_ANCHOR_USER, message]
+                rendered = self._render(window)
+                if not rendered.startswith(base):
+                    self._disable("a message does not render as an addition to the turns before it")
+                    return None
+                text = rendered[len(base):]
+                self._put(key, text, len(text))
+            segments.append((key, text))
+        segments.append((("generation_prompt",), self._generation_prompt))
+
+        if self._render_checks_left > 0:
+            self._render_checks_left -= 1
+            if "".join(text for _, text in segments) != self._render(messages, add_generation_prompt=True):
+                self._disable("per-message rendering differs from the full template")
+                return None
+        return segments
+
+    def encode(self, segments: List[Tuple[tuple, str]], image_placeholder: Optional[Tuple[str, str]] = None) -> List[int]:
+        """
+        Token ids of the rendered segments. `image_placeholder` is a `(token, expansion)`
+        pair replaced in the text before tokenizing, as the processor does for images.
+        """
+        ids: List[int] = []
+        for index, (segment_key, text) in enumerate(segments):
+            head = index == 0
+            key = ("ids", image_placeholder is not None) + segment_key
+            segment_ids = self._get(key)
+            if segment_ids is None:
+                expanded = text.replace(*image_placeholder) if image_placeholder else text
+                # Special tokens (BOS) are added once, to the head
+                encoded = self.tokenizer.encode(expanded) if head else self.tokenizer.encode(expanded, add_special_tokens=False)
+                segment_ids = array("l", encoded)
+                self._put(key, segment_ids, segment_ids.itemsize * len(segment_ids))
+            ids.extend(segment_ids)
+
+        if self._encode_checks_left > 0:
+            self._encode_checks_left -= 1
+            text = "".join(text for _, text in segments)
+            expected = list(self.tokenizer.encode(text.replace(*image_placeholder) if image_placeholder else text))
+            if ids != expected:
+                self._disable("per-segment tokenization differs from tokenizing the whole prompt")
+                return expected
+        return ids
+
+    def _disable(self, reason: str):
+        log.warning("Chat template cache: %s; caching off", reason)
+        self.enabled = False
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "enabled": int(self.enabled),
+                "entries": len(self._entries),
+                "bytes_held": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,7 +1,12 @@
 import json
+import hashlib
 from typing import List, Dict, Any
-import os
+from functools import lru_cache
 from pathlib import Path
+from FileCache import FileContentCache
+from Log import get_logger, preview
+
+log = get_logger(__name__)
 
 def reassemble_objects(chunks: List[str]) -> List[Dict[str, Any]]:
     """
@@ -23,95 +28,94 @@ def reassemble_objects(chunks: List[str]) -> List[Dict[str, Any]]:
             message = json.loads(chunk)
             messages.append(message)
         except json.JSONDecodeError as e:
-            print(f"Error decoding JSON chunk {i}: {e} - Chunk content: {chunk[:200]}...") # Log partial chunk for debugging
+            log.warning("Error decoding JSON chunk %d (%d chars): %s", i, len(chunk), e)
+            # The chunk is chat content; only a short preview, and only when debugging
+            log.debug("Chunk %d starts with: %s", i, preview(chunk))
             raise # Re-raise the exception to indicate a parsing failure
 
-    print(f"Reassembled messages: {messages}")
     return messages
 
 
+def text_checksum(text: str) -> str:
+    """SHA-256 hex digest of the UTF-8 encoded text, used to verify reassembled streams."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def read_text_files_from_folder(folder_path: str):
-    folder_content = []
-    supported_extensions = [
-        ".txt",
-        ".md",
-        ".py",
-        ".js",
-        ".ts",
-        ".tsx",
-        ".html",
-        ".css",
-        ".json",
-        ".xml",
-        ".yaml",
-        ".yml",
-        ".csv",
-    ]  # Extend as needed
+
+SUPPORTED_EXTENSIONS = [
+    ".txt",
+    ".md",
+    ".py",
+    ".js",
+    ".ts",
+    ".tsx",
+    ".html",
+    ".css",
+    ".json",
+    ".xml",
+    ".yaml",
+    ".yml",
+    ".csv",
+]  # Extend as needed
+
+# Shared across requests so unchanged attached files are served from memory
+file_cache = FileContentCache()
+
+
+@lru_cache(maxsize=1)
+def get_project_root() -> Path:
     script_dir = Path(__file__).parent
-    project_root = None
     # Attempt to find the project root by looking for common project files in parent directories
     for parent in script_dir.parents:
         if (parent / "package.json").exists() or (
             parent / "implementation_plan.md"
         ).exists():
-            project_root = parent
-            break
-    if project_root is None:
-        # Fallback: if project root cannot be determined, use the directory where ai_server.py is located.
-        # This might not be ideal but ensures a base path.
-        project_root = script_dir
-        print(
-            f"Warning: Could not determine project root. Using script directory as base: {project_root}"
-        )
-    else:
-        print(f"Determined project root: {project_root}")
+            log.info("Determined project root: %s", parent)
+            return parent
+    # Fallback: if project root cannot be determined, use the directory where ai_server.py is located.
+    # This might not be ideal but ensures a base path.
+    log.warning("Could not determine project root. Using script directory as base: %s", script_dir)
+    return script_dir
+
+
+def iter_text_files_from_folder(folder_path: str):
+    """
+    Yields `{"name", "content"}` for every supported file under the folder as soon as
+    it has been read (in no particular order). Contents come from `file_cache`.
+    """
     # Resolve the provided folder_path relative to the determined project root
-    final_folder_path = project_root / folder_path
-    print(f"Attempting to read from resolved folder path: {final_folder_path}")
+    final_folder_path = get_project_root() / folder_path
     if not final_folder_path.is_dir():
-        print(
-            f"Provided path is not a valid directory or does not exist: {final_folder_path}"
-        )
-        return folder_content
-    for root, _, files in os.walk(final_folder_path):
-        for file_name in files:
-            file_extension = Path(file_name).suffix.lower()
-            if file_extension in supported_extensions:
-                file_path = Path(root) / file_name
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                        # Store file name relative to the resolved folder path for better context in AI response
-                        relative_file_name = file_path.relative_to(final_folder_path)
-                        folder_content.append(
-                            {"name": str(relative_file_name), "content": content}
-                        )
-                except Exception as e:
-                    print(f"Error reading file {file_path}: {e}")
-    return folder_content
+        log.warning("Provided path is not a valid directory or does not exist: %s", final_folder_path)
+        return
+    for file_path, content, error in file_cache.iter_folder(final_folder_path, SUPPORTED_EXTENSIONS):
+        if error is not None:
+            log.warning("Error reading file %s: %s", file_path, error)
+            continue
+        # Store file name relative to the resolved folder path for better context in AI response
+        relative_file_name = file_path.relative_to(final_folder_path)
+        yield {"name": str(relative_file_name), "path": str(file_path), "content": content}
+
+
+def read_text_files_from_folder(folder_path: str):
+    # Sorted so the prompt (and its cached prefix) is identical while the folder is unchanged
+    return sorted(iter_text_files_from_folder(folder_path), key=lambda file_data: file_data["name"])
 
 
 def read_single_text_file(file_path_str: str):
-    supported_extensions = [
-        ".txt", ".md", ".py", ".js", ".ts", ".tsx", ".html", ".css", ".json",
-        ".xml", ".yaml", ".yml", ".csv",
-    ]
     file_path = Path(file_path_str)
     
     if not file_path.is_file():
-        print(f"Provided path is not a valid file or does not exist: {file_path}")
+        log.warning("Provided path is not a valid file or does not exist: %s", file_path)
         return None
 
     file_extension = file_path.suffix.lower()
-    if file_extension not in supported_extensions:
-        print(f"Skipping unsupported file type: {file_path}")
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        log.info("Skipping unsupported file type: %s", file_path)
         return None
 
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-            return {"name": str(file_path), "content": content}
+        content = file_cache.read(file_path)
+        return {"name": str(file_path), "path": str(file_path.resolve()), "content": content}
     except Exception as e:
-        print(f"Error reading file {file_path}: {e}")
+        log.warning("Error reading file %s: %s", file_path, e)
         return None
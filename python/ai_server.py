@@ -1,11 +1,28 @@
+import os
 import uvicorn
 import starlette.formparsers
 import starlette.requests
 from pathlib import Path
-from Inference import InferenceService
-from ServerUtils import process_history, process_paths_in_messages, load_image_from_path
-from fastapi import FastAPI, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from typing import TYPE_CHECKING
+from Persistence import MessageWriter
+from ContextAssembly import ContextAssembler
+from ServerUtils import iter_ndjson, process_history, process_paths_in_messages, resolve_image_path, validate_message
+from Conversations import ConversationStore, VersionConflict
+from ResponseCache import CACHE_MODES
+from Profiles import parse_sampling
+from fastapi import FastAPI, Form, Query, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from Metrics import metrics, flatten_gauges
+from Utils import file_cache
+from Startup import BackgroundLoader, ServiceUnavailable
+from Admission import AdmissionController, AdmissionRejected, PRIORITIES, client_address
+from Generations import GenerationRegistry, GenerationNotFound
+import Log
+from Log import get_logger, set_request_id
+
+if TYPE_CHECKING:
+    # Imported by the background loader; pulling in torch/transformers here would delay binding the port
+    from Inference import InferenceService
 
 
 # Increase the maximum part size for multipart form data
@@ -22,13 +39,76 @@ if starlette.requests.Request.form.__kwdefaults__:
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
-inference_service: InferenceService = None
+log = get_logger(__name__)
+
+inference_service: "InferenceService" = None
+message_writer: MessageWriter = None
+context_assembler: ContextAssembler = None
+
+# On-disk chunk index for attached files (offsets and term stats only, no file text)
+CONTEXT_INDEX_PATH = Path(
+    os.environ.get("OPENMED_CONTEXT_INDEX", Path.home() / ".cache" / "open-med-ai" / "context_index.sqlite3")
+)
+# Set to run on the deterministic CPU stub model instead of Med Gemma (benchmarks, local testing)
+USE_STUB_MODEL = bool(os.environ.get("OPENMED_STUB_MODEL"))
+# Short generation run after loading so first-request kernel setup happens before the server reports ready
+WARM_UP = os.environ.get("OPENMED_WARM_UP", "1") != "0"
+WARM_UP_TOKENS = 8
+# How long a request that arrives while the model is loading waits before getting a 503
+READY_WAIT_SECONDS = float(os.environ.get("OPENMED_READY_WAIT", "30"))
+RETRY_AFTER_SECONDS = 5
+
+
+def create_inference_service() -> "InferenceService":
+    if USE_STUB_MODEL:
+        from benchmarks.stub_model import stub_service_from_env
+        return stub_service_from_env()
+    from Inference import InferenceService
+    return InferenceService()
+
+
+def load_components() -> "InferenceService":
+    """Runs on the loader thread: the model and everything that needs its tokenizer."""
+    global inference_service, context_assembler
+    service = create_inference_service()
+    context_assembler = ContextAssembler(CONTEXT_INDEX_PATH, tokenizer=service.processor.tokenizer)
+    inference_service = service
+    return service
+
+
+async def warm_up(service: "InferenceService"):
+    async for event in service.generate(messages=[{"role": "user", "content": "Hello"}], max_new_tokens=WARM_UP_TOKENS):
+        if event["type"] == "error":
+            raise RuntimeError(event["message"])
+
+
+service_loader = BackgroundLoader(load_components, warm_up=warm_up if WARM_UP else None)
+# Bounds how many generations run at once, per client and overall
+admission = AdmissionController()
+# Per-chat history for clients that send only new turns
+conversations = ConversationStore()
+# Running and recently finished generations, readable by any client that reattaches
+generations = GenerationRegistry()
+
+
+def unavailable_response(status: dict) -> JSONResponse:
+    headers = {} if status["state"] == "failed" else {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    message = f"Model failed to load: {status['error']}" if status["state"] == "failed" else "Model is still loading."
+    return JSONResponse(content={**status, "error": message}, status_code=503, headers=headers)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global inference_service
-    inference_service = InferenceService()
+    global message_writer
+    # One pooled client and background writer for every stream's DB updates
+    message_writer = MessageWriter(RUST_SERVER_URL)
+    message_writer.start()
+    # The model loads in the background; the port answers (and /health/live passes) right away
+    service_loader.start()
     yield
+    await generations.close()
+    await service_loader.close()
+    await message_writer.close()
 
 app = FastAPI(title="MedGemma API", lifespan=lifespan)
 
@@ -41,115 +121,386 @@ app.add_middleware(
 )
 
 
+class RequestIdMiddleware:
+    """
+    Tags every log line written while handling a request with its id: the client's
+    X-Request-ID header when present, otherwise a new one. The id is echoed in the
+    response headers. Plain ASGI, so streamed responses pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        set_request_id(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+app.add_middleware(RequestIdMiddleware)
+
+
 @app.get("/")
 async def root():
     return {"message": "MedGemma API is running."}
 
 
-import httpx
+@app.get("/health/live")
+async def health_live():
+    """The process is up and serving requests."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """200 once the model is loaded and warmed up; 503 with the loading state before that."""
+    status = service_loader.status()
+    if not service_loader.ready:
+        return unavailable_response(status)
+    return {"status": "ready", **status}
+
+
+def component_stats() -> dict:
+    return {
+        "startup": service_loader.status(),
+        "inference": inference_service.stats() if inference_service is not None else None,
+        "admission": admission.stats(),
+        "conversations": conversations.stats(),
+        "generations": generations.stats(),
+        "persistence": message_writer.stats(),
+        "file_cache": file_cache.stats(),
+        "logging": Log.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of latency histograms, counters and cache gauges."""
+    return PlainTextResponse(
+        metrics.prometheus_text(flatten_gauges(component_stats())),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/stats")
+async def stats_endpoint():
+    """JSON summary with p50/p95/p99 of recent generations and component stats."""
+    return {**metrics.snapshot(), **component_stats()}
+
+
 import json
 import asyncio
+import time
+import uuid
 
-RUST_SERVER_URL = "http://127.0.0.1:8001/db"
+RUST_SERVER_URL = os.environ.get("OPENMED_DB_URL", "http://127.0.0.1:8001/db")
+STREAM_MODES = ("full", "delta")
+SYNC_MODES = ("append", "full")
 
-@app.post("/generate")
-async def generate_endpoint(
-    history: list[str] = Form(...), 
-    image_path: str = Form(None),
-    chat_id: int = Form(...)
-):
+def error_response(message: str, status_code: int = 400, **extra) -> JSONResponse:
+    return JSONResponse(content={"error": message, **extra}, status_code=status_code)
+
+
+def check_options(stream_mode: str, priority: str, cache: str = "auto", seed=None):
+    if stream_mode not in STREAM_MODES:
+        return error_response(f"Unknown stream_mode '{stream_mode}'.")
+    if priority not in PRIORITIES:
+        return error_response(f"Unknown priority '{priority}'.")
+    if cache not in CACHE_MODES:
+        return error_response(f"Unknown cache mode '{cache}'.")
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        return error_response("seed must be an integer.")
+    return None
+
+
+async def admit(request: Request, priority: str):
+    """Waits for the model and a generation slot; returns the admission ticket or an error response."""
     try:
-        # Reassemble history from chunks
-        try:
-            messages = process_history(history)
-        except ValueError as e:
-            return JSONResponse(content={"error": str(e)}, status_code=400)
+        await service_loader.wait(READY_WAIT_SECONDS)
+    except ServiceUnavailable as e:
+        return unavailable_response(e.status)
 
-        # Process file/directory paths within user messages
-        process_paths_in_messages(messages)
+    try:
+        # Behind Router.py the caller's address arrives in X-Forwarded-For
+        return await admission.acquire(client_address(request), priority)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            content={"error": str(e), "reason": e.reason},
+            status_code=e.status_code,
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
-        # Load image if provided
-        try:
-            final_image_base64 = load_image_from_path(image_path)
-        except RuntimeError as e:
-            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+async def stream_generation(
+    ticket, messages: list, image_path: str, chat_id: int, stream_mode: str, on_complete=None, generation_options=None
+):
+    """
+    Starts the generation for an admitted request and returns the SSE response.
+    The generation runs in the registry rather than in the response: a client
+    that disconnects can reattach at /generations/{id}/stream, and the answer is
+    still saved. The ticket is released when the generation ends.
+    `on_complete(text)` may return extra fields for the `complete` event;
+    `generation_options` are passed on to `InferenceService.generate` (`seed`,
+    `cache` and sampling overrides).
+    """
+    started = False
+    try:
+        # Process file/directory paths within user messages (off the event loop: disk I/O and tokenizing)
+        await asyncio.to_thread(
+            process_paths_in_messages, messages, context_assembler, inference_service.profile.attachment_token_budget
+        )
+
+        # The image is passed by path; decoding happens (once per content) in the inference service
+        image = resolve_image_path(image_path)
 
         # Generate response using InferenceService
-        generator = inference_service.generate(messages=messages, image_base64=final_image_base64)
+        generation_id = str(uuid.uuid4())
+        generator = inference_service.generate(
+            messages=messages, image=image, generation_id=generation_id, chat_id=chat_id, **(generation_options or {})
+        )
 
-        async def stream_response():
+        async def produce():
             full_text = ""
-            last_saved_text = ""
-            message_id = None
-            save_threshold = 150 # Save every 150 characters
+            # Identifies this answer in the persistence writer
+            message_key = str(uuid.uuid4())
 
             try:
-                print("Generating response...")
-                async for chunk in generator:
-                    yield f"data: {chunk}\n\n"
+                log.info("Streaming generation %s for chat %s", generation_id, chat_id)
+                async for event in generator:
+                    if event["type"] == "delta":
+                        full_text += event["text"]
+                    elif event["type"] == "complete":
+                        full_text = event["text"]
+                        if on_complete is not None:
+                            event = {**event, **on_complete(full_text)}
+                    yield event
 
-                    try:
-                        data = json.loads(chunk)
-                        # We look for "text" in the update
-                        if "text" in data:
-                            full_text = data["text"]
-
-                            # Check if we should save to DB
-                            if len(full_text) - len(last_saved_text) >= save_threshold:
-                                async with httpx.AsyncClient() as client:
-                                    if message_id is None:
-                                        print("Creating message entry " + full_text)
-                                        # Create the message entry
-                                        res = await client.post(
-                                            f"{RUST_SERVER_URL}/chats/{chat_id}/messages",
-                                            json={"role": "assistant", "content": full_text}
-                                        )
-                                        if res.status_code == 201:
-                                            message_id = res.json()
-                                            last_saved_text = full_text
-                                    else:
-                                        # Update existing message entry
-                                        await client.patch(
-                                            f"{RUST_SERVER_URL}/messages/{message_id}",
-                                            json={"content": full_text}
-                                        )
-                                        last_saved_text = full_text
-                    except (json.JSONDecodeError, KeyError, Exception) as e:
-                        # Non-text chunks or errors are ignored for DB persistence
-                        print("Non-text chunk or error: " + str(e))
-            except Exception as e:
-                print(f"Error in stream_response: {e}")
+                    if event["type"] != "error" and full_text:
+                        # Hands the text to the background writer; never waits on the DB
+                        await message_writer.update(message_key, chat_id, full_text)
             finally:
-                # Final save if there's any unsaved content
-                if full_text and full_text != last_saved_text:
-                    print("Final save triggering...")
+                # Runs the generator's cleanup (metrics trace) now rather than at garbage collection
+                await generator.aclose()
+                admission.release(ticket)
+                if full_text:
                     try:
-                        async def final_save():
-                            async with httpx.AsyncClient() as client:
-                                if message_id is None:
-                                    await client.post(
-                                        f"{RUST_SERVER_URL}/chats/{chat_id}/messages",
-                                        json={"role": "assistant", "content": full_text}
-                                    )
-                                else:
-                                    await client.patch(
-                                        f"{RUST_SERVER_URL}/messages/{message_id}",
-                                        json={"content": full_text}
-                                    )
-                        # Shield the saving process so it finishes even if the request task is cancelled
-                        await asyncio.shield(final_save())
-                        print("Final save completed.")
+                        # Shield the final save so it finishes even if the generation is cancelled
+                        persist_started = time.perf_counter()
+                        await asyncio.shield(message_writer.finish(message_key, chat_id, full_text))
+                        metrics.observe("persist_final_seconds", time.perf_counter() - persist_started, "Wait for the final save of an answer.")
                     except Exception as e:
-                        print(f"Final save failed: {e}")
+                        log.warning("Final save of chat %s failed: %s", chat_id, e)
 
-        return StreamingResponse(stream_response(), media_type="text/event-stream")
+        generations.start(generation_id, produce(), cancel=lambda: inference_service.cancel_generation(generation_id))
+        started = True
+        return sse_response(generations.stream(generation_id), stream_mode)
     except Exception as e:
-        print(f"Unhandled exception in generate_endpoint: {e}")
-        return JSONResponse(content={"error": f"Internal server error: {e}"}, status_code=500)
+        log.exception("Unhandled exception in generate_endpoint: %s", e)
+        return error_response(f"Internal server error: {e}", 500)
+    finally:
+        if not started:
+            admission.release(ticket)
+
+
+def sse_response(events, stream_mode: str) -> StreamingResponse:
+    """
+    Formats a generation's events as SSE. In `"full"` mode deltas (and replay
+    snapshots) become `update` events carrying the whole text so far.
+    """
+
+    async def stream_response():
+        full_text = ""
+        async for event in events:
+            if stream_mode == "full":
+                if event["type"] == "delta":
+                    full_text += event["text"]
+                    event = {"type": "update", "text": full_text, "generation_id": event["generation_id"]}
+                elif event["type"] == "snapshot":
+                    full_text = event["text"]
+                    event = {"type": "update", "text": full_text, "generation_id": event["generation_id"]}
+            yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(stream_response(), media_type="text/event-stream")
+
+
+@app.post("/generate")
+async def generate_endpoint(
+    request: Request,
+    history: list[str] = Form(...), 
+    image_path: str = Form(None),
+    chat_id: int = Form(...),
+    stream_mode: str = Form("full"),
+    priority: str = Form("interactive"),
+    seed: int = Form(None),
+    cache: str = Form("auto"),
+    max_new_tokens: int = Form(None),
+    do_sample: bool = Form(None),
+    temperature: float = Form(None),
+    top_p: float = Form(None),
+):
+    """
+    Streams the answer as SSE events. `stream_mode="delta"` sends only the new text
+    per event (with `seq` numbers and a final checksummed `complete` event);
+    `"full"` keeps the legacy `update` events carrying the whole text so far.
+
+    Requests wait for a generation slot by `priority` ("interactive" before
+    "batch"); each caller address is subject to a per-client cap. Overload is answered with 429/503 and Retry-After.
+
+    `seed` makes sampling reproducible. When the server runs with the response
+    cache, `cache="auto"` reuses and stores answers of seeded requests only,
+    `"allow"` also those of unseeded sampled requests, and `"off"` bypasses it.
+    `max_new_tokens`, `do_sample`, `temperature` and `top_p` override the engine
+    profile's defaults.
+    """
+    error = check_options(stream_mode, priority, cache, seed)
+    if error is not None:
+        return error
+    try:
+        sampling = parse_sampling(max_new_tokens, do_sample, temperature, top_p)
+    except ValueError as e:
+        return error_response(str(e))
+
+    # Reassemble history from chunks
+    parse_started = time.perf_counter()
+    try:
+        messages = process_history(history)
+    except ValueError as e:
+        return error_response(str(e))
+    metrics.observe("history_parse_seconds", time.perf_counter() - parse_started, "Time to parse the history sent with a request.")
+
+    ticket = await admit(request, priority)
+    if isinstance(ticket, JSONResponse):
+        return ticket
+    return await stream_generation(
+        ticket, messages, image_path, chat_id, stream_mode, generation_options={"seed": seed, "cache": cache, **sampling}
+    )
+
+
+@app.post("/chats/{chat_id}/generate")
+async def generate_turn_endpoint(chat_id: int, request: Request):
+    """
+    Incremental form of /generate: the server keeps each chat's history, so the
+    body only carries new messages. The body is NDJSON, parsed as it arrives:
+
+        {"sync": "append", "base_version": "<version>", "stream_mode": "delta", "image_path": null, ...}
+        {"role": "user", "content": "..."}
+
+    The first line holds the options (`sync`, `base_version`, `stream_mode`,
+    `image_path`, `priority`, `seed`, `cache` and the sampling
+    overrides of /generate); every further line is a message.
+    With `"sync": "append"` the messages are added to the chat if it is still at
+    `base_version`; otherwise the reply is 409 with the server's
+    `current_version`, and the client should resend the whole history with
+    `"sync": "full"`. The `complete` event carries the chat's new `version`,
+    which includes the answer.
+    """
+    parse_started = time.perf_counter()
+    lines = iter_ndjson(request.stream())
+    try:
+        options = await lines.__anext__()
+    except StopAsyncIteration:
+        return error_response("Empty request body.")
+    except ValueError as e:
+        return error_response(str(e))
+
+    sync = options.get("sync", "append")
+    stream_mode = options.get("stream_mode", "delta")
+    priority = options.get("priority", "interactive")
+    base_version = options.get("base_version")
+    generation_options = {"seed": options.get("seed"), "cache": options.get("cache", "auto")}
+    if sync not in SYNC_MODES:
+        return error_response(f"Unknown sync mode '{sync}'.")
+    error = check_options(stream_mode, priority, generation_options["cache"], generation_options["seed"])
+    if error is not None:
+        return error
+    try:
+        generation_options.update(
+            parse_sampling(options.get("max_new_tokens"), options.get("do_sample"), options.get("temperature"), options.get("top_p"))
+        )
+    except ValueError as e:
+        return error_response(str(e))
+    if sync == "append" and conversations.version(chat_id) != base_version:
+        # Rejected before the messages are read
+        return error_response("Conversation version mismatch.", 409, current_version=conversations.version(chat_id))
+
+    try:
+        new_messages = []
+        async for message in lines:
+            validate_message(message)
+            new_messages.append(message)
+    except ValueError as e:
+        return error_response(str(e))
+    metrics.observe("history_parse_seconds", time.perf_counter() - parse_started, "Time to parse the history sent with a request.")
+
+    ticket = await admit(request, priority)
+    if isinstance(ticket, JSONResponse):
+        return ticket
+
+    try:
+        if sync == "full":
+            version = conversations.replace(chat_id, new_messages)
+        else:
+            version = conversations.append(chat_id, base_version, new_messages)
+    except VersionConflict as e:
+        admission.release(ticket)
+        return error_response("Conversation version mismatch.", 409, current_version=e.current_version)
+
+    def record_answer(text: str) -> dict:
+        try:
+            return {"version": conversations.append(chat_id, version, [{"role": "assistant", "content": text}])}
+        except VersionConflict:
+            # The chat changed while this answer was generated; the client will need a full sync
+            return {"version": None}
+
+    return await stream_generation(
+        ticket,
+        conversations.snapshot(chat_id),
+        options.get("image_path"),
+        chat_id,
+        stream_mode,
+        on_complete=record_answer,
+        generation_options=generation_options,
+    )
+
+@app.get("/generations/{generation_id}")
+async def generation_status_endpoint(generation_id: str):
+    """Whether a generation is still running and the seq of its last event."""
+    try:
+        return generations.status(generation_id)
+    except GenerationNotFound:
+        return error_response(f"Generation {generation_id} not found.", 404)
+
+
+@app.get("/generations/{generation_id}/stream")
+async def generation_stream_endpoint(generation_id: str, from_seq: int = Query(0, alias="from"), stream_mode: str = "delta"):
+    """
+    Reattaches to a generation: replays its events from seq `from` (0 includes
+    the `start` event) and continues live. When `from` is older than the replay
+    buffer, a `snapshot` event with the whole text up to its `seq` comes first;
+    in `"full"` mode the text before `from` always comes first.
+    Finished generations can be read for a while after their last client left.
+    """
+    if stream_mode not in STREAM_MODES:
+        return error_response(f"Unknown stream_mode '{stream_mode}'.")
+    try:
+        events = generations.stream(generation_id, from_seq, reattach=True, snapshot=stream_mode == "full")
+    except GenerationNotFound:
+        return error_response(f"Generation {generation_id} not found.", 404)
+    log.info("Reattached to generation %s from seq %d", generation_id, from_seq)
+    return sse_response(events, stream_mode)
+
 
 @app.post("/cancel")
 async def cancel_generation_endpoint(generation_id: str = Form(...)):
-    if inference_service.cancel_generation(generation_id):
+    if inference_service is not None and inference_service.cancel_generation(generation_id):
         return {"message": f"Generation {generation_id} cancelled successfully."}
     else:
         return JSONResponse(content={"message": f"Generation {generation_id} not found or already finished."}, status_code=404)
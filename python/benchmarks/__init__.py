@@ -0,0 +1 @@
+"""Load benchmarks for the inference server, runnable without the Med Gemma weights."""
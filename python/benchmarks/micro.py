@@ -0,0 +1,171 @@
+"""
+Micro-benchmarks for the per-request and per-token text paths, old against new.
+
+- detokenize: turning each generated token into text. The old way decodes the
+  whole answer after every token; IncrementalDetokenizer decodes a short window.
+- prompt: building the token ids of a growing chat before each turn. The old way
+  renders the chat template over the whole history and tokenizes the result;
+  ChatTemplateCache renders and tokenizes only the new turns.
+- logging: the log output of one request with an image and a large attached
+  file. The old way printed the whole message list to stdout; Log writes short
+  lines from a background thread and shows contents only at DEBUG.
+
+Both run on the stub tokenizer by default; --tokenizer takes a Hugging Face
+tokenizer name or path (e.g. the model's) for realistic numbers. The stub's
+chat template is a plain string join, so on it the prompt numbers only show
+the cache's own overhead.
+
+Run from the python/ directory:
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --tokenizer google/medgemma-1.5-4b-it --answer-tokens 2000 --turns 40
+"""
+
+import argparse
+import contextlib
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+if str(PYTHON_DIR) not in sys.path:
+    sys.path.insert(0, str(PYTHON_DIR))
+
+import Log  # noqa: E402
+from Detokenizer import IncrementalDetokenizer  # noqa: E402
+from TemplateCache import ChatTemplateCache  # noqa: E402
+from benchmarks.run import WORDS  # noqa: E402
+from benchmarks.stub_model import ANSWER_TOKEN_BASE, StubTokenizer  # noqa: E402
+
+
+def load_tokenizer(name):
+    if not name:
+        return StubTokenizer()
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name)
+
+
+def answer_ids(tokenizer, count: int, rng: random.Random):
+    if isinstance(tokenizer, StubTokenizer):
+        return [ANSWER_TOKEN_BASE + i for i in range(count)]
+    ids = []
+    while len(ids) < count:
+        ids.extend(tokenizer.encode(" ".join(rng.choice(WORDS) for _ in range(64)), add_special_tokens=False))
+    return ids[:count]
+
+
+def bench_detokenize(tokenizer, ids):
+    started = time.perf_counter()
+    printed = 0
+    for end in range(1, len(ids) + 1):
+        text = tokenizer.decode(ids[:end], skip_special_tokens=True)
+        if not text.endswith("�") and len(text) > printed:
+            printed = len(text)
+    full_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    for token in ids:
+        detokenizer.push(token)
+    incremental_s = time.perf_counter() - started
+    return full_s, incremental_s
+
+
+def bench_prompt(tokenizer, turns: int, turn_words: int, rng: random.Random):
+    def text(words):
+        return " ".join(rng.choice(WORDS) for _ in range(words))
+
+    history = [{"role": "system", "content": "You are a careful medical assistant."}]
+    for _ in range(turns):
+        history.append({"role": "user", "content": text(turn_words)})
+        history.append({"role": "assistant", "content": text(turn_words)})
+
+    cache = ChatTemplateCache(tokenizer, verify_prompts=0)
+    full_s = cached_s = 0.0
+    for end in range(2, len(history) + 1, 2):
+        messages = history[:end]
+        started = time.perf_counter()
+        prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        expected = list(tokenizer.encode(prompt))
+        full_s += time.perf_counter() - started
+
+        started = time.perf_counter()
+        ids = cache.encode(cache.render(messages))
+        cached_s += time.perf_counter() - started
+        if ids != expected:
+            raise SystemExit("ChatTemplateCache produced different token ids than the full path.")
+    return full_s / turns, cached_s / turns
+
+
+def bench_logging(attachment_kb: int, requests: int, rng: random.Random):
+    attachment = " ".join(rng.choice(WORDS) for _ in range(attachment_kb * 1024 // 7))[: attachment_kb * 1024]
+    messages = [
+        {"role": "user", "content": [{"type": "image"}, {"type": "text", "text": "What does the report say?"}]},
+        {"role": "user", "content": [{"type": "text", "text": f"\n--- File: report.txt ---\n{attachment}\n"}]},
+    ]
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as sink:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            for _ in range(requests):
+                # What a request used to print on its way through the server
+                print(f"Processing {len(messages)} messages")
+                print("Appended 1 files from paths to a user message.")
+                print(messages)
+                print("Generating response...")
+                print("InferenceService: Starting to iterate scheduler output...")
+                print("InferenceService: Finished iterating scheduler output.")
+            sink.flush()
+        print_s = time.perf_counter() - started
+
+        Log.configure(level="INFO", module_levels="", stream=sink)
+        log = Log.get_logger("benchmark")
+        started = time.perf_counter()
+        for request in range(requests):
+            Log.set_request_id(f"request-{request}")
+            log.debug("Processing %d messages", len(messages))
+            log.info("Appended %d files from paths to a user message.", 1)
+            log.debug("Attached the image to message %d of %d", 0, len(messages))
+            log.info("Streaming generation %s for chat %s", request, 1)
+            log.debug("Generation %s submitted: %d prompt tokens", request, 1000)
+            log.debug("Generation %s finished: %d tokens", request, 100)
+        log_s = time.perf_counter() - started
+        Log.flush()
+    return print_s / requests, log_s / requests
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer name or path; default: stub")
+    parser.add_argument("--answer-tokens", type=int, default=2000, help="tokens detokenized one by one")
+    parser.add_argument("--turns", type=int, default=40, help="user/assistant turns in the growing chat")
+    parser.add_argument("--turn-words", type=int, default=80, help="words per message")
+    parser.add_argument("--attachment-kb", type=int, default=2048, help="attached file size for the logging benchmark")
+    parser.add_argument("--log-requests", type=int, default=50, help="requests in the logging benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    tokenizer = load_tokenizer(args.tokenizer)
+
+    ids = answer_ids(tokenizer, args.answer_tokens, rng)
+    full_s, incremental_s = bench_detokenize(tokenizer, ids)
+    print(f"detokenize {len(ids)} tokens")
+    print(f"  full re-decode   {full_s / len(ids) * 1e6:9.1f} us/token")
+    print(f"  incremental      {incremental_s / len(ids) * 1e6:9.1f} us/token  ({full_s / incremental_s:.1f}x)")
+
+    full_s, cached_s = bench_prompt(tokenizer, args.turns, args.turn_words, rng)
+    print(f"prompt of a chat growing to {args.turns} turns")
+    print(f"  template + tokenize  {full_s * 1e3:9.3f} ms/request")
+    print(f"  template cache       {cached_s * 1e3:9.3f} ms/request  ({full_s / cached_s:.1f}x)")
+
+    print_s, log_s = bench_logging(args.attachment_kb, args.log_requests, rng)
+    print(f"logging of a request with a {args.attachment_kb} KB attachment")
+    print(f"  print()          {print_s * 1e3:9.3f} ms/request")
+    print(f"  Log              {log_s * 1e3:9.3f} ms/request  ({print_s / log_s:.0f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
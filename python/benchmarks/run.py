@@ -0,0 +1,462 @@
+"""
+Load benchmark for the /generate endpoint.
+
+Starts ai_server in a child process on the deterministic stub model, plus a
+stand-in for the Rust persistence server, then drives /generate with the
+configured concurrency, history length, attachments and image. With the stub
+model's near-zero compute, the latencies mostly measure the server's own
+overhead (history parsing, file reading, tokenizing, streaming, persistence);
+use --step-ms to add a fixed per-forward model time. --profile runs the server
+with an engine profile; on the stub model its sampling defaults, answer length,
+context limit, prompt budget and CPU threads apply, its weight loading
+settings do not.
+
+Run from the python/ directory:
+
+    python -m benchmarks.run --requests 64 --concurrency 8 --history-turns 20
+    python -m benchmarks.run --attachment-files 10 --attachment-kb 64 --image
+    python -m benchmarks.run --output benchmarks/baseline.json
+    python -m benchmarks.run --profile cpu-fast --step-ms 20
+    python -m benchmarks.run --baseline benchmarks/baseline.json --max-regression 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+
+WORDS = (
+    "patient", "reports", "mild", "chest", "pain", "since", "yesterday", "no", "fever", "history", "of",
+    "hypertension", "blood", "pressure", "130/85", "heart", "rate", "72", "medication", "lisinopril", "10mg",
+)
+
+# Metric -> whether a larger value is better, for baseline comparison
+COMPARED_METRICS = {
+    "ttft_s.p50": False,
+    "ttft_s.p95": False,
+    "ttft_s.p99": False,
+    "itl_s.p50": False,
+    "itl_s.p95": False,
+    "itl_s.p99": False,
+    "e2e_s.p50": False,
+    "e2e_s.p95": False,
+    "tokens_per_s": True,
+    "requests_per_s": True,
+    "peak_rss_mb": False,
+}
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    def at(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": values[-1]}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeDBHandler(BaseHTTPRequestHandler):
+    """Answers the persistence writer like the Rust server: 201 + id on create, 200 on update."""
+
+    def _reply(self, status: int, body: Any):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.requests += 1
+
+    def do_POST(self):
+        self.server.next_id += 1
+        self._reply(201, self.server.next_id)
+
+    def do_PATCH(self):
+        self._reply(200, {})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_db() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDBHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.next_id = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def random_text(rng: random.Random, n_chars: int) -> str:
+    words = []
+    length = 0
+    while length < n_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:n_chars]
+
+
+def build_workload(args, workdir: Path) -> List[Tuple[Dict[str, Any], str]]:
+    """One `(form payload, client address)` per request. Requests of the same chat share their history."""
+    rng = random.Random(args.seed)
+
+    attachment_dir = None
+    if args.attachment_files:
+        attachment_dir = workdir / "attachments"
+        attachment_dir.mkdir()
+        for i in range(args.attachment_files):
+            lines = []
+            size = 0
+            while size < args.attachment_kb * 1024:
+                line = random_text(rng, 100)
+                lines.append(line)
+                size += len(line) + 1
+            (attachment_dir / f"record_{i:03d}.txt").write_text("\n".join(lines), encoding="utf-8")
+
+    image_path = None
+    if args.image:
+        from PIL import Image
+
+        image_path = workdir / "scan.png"
+        pixels = bytes(rng.randrange(256) for _ in range(args.image_size * args.image_size))
+        Image.frombytes("L", (args.image_size, args.image_size), pixels).save(image_path)
+
+    chats = max(1, args.chats or args.requests)
+    histories = []
+    for _ in range(chats):
+        history = []
+        for turn in range(args.history_turns):
+            history.append({"role": "user", "content": random_text(rng, args.turn_chars)})
+            history.append({"role": "assistant", "content": random_text(rng, args.turn_chars)})
+        question = {"role": "user", "content": random_text(rng, args.turn_chars)}
+        if attachment_dir is not None:
+            question["paths"] = [str(attachment_dir)]
+        history.append(question)
+        histories.append([json.dumps(message) for message in history])
+
+    workload = []
+    clients = max(1, args.clients or args.concurrency)
+    for i in range(args.requests):
+        form = {
+            "history": histories[i % chats],
+            "chat_id": str(i % chats),
+            "stream_mode": args.stream_mode,
+            "priority": "batch" if rng.random() < args.batch_fraction else "interactive",
+        }
+        if image_path is not None:
+            form["image_path"] = str(image_path)
+        # Simulated clients, as a trusted proxy would name them (see OPENMED_TRUSTED_PROXIES below)
+        workload.append((form, f"bench-{i % clients}"))
+    return workload
+
+
+async def run_request(client: httpx.AsyncClient, form: Dict[str, Any], client_address: str) -> Dict[str, Any]:
+    """Streams one generation and records client-side timings."""
+    started = time.perf_counter()
+    token_times = []
+    error = None
+    try:
+        # The chat id header lets the router stream the body through without parsing it
+        headers = {"X-Chat-ID": form["chat_id"], "X-Forwarded-For": client_address}
+        async with client.stream("POST", "/generate", data=form, headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+            else:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if event["type"] in ("delta", "update"):
+                        token_times.append(time.perf_counter())
+                    elif event["type"] == "error":
+                        error = event.get("message", "error")[:200]
+    except httpx.HTTPError as e:
+        error = f"{type(e).__name__}: {e}"
+    finished = time.perf_counter()
+
+    return {
+        "priority": form.get("priority", "interactive"),
+        "ttft": token_times[0] - started if token_times else None,
+        "itl": [b - a for a, b in zip(token_times, token_times[1:])],
+        "e2e": finished - started,
+        "tokens": len(token_times),
+        "error": error,
+    }
+
+
+async def drive(base_url: str, workload: List[Tuple[Dict[str, Any], str]], concurrency: int, warmup: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(300.0), limits=limits) as client:
+        # Warm-up requests use their own chat ids so they do not seed the prefix cache
+        for i, (form, client_address) in enumerate(workload[:warmup]):
+            await run_request(client, {**form, "chat_id": str(-1 - i)}, client_address)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(form, client_address):
+            async with semaphore:
+                return await run_request(client, form, client_address)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(bounded(form, client_address) for form, client_address in workload))
+        wall = time.perf_counter() - started
+
+        server_stats = (await client.get("/stats")).json()
+    return results, wall, server_stats
+
+
+def wait_until_up(base_url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            if httpx.get(base_url + "/health/ready", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server was not ready within {timeout}s")
+
+
+def children_peak_rss_mb() -> Optional[float]:
+    """Peak RSS of terminated child processes (the server), or None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(results: List[Dict[str, Any]], wall: float, server_stats: Dict[str, Any]) -> Dict[str, Any]:
+    ok = [r for r in results if r["error"] is None]
+    tokens = sum(r["tokens"] for r in ok)
+    histograms = server_stats.get("histograms", {})
+    priorities = sorted({r["priority"] for r in results})
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": [r["error"] for r in results if r["error"] is not None][:5],
+        "wall_s": wall,
+        "ttft_s": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "itl_s": percentiles([gap for r in ok for gap in r["itl"]]),
+        "e2e_s": percentiles([r["e2e"] for r in ok]),
+        "ttft_s_by_priority": {
+            priority: percentiles([r["ttft"] for r in ok if r["priority"] == priority and r["ttft"] is not None])
+            for priority in priorities
+        },
+        "tokens": tokens,
+        "tokens_per_s": tokens / wall if wall else 0.0,
+        "requests_per_s": len(ok) / wall if wall else 0.0,
+        # Server-side phase timings, to tell serving overhead apart from model time
+        "server": {
+            name: histograms[name]
+            for name in (
+                "generation_queue_wait_seconds",
+                "generation_template_seconds",
+                "generation_tokenize_seconds",
+                "generation_prefill_seconds",
+                "generation_time_to_first_token_seconds",
+                "persist_final_seconds",
+                "persist_write_seconds",
+            )
+            if name in histograms
+        },
+        "persistence": server_stats.get("persistence"),
+        "admission": server_stats.get("admission"),
+        "prefix_cache": server_stats.get("inference", {}).get("prefix_cache"),
+        "speculative": server_stats.get("inference", {}).get("speculative"),
+        # Per-worker load when running behind the router
+        "workers": {
+            index: {"served": worker["served"], "restarts": worker["restarts"]}
+            for index, worker in server_stats.get("workers", {}).items()
+        },
+    }
+
+
+def lookup(result: Dict[str, Any], dotted: str) -> Optional[float]:
+    value: Any = result
+    for part in dotted.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Prints the change of every compared metric and returns those that regressed past `max_regression`."""
+    if baseline.get("config") != result.get("config"):
+        print("Warning: baseline was recorded with a different configuration.")
+
+    regressions = []
+    print(f"\n{'metric':<20}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, higher_is_better in COMPARED_METRICS.items():
+        old, new = lookup(baseline, name), lookup(result, name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > max_regression else ""
+        print(f"{name:<20}{old:>14.4f}{new:>14.4f}{change:>+9.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"\nrequests: {result['requests']}  errors: {result['errors']}  wall: {result['wall_s']:.2f}s")
+    for sample in result["error_samples"]:
+        print(f"  error: {sample}")
+    for name in ("ttft_s", "itl_s", "e2e_s"):
+        stats = result[name]
+        if stats["p50"] is None:
+            continue
+        print(
+            f"{name:<8} p50 {stats['p50'] * 1000:9.2f} ms   p95 {stats['p95'] * 1000:9.2f} ms"
+            f"   p99 {stats['p99'] * 1000:9.2f} ms"
+        )
+    if len(result["ttft_s_by_priority"]) > 1:
+        for priority, stats in result["ttft_s_by_priority"].items():
+            if stats["p50"] is not None:
+                print(f"  ttft {priority}: p50 {stats['p50'] * 1000:.2f} ms, p95 {stats['p95'] * 1000:.2f} ms")
+    print(f"throughput: {result['tokens_per_s']:.1f} tokens/s, {result['requests_per_s']:.2f} requests/s")
+    if result["peak_rss_mb"] is not None:
+        print(f"server peak RSS: {result['peak_rss_mb']:.1f} MB")
+    for name, stats in result["server"].items():
+        if stats.get("p50") is not None:
+            print(f"  server {name}: p50 {stats['p50'] * 1000:.2f} ms, p95 {stats['p95'] * 1000:.2f} ms")
+    speculative = result.get("speculative") or {}
+    if speculative.get("draft_tokens"):
+        print(
+            f"speculative ({speculative['drafter']}): {speculative['accepted_tokens']}/{speculative['draft_tokens']}"
+            f" draft tokens accepted ({speculative['acceptance_rate']:.1%})"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=32, help="measured requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--warmup", type=int, default=2, help="sequential requests sent before measuring")
+    parser.add_argument("--clients", type=int, default=0, help="distinct client ids (default: one per concurrent request)")
+    parser.add_argument("--batch-fraction", type=float, default=0.0, help="share of requests sent with batch priority")
+    parser.add_argument("--chats", type=int, default=0, help="distinct chats the requests cycle over (default: one per request)")
+    parser.add_argument("--history-turns", type=int, default=4, help="user/assistant pairs before the question")
+    parser.add_argument("--turn-chars", type=int, default=400, help="characters per history message")
+    parser.add_argument("--attachment-files", type=int, default=0, help="text files attached to the question")
+    parser.add_argument("--attachment-kb", type=int, default=16, help="size of each attached file")
+    parser.add_argument("--image", action="store_true", help="send an image with every request")
+    parser.add_argument("--image-size", type=int, default=512, help="image width and height in pixels")
+    parser.add_argument("--stream-mode", choices=("full", "delta"), default="delta")
+    parser.add_argument("--answer-tokens", type=int, default=128, help="tokens generated per answer")
+    parser.add_argument("--step-ms", type=float, default=0.0, help="simulated model time per forward pass")
+    parser.add_argument("--workers", type=int, default=0, help="run behind Router.py with this many workers")
+    parser.add_argument("--profile", default="default", help="engine profile (OPENMED_PROFILE) to benchmark")
+    parser.add_argument("--speculative", choices=("off", "ngram", "draft"), default="off", help="speculative decoding mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results JSON here (use as a future baseline)")
+    parser.add_argument("--baseline", type=Path, help="results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative slowdown before failing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("output", "baseline", "max_regression")
+    }
+
+    fake_db = start_fake_db()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    with tempfile.TemporaryDirectory(prefix="openmed-bench-") as workdir:
+        workdir = Path(workdir)
+        workload = build_workload(args, workdir)
+        env = {
+            **os.environ,
+            "OPENMED_STUB_MODEL": "1",
+            "OPENMED_STUB_ANSWER_TOKENS": str(args.answer_tokens),
+            "OPENMED_STUB_STEP_MS": str(args.step_ms),
+            "OPENMED_SPECULATIVE": args.speculative,
+            "OPENMED_PROFILE": args.profile,
+            "OPENMED_DB_URL": f"http://127.0.0.1:{fake_db.server_address[1]}/db",
+            "OPENMED_CONTEXT_INDEX": str(workdir / "context_index.sqlite3"),
+            "OPENMED_TRUSTED_PROXIES": "127.0.0.1",
+        }
+        env.pop("OPENMED_TRACE_FILE", None)
+        if args.workers:
+            # Through the multi-worker router, each worker running its own stub model
+            command = [sys.executable, "Router.py", "--host", "127.0.0.1", "--port", str(port),
+                       "--workers", str(args.workers), "--worker-base-port", str(free_port())]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "ai_server:app", "--host", "127.0.0.1", "--port", str(port),
+                       "--log-level", "warning"]
+        server = subprocess.Popen(
+            command,
+            cwd=PYTHON_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_up(base_url, server, timeout=120)
+            results, wall, server_stats = asyncio.run(
+                drive(base_url, workload, args.concurrency, args.warmup)
+            )
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            fake_db.shutdown()
+
+    result = summarize(results, wall, server_stats)
+    result["peak_rss_mb"] = children_peak_rss_mb()
+    result["db_requests"] = fake_db.requests
+    result["config"] = config
+    result["platform"] = {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system()}
+    print_report(result)
+
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2), encoding="utf-8")
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(result, json.loads(args.baseline.read_text(encoding="utf-8")), args.max_regression)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.max_regression:.0%}.")
+            return 1
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Deterministic CPU stand-ins for the Med Gemma model and processor.
+
+The stub model is a tiny attention network that still exercises the real
+serving paths (batched KV cache, prefix reuse, image features). Its answers
+use dedicated vocabulary entries that each decode to one word: after the
+prompt it emits answer token 0, then 1, 2, ... and finally EOS. The logits are
+sharply peaked, so every run produces the same answer of exactly
+`answer_tokens` tokens, even with sampling enabled. `step_delay` adds a fixed
+sleep per forward pass to mimic model time.
+"""
+
+import math
+import os
+import time
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+from transformers import BatchFeature
+
+EOS_TOKEN_ID = 256
+IMAGE_TOKEN_ID = 257
+ANSWER_TOKEN_BASE = 258
+
+BOI_TOKEN = "<start_of_image>"
+IMAGE_TOKEN = "<image_soft_token>"
+IMAGE_SEQ_LENGTH = 16
+
+ANSWER_WORDS = (
+    "The", "scan", "shows", "no", "acute", "findings.", "Lungs", "are", "clear", "and", "the",
+    "cardiac", "silhouette", "is", "within", "normal", "limits.", "Follow", "up", "as", "needed.\n",
+)
+
+
+class StubTokenizer:
+    """Byte-level tokenizer with a Gemma-like chat template."""
+
+    eos_token_id = EOS_TOKEN_ID
+    image_token_id = IMAGE_TOKEN_ID
+
+    def encode(self, text: str, add_special_tokens: bool = False):
+        ids = []
+        for i, part in enumerate(text.split(IMAGE_TOKEN)):
+            if i:
+                ids.append(IMAGE_TOKEN_ID)
+            ids.extend(part.encode("utf-8"))
+        return ids
+
+    def __call__(self, text, return_tensors="pt", **kwargs):
+        if isinstance(text, str):
+            text = [text]
+        rows = [self.encode(t) for t in text]
+        width = max(len(r) for r in rows)
+        side = kwargs.get("padding_side", "left")
+        input_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, row in enumerate(rows):
+            sl = slice(width - len(row), width) if side == "left" else slice(0, len(row))
+            input_ids[i, sl] = torch.tensor(row, dtype=torch.long)
+            attention_mask[i, sl] = 1
+        return BatchFeature({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def decode(self, ids, skip_special_tokens: bool = False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        parts = []
+        raw = bytearray()
+        for i in ids:
+            if i < 256:
+                raw.append(i)
+                continue
+            if raw:
+                parts.append(raw.decode("utf-8", errors="replace"))
+                raw = bytearray()
+            if i >= ANSWER_TOKEN_BASE:
+                parts.append(ANSWER_WORDS[(i - ANSWER_TOKEN_BASE) % len(ANSWER_WORDS)] + " ")
+        if raw:
+            parts.append(raw.decode("utf-8", errors="replace"))
+        return "".join(parts)
+
+    def batch_decode(self, sequences, skip_special_tokens: bool = False):
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, **kwargs):
+        out = ""
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "".join(
+                    part.get("text", "") if part.get("type") == "text" else BOI_TOKEN for part in content
+                )
+            role = "model" if message["role"] == "assistant" else message["role"]
+            out += f"<start_of_turn>{role}\n{content}<end_of_turn>\n"
+        if add_generation_prompt:
+            out += "<start_of_turn>model\n"
+        return self.encode(out) if tokenize else out
+
+
+class StubImageProcessor:
+    """Downsamples to a 4x4 RGB grid."""
+
+    def __call__(self, images, return_tensors="pt", **kwargs):
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        pixels = [
+            torch.tensor(list(image.convert("RGB").resize((4, 4)).getdata()), dtype=torch.float32).view(16, 3) / 255
+            for image in images
+        ]
+        return BatchFeature({"pixel_values": torch.stack(pixels)})
+
+
+class StubProcessor:
+    boi_token = BOI_TOKEN
+    full_image_sequence = f"\n\n{BOI_TOKEN}{IMAGE_TOKEN * IMAGE_SEQ_LENGTH}\n\n"
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+        self.image_processor = StubImageProcessor()
+
+    def __call__(self, text=None, images=None, return_tensors="pt", **kwargs):
+        if images is not None:
+            text = text.replace(BOI_TOKEN, self.full_image_sequence)
+        inputs = self.tokenizer(text, **kwargs)
+        if images is not None:
+            inputs["token_type_ids"] = (inputs["input_ids"] == IMAGE_TOKEN_ID).long()
+            inputs["pixel_values"] = self.image_processor(images)["pixel_values"]
+        return inputs
+
+
+class StubModel(nn.Module):
+    """
+    Tiny attention model. Each position predicts the successor of its input
+    token: answer token `i` -> answer token `i + 1`, the last answer token ->
+    EOS, and any prompt token -> answer token 0.
+    """
+
+    def __init__(self, answer_tokens: int = 256, step_delay: float = 0.0, dim: int = 16, layers: int = 2):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.answer_tokens = answer_tokens
+        self.step_delay = step_delay
+        self.vocab_size = ANSWER_TOKEN_BASE + answer_tokens
+        self.emb = nn.Embedding(self.vocab_size, dim)
+        self.vision = nn.Linear(48, IMAGE_SEQ_LENGTH * dim)
+        self.qkv = nn.ModuleList([nn.Linear(dim, 3 * dim) for _ in range(layers)])
+        for parameter in self.parameters():
+            parameter.data = torch.randn(parameter.shape, generator=generator) * 0.1
+        # The dimensions the memory governor reads to size the KV cache
+        self.config = SimpleNamespace(
+            image_token_id=IMAGE_TOKEN_ID, num_hidden_layers=layers, num_attention_heads=1, head_dim=dim, hidden_size=dim
+        )
+        self.generation_config = SimpleNamespace(eos_token_id=EOS_TOKEN_ID)
+
+    def get_input_embeddings(self):
+        return self.emb
+
+    def get_image_features(self, pixel_values):
+        return self.vision(pixel_values.flatten(1)).view(-1, self.emb.embedding_dim)
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        position_ids=None,
+        past_key_values=None,
+        inputs_embeds=None,
+        pixel_values=None,
+        use_cache=True,
+        logits_to_keep=0,
+        **kwargs,
+    ):
+        if self.step_delay:
+            time.sleep(self.step_delay)
+        if inputs_embeds is None:
+            inputs_embeds = self.emb(input_ids.masked_fill(input_ids == IMAGE_TOKEN_ID, 0))
+            if pixel_values is not None:
+                mask = (input_ids == IMAGE_TOKEN_ID).unsqueeze(-1)
+                inputs_embeds = inputs_embeds.masked_scatter(mask, self.get_image_features(pixel_values))
+
+        batch, length, _ = inputs_embeds.shape
+        # Only the last `logits_to_keep` positions attend; the rest just fill the KV cache
+        keep = min(logits_to_keep, length) if logits_to_keep else length
+        x = inputs_embeds
+        for layer_idx, qkv in enumerate(self.qkv):
+            q, k, v = qkv(x).unsqueeze(1).chunk(3, dim=-1)
+            q = q[:, :, -keep:]
+            if past_key_values is not None:
+                k, v = past_key_values.update(k, v, layer_idx)
+            total = k.shape[2]
+            scores = q @ k.transpose(-1, -2) / math.sqrt(q.shape[-1])
+            causal = torch.arange(total).unsqueeze(0) <= (torch.arange(keep) + total - keep).unsqueeze(1)
+            mask = causal.unsqueeze(0).unsqueeze(0)
+            if attention_mask is not None:
+                mask = mask & attention_mask[:, None, None, :total].bool()
+            scores = scores.masked_fill(~mask, float("-inf"))
+            out = torch.nan_to_num(torch.softmax(scores, -1) @ v).squeeze(1)
+            x = torch.cat([x[:, : length - keep], x[:, length - keep :] + out], dim=1)
+
+        if input_ids is None:
+            # Embedding-only prefill (cached image features): the last position is
+            # always the end of the prompt
+            next_ids = torch.full((batch, length), ANSWER_TOKEN_BASE, dtype=torch.long)
+        else:
+            last = ANSWER_TOKEN_BASE + self.answer_tokens - 1
+            next_ids = torch.where(input_ids >= ANSWER_TOKEN_BASE, input_ids + 1, ANSWER_TOKEN_BASE)
+            next_ids = torch.where(input_ids == last, EOS_TOKEN_ID, next_ids)
+        next_ids = next_ids[:, -keep:]
+        logits = torch.full((batch, keep, self.vocab_size), -1e4)
+        logits.scatter_(-1, next_ids.unsqueeze(-1), 1e4)
+        logits = logits + 0 * x[:, -keep:].sum(dim=-1, keepdim=True)
+        return SimpleNamespace(logits=logits, past_key_values=past_key_values)
+
+
+def create_stub_service(answer_tokens: int = 256, step_delay: float = 0.0, **kwargs):
+    """InferenceService running on the stub model and processor."""
+    from Inference import InferenceService
+
+    return InferenceService(
+        model=StubModel(answer_tokens=answer_tokens, step_delay=step_delay),
+        processor=StubProcessor(),
+        **kwargs,
+    )
+
+
+def stub_service_from_env():
+    """Stub service configured by OPENMED_STUB_ANSWER_TOKENS and OPENMED_STUB_STEP_MS."""
+    return create_stub_service(
+        answer_tokens=int(os.environ.get("OPENMED_STUB_ANSWER_TOKENS", "256")),
+        step_delay=float(os.environ.get("OPENMED_STUB_STEP_MS", "0")) / 1000,
+    )
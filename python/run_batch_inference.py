@@ -0,0 +1,213 @@
+"""
+Offline batch inference over a JSONL dataset of chats, for nightly jobs that
+would otherwise go through /generate one request at a time.
+
+Each input line is a JSON object; only `messages` is required:
+
+    {"id": "report-17", "messages": [{"role": "user", "content": "Summarize this report.", "paths": ["reports/17.txt"]}],
+     "image": "scans/17.png", "max_new_tokens": 512, "temperature": 0.2, "seed": 1}
+
+Messages use the same format as the API (including `paths` attachments).
+Items are sorted by prompt length, so the rows decoding together have similar
+lengths and the left-padded batch wastes little compute. They are fed to the
+InferenceService batch scheduler, which keeps up to --batch-size generations
+decoding at once and refills the batch as rows finish. Images are read, hashed
+and preprocessed ahead of time on a thread pool.
+
+Every result is appended to the output JSONL as soon as it finishes. The output
+doubles as the checkpoint: a rerun skips the ids already written without an
+error, so an interrupted job resumes where it stopped.
+
+Run from the python/ directory:
+
+    python run_batch_inference.py data.jsonl results.jsonl --batch-size 8
+    OPENMED_STUB_MODEL=1 python run_batch_inference.py data.jsonl results.jsonl  # stub model, for testing
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+from Profiles import parse_sampling
+from ServerUtils import message_text, process_paths_in_messages, validate_message
+
+# Prompt length credited to an image when sorting (Gemma 3 uses 256 image tokens, about 4 characters each)
+IMAGE_PROMPT_CHARS = 1024
+# Seconds between progress lines
+PROGRESS_INTERVAL_SECONDS = 30.0
+
+
+def create_service(batch_size: int):
+    if os.environ.get("OPENMED_STUB_MODEL"):
+        from benchmarks.stub_model import stub_service_from_env
+        service = stub_service_from_env()
+        service.scheduler.max_batch_size = batch_size
+        return service
+    from Inference import InferenceService
+    return InferenceService(max_batch_size=batch_size)
+
+
+def read_items(path: Path) -> List[Dict[str, Any]]:
+    """Parses and validates the input file; raises ValueError naming the first bad line."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                messages = item["messages"]
+                if not isinstance(messages, list) or not messages:
+                    raise ValueError("`messages` must be a non-empty list.")
+                for message in messages:
+                    validate_message(message)
+                options = parse_sampling(
+                    item.get("max_new_tokens"), item.get("do_sample"), item.get("temperature"), item.get("top_p")
+                )
+                if item.get("seed") is not None:
+                    options["seed"] = int(item["seed"])
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from e
+            items.append({
+                "id": str(item.get("id", line_number)),
+                "messages": messages,
+                "image": item.get("image"),
+                "options": options,
+            })
+    return items
+
+
+def completed_ids(path: Path) -> Set[str]:
+    """Ids already written without an error. A torn last line (killed mid-write) is cut off."""
+    if not path.exists():
+        return set()
+    done = set()
+    good_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            good_bytes += len(line)
+            if not record.get("error"):
+                done.add(record["id"])
+    if good_bytes < path.stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(good_bytes)
+    return done
+
+
+def prompt_length(item: Dict[str, Any]) -> int:
+    length = sum(len(message_text(message)) for message in item["messages"])
+    return length + (IMAGE_PROMPT_CHARS if item["image"] else 0)
+
+
+async def run(args) -> int:
+    items = read_items(args.input)
+    done = completed_ids(args.output) if not args.restart else set()
+    pending = sorted((item for item in items if item["id"] not in done), key=prompt_length)
+    print(f"{len(items)} items, {len(done)} already done, {len(pending)} to run")
+    if not pending:
+        return 0
+
+    service = await asyncio.to_thread(create_service, args.batch_size)
+    # Queued items may wait a whole generation for a free row, unlike interactive requests
+    service.first_token_timeout = args.first_token_timeout
+    loop = asyncio.get_running_loop()
+    image_pool = ThreadPoolExecutor(max_workers=args.image_workers, thread_name_prefix="image-prefetch")
+    prefetches: Dict[int, asyncio.Future] = {}
+
+    def prefetch(index: int):
+        if index < len(pending) and index not in prefetches and pending[index]["image"]:
+            prefetches[index] = loop.run_in_executor(image_pool, service.prefetch_image, Path(pending[index]["image"]))
+
+    # Enough queued work that the scheduler can refill a finished row at the next token
+    in_flight = asyncio.Semaphore(args.batch_size * 2)
+    output = open(args.output, "w" if args.restart else "a", encoding="utf-8")
+    started_at = time.perf_counter()
+    last_progress = started_at
+    finished = failed = tokens = 0
+
+    async def run_item(index: int, item: Dict[str, Any]):
+        nonlocal finished, failed, tokens, last_progress
+        record: Dict[str, Any] = {"id": item["id"]}
+        item_started = time.perf_counter()
+        try:
+            if index in prefetches:
+                await prefetches.pop(index)
+            messages = [dict(message) for message in item["messages"]]
+            await asyncio.to_thread(process_paths_in_messages, messages)
+            image = Path(item["image"]) if item["image"] else None
+            async for event in service.generate(messages=messages, image=image, **item["options"]):
+                if event["type"] == "complete":
+                    record.update(text=event["text"], checksum=event["checksum"], stats=event["stats"])
+                elif event["type"] == "error":
+                    record["error"] = event["message"]
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            in_flight.release()
+
+        record["elapsed_s"] = time.perf_counter() - item_started
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+        finished += 1
+        if "error" in record:
+            failed += 1
+        else:
+            tokens += record["stats"].get("generated_tokens") or 0
+
+        now = time.perf_counter()
+        if now - last_progress >= PROGRESS_INTERVAL_SECONDS:
+            last_progress = now
+            rate = finished / (now - started_at) * 3600
+            print(f"{finished}/{len(pending)} items ({failed} failed), {rate:.0f} items/hour")
+
+    tasks = []
+    try:
+        for index, item in enumerate(pending):
+            await in_flight.acquire()
+            for ahead in range(index, index + args.prefetch):
+                prefetch(ahead)
+            tasks.append(asyncio.create_task(run_item(index, item)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        output.close()
+        image_pool.shutdown(wait=False, cancel_futures=True)
+        service.scheduler.close()
+
+    elapsed = time.perf_counter() - started_at
+    print(
+        f"Done: {finished} items ({failed} failed) in {elapsed:.1f}s, "
+        f"{finished / elapsed * 3600:.0f} items/hour, {tokens / elapsed:.1f} tokens/s"
+    )
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", type=Path, help="JSONL file with one chat per line")
+    parser.add_argument("output", type=Path, help="JSONL results file; appended to and used to resume")
+    parser.add_argument("--batch-size", type=int, default=8, help="generations decoding at once")
+    parser.add_argument("--image-workers", type=int, default=4, help="threads decoding images ahead of time")
+    parser.add_argument("--prefetch", type=int, default=16, help="items ahead whose images are prepared")
+    parser.add_argument("--first-token-timeout", type=float, default=3600.0, help="seconds an item may wait for its first token")
+    parser.add_argument("--restart", action="store_true", help="ignore existing results and start over")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(asyncio.run(run(parse_args())))
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume.")
+        sys.exit(130)
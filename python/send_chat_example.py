@@ -45,7 +45,8 @@ messages = [
 # Prepare the form data
 form_data = {
     "history": [json.dumps(msg) for msg in messages],
-    "image_base64": "" # No image for this example
+    "image_base64": "", # No image for this example
+    "stream_mode": "delta" # Each event carries only the new text
 }
 
 print(f"Sending request to {API_URL} with history: {messages}")
@@ -56,7 +57,6 @@ try:
         response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
 
         print("--- Streaming Response ---")
-        previous_text_chunk = "" # Initialize variable to keep track of cumulative text
         buffer = b""
         for chunk in response.iter_content(chunk_size=None):
             if chunk:
@@ -69,13 +69,8 @@ try:
                         try:
                             json_data = json.loads(decoded_line[len("data:"):].strip())
                             msg_type = json_data.get("type")
-                            if msg_type == "update" or (msg_type is None and "text" in json_data):
-                                if "text" in json_data:
-                                    current_text = json_data['text']
-                                    if len(current_text) > len(previous_text_chunk):
-                                        new_part = current_text[len(previous_text_chunk):]
-                                        print(new_part, end='', flush=True) # Print only the new part
-                                        previous_text_chunk = current_text # Update previous_text_chunk
+                            if msg_type == "delta":
+                                print(json_data["text"], end='', flush=True) # Print only the new part
                             elif msg_type == "complete":
                                 print("\n--- Generation Complete ---")
                             elif msg_type == "error":
@@ -31,37 +31,82 @@ export function setPythonServerUrl(url: string) {
   localStorage.setItem('PYTHON_SERVER_URL', PYTHON_SERVER_URL)
 }
 
-export async function callToGenerate(
-  history: ChatMessage[],
-  onChunk: (chunk: string, generationId?: string) => void,
+// What the server holds for each chat, so later turns only upload new messages
+type SyncedChat = { version: string; messages: string[] }
+const syncedChats = new Map<number, SyncedChat>()
+
+function toApiMessage(msg: ChatMessage) {
+  const apiMsg: any = {
+    role: msg.role,
+    content: msg.content,
+  }
+  if (msg.folder) {
+    apiMsg.paths = [msg.folder]
+  }
+  return JSON.stringify(apiMsg)
+}
+
+// Sends only the messages the server has not seen, or the whole history when
+// the server's copy is unknown or has diverged
+async function postChatTurn(
   chatId: number,
-  image?: ChatImage,
+  messages: string[],
+  image: ChatImage | undefined,
+  fullSync: boolean,
 ) {
-  const API_URL = `${PYTHON_SERVER_URL}generate`
-
-  const formData = new FormData()
+  const synced = syncedChats.get(chatId)
+  const canAppend =
+    !fullSync &&
+    synced !== undefined &&
+    synced.messages.length <= messages.length &&
+    synced.messages.every((msg, i) => msg === messages[i])
 
-  history.forEach(msg => {
-    const apiMsg: any = {
-      role: msg.role,
-      content: msg.content,
-    }
-    if (msg.folder) {
-      apiMsg.paths = [msg.folder]
-    }
+  const options = {
+    sync: canAppend ? 'append' : 'full',
+    base_version: canAppend ? synced!.version : null,
+    stream_mode: 'delta', // Only the new text is sent per event; we keep the running text here
+    image_path: image?.path || null,
+  }
+  const newMessages = canAppend ? messages.slice(synced!.messages.length) : messages
 
-    formData.append('history', JSON.stringify(apiMsg))
+  return fetch(`${PYTHON_SERVER_URL}chats/${chatId}/generate`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/x-ndjson' },
+    body: [JSON.stringify(options), ...newMessages].join('\n') + '\n',
   })
+}
+
+// Times a dropped stream is reattached to its generation on the server before giving up
+const REATTACH_ATTEMPTS = 3
+const REATTACH_DELAY_MS = 1000
 
-  // Append the determined image_base64 data (or empty string) once
-  formData.append('image_path', image?.path || '')
-  formData.append('chat_id', chatId.toString())
+// Continues a generation's event stream from `fromSeq`; the server keeps
+// generating while no client is connected
+async function reattachStream(generationId: string, fromSeq: number) {
+  const response = await fetch(
+    `${PYTHON_SERVER_URL}generations/${generationId}/stream?from=${fromSeq}&stream_mode=delta`,
+  )
+  if (!response.ok) {
+    throw new Error(`Cannot reattach to generation ${generationId}: status ${response.status}`)
+  }
+  return response.body?.getReader()
+}
+
+export async function callToGenerate(
+  history: ChatMessage[],
+  onChunk: (chunk: string, generationId?: string) => void,
+  chatId: number,
+  image?: ChatImage,
+) {
+  const messages = history.map(toApiMessage)
 
   try {
-    const response = await fetch(API_URL, {
-      method: 'POST',
-      body: formData,
-    })
+    let response = await postChatTurn(chatId, messages, image, false)
+    if (response.status === 409) {
+      // The server's copy of the chat differs from ours; send everything
+      response = await postChatTurn(chatId, messages, image, true)
+    }
+    syncedChats.delete(chatId)
 
     if (!response.ok) {
       const errorText = await response.text()
@@ -70,17 +115,46 @@ export async function callToGenerate(
       )
     }
 
-    const reader = response.body?.getReader()
+    let reader = response.body?.getReader()
     if (!reader) throw new Error('Failed to get readable stream from response.')
 
-    let previousTextChunk = ''
+    let receivedText = ''
+    let lastSeq = 0
     let buffer = ''
+    // One decoder per connection, so characters split across reads decode whole
+    let decoder = new TextDecoder()
+    let currentGenerationId: string | undefined
+    let finished = false
+    let reattachAttempts = 0
 
     while (true) {
-      const { done, value } = await reader.read()
-      if (done) break
+      let chunk: ReadableStreamReadResult<Uint8Array>
+      try {
+        chunk = await reader.read()
+      } catch (e) {
+        chunk = { done: true, value: undefined }
+        console.warn('Stream interrupted:', e)
+      }
+      if (chunk.done) {
+        if (finished || !currentGenerationId || reattachAttempts >= REATTACH_ATTEMPTS) break
+        // The connection dropped mid-answer; pick the generation up where we left it
+        reattachAttempts++
+        await new Promise((resolve) => setTimeout(resolve, REATTACH_DELAY_MS))
+        try {
+          const resumed = await reattachStream(currentGenerationId, lastSeq + 1)
+          if (resumed) {
+            reader = resumed
+            decoder = new TextDecoder()
+          }
+        } catch (e) {
+          console.warn(e)
+        }
+        buffer = ''
+        continue
+      }
+      const value = chunk.value
 
-      buffer += new TextDecoder().decode(value)
+      buffer += decoder.decode(value, { stream: true })
 
       while (buffer.includes('\n')) {
         const lineEnd = buffer.indexOf('\n')
@@ -94,24 +168,43 @@ export async function callToGenerate(
             const msgType = json_data.type
             const generationId = json_data.generation_id
 
-            if (
-              msgType === 'update' ||
-              (msgType === undefined && 'text' in json_data)
-            ) {
-              if ('text' in json_data) {
-                const currentText = json_data.text
-                if (currentText.length > previousTextChunk.length) {
-                  const newPart = currentText.substring(
-                    previousTextChunk.length,
-                  )
-                  onChunk(newPart, generationId)
-                  previousTextChunk = currentText
-                }
+            if (generationId) currentGenerationId = generationId
+
+            if (msgType === 'start') {
+              // Lets the UI cancel before the first token arrives
+              onChunk('', generationId)
+            } else if (msgType === 'snapshot') {
+              // The text up to `seq`, sent on reattaching when those deltas are no longer buffered
+              onChunk(json_data.text.slice(receivedText.length), generationId)
+              receivedText = json_data.text
+              lastSeq = json_data.seq
+            } else if (msgType === 'delta') {
+              if (json_data.seq !== lastSeq + 1) {
+                console.warn(
+                  `Out of order stream event: expected ${lastSeq + 1}, got ${json_data.seq}`,
+                )
               }
+              lastSeq = json_data.seq
+              receivedText += json_data.text
+              onChunk(json_data.text, generationId)
             } else if (msgType === 'complete') {
+              finished = true
               // Generation complete, no action needed for onChunk, but can be used to signal completion
+              if (json_data.text !== receivedText) {
+                console.warn('Streamed text does not match the final text.')
+              }
+              if (json_data.version) {
+                syncedChats.set(chatId, {
+                  version: json_data.version,
+                  messages: [
+                    ...messages,
+                    JSON.stringify({ role: 'assistant', content: json_data.text }),
+                  ],
+                })
+              }
               console.log('--- Generation Complete ---')
             } else if (msgType === 'error') {
+              finished = true
               console.error(`Error from server: ${json_data.message}`)
               throw new Error(`Server error: ${json_data.message}`)
             }
@@ -186,18 +279,35 @@ export async function checkAIServer() {
   }
 }
 
+// The server binds before the model has loaded; poll until it reports ready
+export async function waitForAIServerReady(intervalMs = 1000) {
+  while (true) {
+    try {
+      const response = await fetch(`${PYTHON_SERVER_URL}health/ready`)
+      if (response.ok) return
+      const status = await response.json()
+      if (status.state === 'failed') throw new Error(status.error)
+    } catch (error) {
+      if (error instanceof Error && !(error instanceof TypeError)) throw error
+    }
+    await new Promise(resolve => setTimeout(resolve, intervalMs))
+  }
+}
+
 export async function startPythonServer(onConsole?: (msg: string) => void) {
   return new Promise<void>((resolve, reject) => {
     const eventSource = new EventSource('http://127.0.0.1:8001/start')
+    let waiting = false
 
     eventSource.onmessage = event => {
       const msg = event.data
       if (onConsole) {
         onConsole(msg)
       }
-      // If the message indicates the server is ready, we can resolve
-      if (msg.includes('Uvicorn running on')) {
-        resolve()
+      // Once the port is bound, wait for the model to finish loading
+      if (msg.includes('Uvicorn running on') && !waiting) {
+        waiting = true
+        waitForAIServerReady().then(resolve, reject)
       }
     }
 